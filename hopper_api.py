@@ -14,7 +14,28 @@
 """<hr/>"""
 
 import HopperLowLevel
+import bisect
 import struct
+import threading
+import weakref
+from collections import OrderedDict
+
+_UINT16LE = struct.Struct("<H") # NO_DOC
+_UINT32LE = struct.Struct("<I") # NO_DOC
+_UINT64LE = struct.Struct("<Q") # NO_DOC
+_UINT16BE = struct.Struct(">H") # NO_DOC
+_UINT32BE = struct.Struct(">I") # NO_DOC
+_UINT64BE = struct.Struct(">Q") # NO_DOC
+
+# Segment, Section and Tag objects, shared by all the lookups of the same internal address while they are in use
+_INTERNED = weakref.WeakValueDictionary() # NO_DOC
+
+def _interned(cls,internal): # NO_DOC
+    instance = _INTERNED.get((cls,internal))
+    if instance is None:
+        instance = object.__new__(cls)
+        _INTERNED[(cls,internal)] = instance
+    return instance
 
 class HopperStdRedirection: # NO_DOC
     def __init__(self,tag):
@@ -49,6 +70,8 @@ class CallReference:
     CALL_DIRECT = 2
     CALL_OBJC = 3
 
+    __slots__ = ("__type__","__from__","__to__")
+
     def __init__(self,callType,fromAddress,toAddress):
         self.__type__ = callType
         self.__from__ = fromAddress
@@ -65,6 +88,7 @@ class CallReference:
 
 class LocalVariable:
     """A procedure's local variable."""
+    __slots__ = ("__name__","__displacement__")
     def __init__(self,name,displacement):
         self.__name__ = name
         self.__displacement__ = displacement
@@ -78,6 +102,9 @@ class LocalVariable:
 class Tag:
     """A Tag that could be applied to a specific address, a BasicBlock or a Procedure."""
     """Tags are built using the document."""
+    __slots__ = ("__tag_internal__","__weakref__")
+    def __new__(cls,tag_internal):
+        return _interned(cls,tag_internal)
     def __init__(self,tag_internal):
         self.__tag_internal__ = tag_internal
     def __eq__(self,other):
@@ -165,6 +192,8 @@ class Procedure:
     REGIDX_X86_R15 = 15
     REGIDX_X86_RIP = 16
 
+    __slots__ = ("__segment_internal__","__procedure_index__")
+
     def __init__(self,segment_internal,procedure_index):
         self.__segment_internal__ = segment_internal
         self.__procedure_index__ = procedure_index
@@ -172,6 +201,11 @@ class Procedure:
         return other.__class__ == self.__class__ and self.__segment_internal__ == other.__segment_internal__ and self.__procedure_index__ == other.__procedure_index__
     def __ne__(self,other):
         return other.__class__ != self.__class__ or self.__segment_internal__ != other.__segment_internal__ or self.__procedure_index__ != other.__procedure_index__
+    def __renamed(self,result):
+        Segment.dropDecodedInstructions(self.__segment_internal__,self.getEntryPoint(),1,Segment.CHANGE_LOCAL_NAME)
+        if len(Segment.__modification_observers__) > 0:
+            Segment.notifyModification(self.__segment_internal__,self.getEntryPoint(),1,Segment.CHANGE_LOCAL_NAME)
+        return result
     def getSegment(self):
         """Returns the segment this procedure belongs to."""
         return Segment(self.__segment_internal__)
@@ -244,13 +278,13 @@ class Procedure:
         return HopperLowLevel.localLabelAtAddress(self.__segment_internal__,self.__procedure_index__,addr)
     def setLocalLabelAtAddress(self,label,addr):
         """Set the local label for a given address."""
-        return HopperLowLevel.setLocalLabelAtAddress(self.__segment_internal__,self.__procedure_index__,label,addr)
+        return self.__renamed(HopperLowLevel.setLocalLabelAtAddress(self.__segment_internal__,self.__procedure_index__,label,addr))
     def declareLocalLabelAt(self,addr):
         """Create a local label at a given address, and return its name."""
-        return HopperLowLevel.declareLocalLabelAt(self.__segment_internal__,self.__procedure_index__,addr)
+        return self.__renamed(HopperLowLevel.declareLocalLabelAt(self.__segment_internal__,self.__procedure_index__,addr))
     def removeLocalLabelAtAddress(self,addr):
         """Remove a local label."""
-        return HopperLowLevel.removeLocalLabelAtAddress(self.__segment_internal__,self.__procedure_index__,addr)
+        return self.__renamed(HopperLowLevel.removeLocalLabelAtAddress(self.__segment_internal__,self.__procedure_index__,addr))
     def addressOfLocalLabel(self,label):
         """Return the address of the local label."""
         return HopperLowLevel.addressOfLocalLabel(self.__segment_internal__,self.__procedure_index__,label)
@@ -262,16 +296,17 @@ class Procedure:
         return HopperLowLevel.procedureSignature(self.__segment_internal__,self.__procedure_index__)
     def renameRegister(self,reg_cls,reg_idx,name):
         """Rename the register reg_idx, of class reg_cls to the provided name. The reg_cls argument is one of the REGCLS_* constants."""
-        return HopperLowLevel.renameRegister(self.__segment_internal__,self.__procedure_index__,reg_cls,reg_idx,name)
+        return self.__renamed(HopperLowLevel.renameRegister(self.__segment_internal__,self.__procedure_index__,reg_cls,reg_idx,name))
     def registerNameOverride(self,reg_cls,reg_idx):
         """Returns the name given to the register, if it has been previously renamed. Otherwise, returns None. The reg_cls argument is one of the REGCLS_* constants."""
         return HopperLowLevel.registerNameOverride(self.__segment_internal__,self.__procedure_index__,reg_cls,reg_idx)
     def clearRegisterNameOverride(self,reg_cls,reg_idx):
         """Clear register renaming. The reg_cls argument is one of the REGCLS_* constants."""
-        return HopperLowLevel.clearRegisterNameOverride(self.__segment_internal__,self.__procedure_index__,reg_cls,reg_idx)
+        return self.__renamed(HopperLowLevel.clearRegisterNameOverride(self.__segment_internal__,self.__procedure_index__,reg_cls,reg_idx))
 
 class BasicBlock:
     """A BasicBlock is a set of instructions that is guaranteed to be executed in a whole, if the control flow reach the first instruction."""
+    __slots__ = ("__procedure__","__basic_block_index__")
     def __init__(self,procedure,basic_block_index):
         self.__procedure__ = procedure
         self.__basic_block_index__ = basic_block_index
@@ -320,6 +355,9 @@ class BasicBlock:
     def getTagList(self):
         """Return a list a all tags for this basic block."""
         return [tag for tag in self.tagIterator()]
+    def getInstructionList(self):
+        """Decode all the instructions of the basic block in one pass. Returns a list of (address, Instruction) tuples."""
+        return self.__procedure__.getSegment().getInstructionsInRange(self.getStartingAddress(),self.getEndingAddress())
 
 class Instruction:
     """This class represents a disassembled instruction."""
@@ -333,6 +371,8 @@ class Instruction:
     ARCHITECTURE_AARCH64 = 5,
     ARCHITECTURE_OTHER = 99
 
+    __slots__ = ("__archi__","__instr__","__rawArgs__","__formattedArgs__","__cjmp__","__ijmp__","__instrLen__")
+
     def __init__(self,archi,instr,rawArgs,formattedArgs,cjmp,ijmp,instrLen):
         self.__archi__ = archi
         self.__instr__ = instr
@@ -380,6 +420,10 @@ class Instruction:
             return None
         return self.__formattedArgs__[index]
 
+    def getFormattedArguments(self):
+        """Returns the list of all the formatted arguments of the instruction."""
+        return list(self.__formattedArgs__)
+
     def isAnInconditionalJump(self):
         """Returns True if the instruction represents an inconditional jump."""
         return self.__ijmp__
@@ -394,6 +438,9 @@ class Instruction:
 
 class Section:
     """This class represents a section of a segment."""
+    __slots__ = ("__internal_section_addr__","__weakref__")
+    def __new__(cls,addr):
+        return _interned(cls,addr)
     def __init__(self,addr):
         self.__internal_section_addr__ = addr
     def __eq__(self,other):
@@ -431,10 +478,27 @@ class Segment:
     """&nbsp;&nbsp;&nbsp;&nbsp;<b>TYPE_PROCEDURE</b> : a procedure<br/>"""
     """<br/>"""
     """The class defines the constant <b>BAD_ADDRESS</b> which is returned by some methods when the"""
-    """requested information is incorrect."""
+    """requested information is incorrect.<br/>"""
+    """<br/>"""
+    """Modifications made through this API can be observed using <b>Segment.addModificationObserver(callback)</b>."""
+    """The callback is called with the internal segment, the address, the length of the modified range, and one of the values"""
+    """<b>CHANGE_BYTES</b>, <b>CHANGE_TYPE</b>, <b>CHANGE_NAME</b> (a label), <b>CHANGE_LOCAL_NAME</b> (a local label or a register"""
+    """of the procedure starting at the address) or <b>CHANGE_COMMENT</b> (a prefix or inline comment)."""
+    """The references added or removed through this API can be observed using <b>Segment.addReferenceObserver(callback)</b>."""
+    """The callback is called with the internal segment, the referencing address, the referenced address, and True if the"""
+    """reference was added or False if it was removed."""
 
     BAD_ADDRESS=-1
 
+    CHANGE_BYTES=1
+    CHANGE_TYPE=2
+    CHANGE_NAME=3
+    CHANGE_LOCAL_NAME=4
+    CHANGE_COMMENT=5
+
+    __modification_observers__ = []
+    __reference_observers__ = []
+
     TYPE_UNDEFINED=0
     TYPE_OUTSIDE=1
     TYPE_NEXT=2
@@ -467,8 +531,100 @@ class Segment:
         Segment.TYPE_STRUCTURE : "structure",
         }.get(t, "<unknown>")
 
+    @staticmethod
+    def addModificationObserver(callback):
+        """Register a callable, called after each modification of the bytes, types or names made through this API."""
+        Segment.__modification_observers__ = Segment.__modification_observers__ + [callback]
+    @staticmethod
+    def removeModificationObserver(callback):
+        """Unregister a callable previously registered with addModificationObserver."""
+        Segment.__modification_observers__ = [observer for observer in Segment.__modification_observers__ if observer != callback]
+    @staticmethod
+    def notifyModification(segment_internal,addr,length,kind): # NO_DOC
+        for observer in Segment.__modification_observers__:
+            observer(segment_internal,addr,length,kind)
+    @staticmethod
+    def addReferenceObserver(callback):
+        """Register a callable, called after each cross reference added or removed through this API."""
+        Segment.__reference_observers__ = Segment.__reference_observers__ + [callback]
+    @staticmethod
+    def removeReferenceObserver(callback):
+        """Unregister a callable previously registered with addReferenceObserver."""
+        Segment.__reference_observers__ = [observer for observer in Segment.__reference_observers__ if observer != callback]
+    @staticmethod
+    def notifyReference(segment_internal,addr,referenced,added): # NO_DOC
+        for observer in Segment.__reference_observers__:
+            observer(segment_internal,addr,referenced,added)
+
+    # Decoded instructions of every segment: OrderedDict of (internal segment address, address) -> Instruction, least recently used first,
+    # and the cached addresses of each internal segment address
+    DECODED_INSTRUCTION_CACHE_SIZE = 262144 # NO_DOC
+    MAX_INSTRUCTION_LENGTH = 16 # NO_DOC
+    __decoded_instructions__ = OrderedDict()
+    __decoded_addresses__ = {}
+    __decoded_instructions_lock__ = threading.Lock()
+
+    @staticmethod
+    def clearDecodedInstructions():
+        """Forget every decoded instruction. The modifications made through this API are taken into account automatically, but the changes made"""
+        """ from the user interface, or by the background analysis, are not: see also Document.clearDecodedInstructions."""
+        with Segment.__decoded_instructions_lock__:
+            Segment.__decoded_instructions__ = OrderedDict()
+            Segment.__decoded_addresses__ = {}
+    @staticmethod
+    def clearDecodedInstructionsOfSegments(segment_internals): # NO_DOC
+        with Segment.__decoded_instructions_lock__:
+            for segment_internal in segment_internals:
+                for address in Segment.__decoded_addresses__.pop(segment_internal,()):
+                    del Segment.__decoded_instructions__[(segment_internal,address)]
+    @staticmethod
+    def dropDecodedInstructions(segment_internal,addr,length,kind): # NO_DOC
+        if kind == Segment.CHANGE_COMMENT:
+            return
+        if kind == Segment.CHANGE_NAME:
+            # Any instruction of the document may print the label as an argument
+            for document in Document.getAllDocuments():
+                segment_internals = document.getSegmentInternals()
+                if segment_internal in segment_internals:
+                    Segment.clearDecodedInstructionsOfSegments(segment_internals)
+            return
+        if kind != Segment.CHANGE_BYTES:
+            # Marking code may disassemble far past the marked bytes, and local names are printed anywhere in their procedure
+            Segment.clearDecodedInstructionsOfSegments([segment_internal])
+            return
+        with Segment.__decoded_instructions_lock__:
+            addresses = Segment.__decoded_addresses__.get(segment_internal)
+            if addresses == None:
+                return
+            # An instruction starting a few bytes before the range may overlap it
+            start = addr - Segment.MAX_INSTRUCTION_LENGTH + 1
+            end = addr + max(length,1)
+            if end - start <= len(addresses):
+                dropped = [address for address in range(start,end) if address in addresses]
+            else:
+                dropped = [address for address in addresses if start <= address < end]
+            for address in dropped:
+                addresses.discard(address)
+                del Segment.__decoded_instructions__[(segment_internal,address)]
+
+    __slots__ = ("__internal_segment_addr__","__weakref__")
+
+    def __new__(cls,addr):
+        return _interned(cls,addr)
     def __init__(self,addr):
         self.__internal_segment_addr__ = addr
+    def __modified(self,addr,length,kind,result):
+        Segment.dropDecodedInstructions(self.__internal_segment_addr__,addr,length,kind)
+        if kind == Segment.CHANGE_TYPE:
+            # Marking code or procedures, or undefining them, moves the procedure ranges
+            Document.invalidateProcedureIndexesOfSegment(self.__internal_segment_addr__)
+        if len(Segment.__modification_observers__) > 0:
+            Segment.notifyModification(self.__internal_segment_addr__,addr,length,kind)
+        return result
+    def __referenced(self,addr,referenced,added,result):
+        if result != False and len(Segment.__reference_observers__) > 0:
+            Segment.notifyReference(self.__internal_segment_addr__,addr,referenced,added)
+        return result
     def __eq__(self,other):
         return other.__class__ == self.__class__ and self.__internal_segment_addr__ == other.__internal_segment_addr__
     def __ne__(self,other):
@@ -518,78 +674,110 @@ class Segment:
         if result == False:
             return False
         return struct.unpack("B", result)[0]
+    def readStruct(self,fmt,addr,count=1):
+        """Read 'count' consecutive records described by the struct module format 'fmt', starting at a given address."""
+        """All the records are fetched with a single read. Returns a list of tuples, or False if the range cannot be read."""
+        packer = fmt if isinstance(fmt, struct.Struct) else struct.Struct(fmt)
+        if count <= 0:
+            return []
+        data = HopperLowLevel.readBytes(self.__internal_segment_addr__,addr,packer.size * count)
+        if data == False or len(data) < packer.size * count:
+            return False
+        return [packer.unpack_from(data, index * packer.size) for index in range(count)]
+    def readUInt32Array(self,addr,count,bigEndian=False):
+        """Read an array of 'count' 32 bits integers with a single read. Returns a list of integers, or False if the range cannot be read."""
+        return self.__readIntegerArray(">I" if bigEndian else "<I",addr,count)
+    def readUInt64Array(self,addr,count,bigEndian=False):
+        """Read an array of 'count' 64 bits integers with a single read. Returns a list of integers, or False if the range cannot be read."""
+        return self.__readIntegerArray(">Q" if bigEndian else "<Q",addr,count)
+    def __readIntegerArray(self,fmt,addr,count):
+        if count <= 0:
+            return []
+        packer = struct.Struct(fmt[0] + str(count) + fmt[1])
+        data = HopperLowLevel.readBytes(self.__internal_segment_addr__,addr,packer.size)
+        if data == False or len(data) < packer.size:
+            return False
+        return list(packer.unpack_from(data))
+    def __readInteger(self,packer,addr):
+        data = HopperLowLevel.readBytes(self.__internal_segment_addr__,addr,packer.size)
+        if data == False or len(data) < packer.size:
+            return False
+        return packer.unpack_from(data)[0]
     def readUInt16LE(self,addr):
-        """Read a 16 bits little endian integer."""
-        return self.readByte(addr) | (self.readByte(addr + 1) << 8)
+        """Read a 16 bits little endian integer. Returns False if the integer is read outside of the segment."""
+        return self.__readInteger(_UINT16LE,addr)
     def readUInt32LE(self,addr):
-        """Read a 32 bits little endian integer."""
-        return self.readByte(addr) | (self.readByte(addr + 1) << 8) | (self.readByte(addr + 2) << 16) | (self.readByte(addr + 3) << 24)
+        """Read a 32 bits little endian integer. Returns False if the integer is read outside of the segment."""
+        return self.__readInteger(_UINT32LE,addr)
     def readUInt64LE(self,addr):
-        """Read a 64 bits little endian integer."""
-        return self.readByte(addr) | (self.readByte(addr + 1) << 8) | (self.readByte(addr + 2) << 16) | (self.readByte(addr + 3) << 24) | (self.readByte(addr + 4) << 32) | (self.readByte(addr + 5) << 40) | (self.readByte(addr + 6) << 48) | (self.readByte(addr + 7) << 56)
+        """Read a 64 bits little endian integer. Returns False if the integer is read outside of the segment."""
+        return self.__readInteger(_UINT64LE,addr)
     def readUInt16BE(self,addr):
-        """Read a 16 bits big endian integer."""
-        return self.readByte(addr + 1) | (self.readByte(addr) << 8)
+        """Read a 16 bits big endian integer. Returns False if the integer is read outside of the segment."""
+        return self.__readInteger(_UINT16BE,addr)
     def readUInt32BE(self,addr):
-        """Read a 32 bits big endian integer."""
-        return self.readByte(addr + 3) | (self.readByte(addr + 2) << 8) | (self.readByte(addr + 1) << 16) | (self.readByte(addr) << 24)
+        """Read a 32 bits big endian integer. Returns False if the integer is read outside of the segment."""
+        return self.__readInteger(_UINT32BE,addr)
     def readUInt64BE(self,addr):
-        """Read a 64 bits big endian integer."""
-        return self.readByte(addr + 7) | (self.readByte(addr + 6) << 8) | (self.readByte(addr + 5) << 16) | (self.readByte(addr + 4) << 24) | (self.readByte(addr + 3) << 32) | (self.readByte(addr + 2) << 40) | (self.readByte(addr + 1) << 48) | (self.readByte(addr) << 56)
+        """Read a 64 bits big endian integer. Returns False if the integer is read outside of the segment."""
+        return self.__readInteger(_UINT64BE,addr)
     def writeBytes(self,addr,bytesStr):
         """Write bytes at a given address. Bytes are given as a string. Returns True if the writting has succeed."""
-        return HopperLowLevel.writeBytes(self.__internal_segment_addr__,addr,bytesStr)
+        return self.__modified(addr,len(bytesStr),Segment.CHANGE_BYTES,HopperLowLevel.writeBytes(self.__internal_segment_addr__,addr,bytesStr))
     def writeByte(self,addr,value):
         """Write a byte at a given address. Returns True if the writting has succeed."""
-        return HopperLowLevel.writeBytes(self.__internal_segment_addr__,addr,struct.pack("B", value))
+        return self.__modified(addr,1,Segment.CHANGE_BYTES,HopperLowLevel.writeBytes(self.__internal_segment_addr__,addr,struct.pack("B", value)))
     def writeUInt16LE(self,addr,value):
         """Write a 16 bits little endian integer. Returns True if succeeded."""
-        return self.writeByte(addr, value & 0xFF) and self.writeByte(addr + 1, (value >> 8) & 0xFF)
+        return self.__modified(addr,2,Segment.CHANGE_BYTES,HopperLowLevel.writeBytes(self.__internal_segment_addr__,addr,_UINT16LE.pack(value & 0xFFFF)))
     def writeUInt32LE(self,addr,value):
         """Write a 32 bits little endian integer. Returns True if succeeded."""
-        return self.writeByte(addr, value & 0xFF) and self.writeByte(addr + 1, (value >> 8) & 0xFF) and self.writeByte(addr + 2, (value >> 16) & 0xFF) and self.writeByte(addr + 3, (value >> 24) & 0xFF)
+        return self.__modified(addr,4,Segment.CHANGE_BYTES,HopperLowLevel.writeBytes(self.__internal_segment_addr__,addr,_UINT32LE.pack(value & 0xFFFFFFFF)))
     def writeUInt64LE(self,addr,value):
-        """Write a 32 bits little endian integer. Returns True if succeeded."""
-        return self.writeByte(addr, value & 0xFF) and self.writeByte(addr + 1, (value >> 8) & 0xFF) and self.writeByte(addr + 2, (value >> 16) & 0xFF) and self.writeByte(addr + 3, (value >> 24) & 0xFF) and self.writeByte(addr + 4, (value >> 32) & 0xFF) and self.writeByte(addr + 5, (value >> 40) & 0xFF) and self.writeByte(addr + 6, (value >> 48) & 0xFF) and self.writeByte(addr + 7, (value >> 56) & 0xFF)
+        """Write a 64 bits little endian integer. Returns True if succeeded."""
+        return self.__modified(addr,8,Segment.CHANGE_BYTES,HopperLowLevel.writeBytes(self.__internal_segment_addr__,addr,_UINT64LE.pack(value & 0xFFFFFFFFFFFFFFFF)))
     def writeUInt16BE(self,addr,value):
         """Write a 16 bits big endian integer. Returns True if succeeded."""
-        return self.writeByte(addr + 1, value & 0xFF) and self.writeByte(addr, (value >> 8) & 0xFF)
+        return self.__modified(addr,2,Segment.CHANGE_BYTES,HopperLowLevel.writeBytes(self.__internal_segment_addr__,addr,_UINT16BE.pack(value & 0xFFFF)))
     def writeUInt32BE(self,addr,value):
         """Write a 32 bits big endian integer. Returns True if succeeded."""
-        return self.writeByte(addr + 3, value & 0xFF) and self.writeByte(addr + 2, (value >> 8) & 0xFF) and self.writeByte(addr + 1, (value >> 16) & 0xFF) and self.writeByte(addr, (value >> 24) & 0xFF)
+        return self.__modified(addr,4,Segment.CHANGE_BYTES,HopperLowLevel.writeBytes(self.__internal_segment_addr__,addr,_UINT32BE.pack(value & 0xFFFFFFFF)))
     def writeUInt64BE(self,addr,value):
-        """Write a 32 bits big endian integer. Returns True if succeeded."""
-        return self.writeByte(addr + 7, value & 0xFF) and self.writeByte(addr + 6, (value >> 8) & 0xFF) and self.writeByte(addr + 5, (value >> 16) & 0xFF) and self.writeByte(addr + 4, (value >> 24) & 0xFF) and self.writeByte(addr + 3, (value >> 32) & 0xFF) and self.writeByte(addr + 2, (value >> 40) & 0xFF) and self.writeByte(addr + 1, (value >> 48) & 0xFF) and self.writeByte(addr, (value >> 56) & 0xFF)
+        """Write a 64 bits big endian integer. Returns True if succeeded."""
+        return self.__modified(addr,8,Segment.CHANGE_BYTES,HopperLowLevel.writeBytes(self.__internal_segment_addr__,addr,_UINT64BE.pack(value & 0xFFFFFFFFFFFFFFFF)))
+    def newPatchBatch(self):
+        """Returns a new PatchBatch object collecting writes to this segment, to be applied at once."""
+        return PatchBatch(self)
     def markAsUndefined(self,addr):
         """Mark the address as being undefined."""
-        return HopperLowLevel.markAsUndefined(self.__internal_segment_addr__,addr)
+        return self.__modified(addr,1,Segment.CHANGE_TYPE,HopperLowLevel.markAsUndefined(self.__internal_segment_addr__,addr))
     def markRangeAsUndefined(self,addr,length):
         """Mark the address range as being undefined."""
-        return HopperLowLevel.markRangeAsUndefined(self.__internal_segment_addr__,addr,length)
+        return self.__modified(addr,length,Segment.CHANGE_TYPE,HopperLowLevel.markRangeAsUndefined(self.__internal_segment_addr__,addr,length))
     def markAsCode(self,addr):
         """Mark the address as being code."""
-        return HopperLowLevel.markAsCode(self.__internal_segment_addr__,addr)
+        return self.__modified(addr,1,Segment.CHANGE_TYPE,HopperLowLevel.markAsCode(self.__internal_segment_addr__,addr))
     def markAsProcedure(self,addr):
         """Mark the address as being a procedure."""
-        return HopperLowLevel.markAsProcedure(self.__internal_segment_addr__,addr)
+        return self.__modified(addr,1,Segment.CHANGE_TYPE,HopperLowLevel.markAsProcedure(self.__internal_segment_addr__,addr))
     def markAsDataByteArray(self,addr,count):
         """Mark the address as being byte array."""
-        return HopperLowLevel.markAsDataByteArray(self.__internal_segment_addr__,addr,count)
+        return self.__modified(addr,count,Segment.CHANGE_TYPE,HopperLowLevel.markAsDataByteArray(self.__internal_segment_addr__,addr,count))
     def markAsDataShortArray(self,addr,count):
         """Mark the address as being a short array."""
-        return HopperLowLevel.markAsDataShortArray(self.__internal_segment_addr__,addr,count)
+        return self.__modified(addr,count * 2,Segment.CHANGE_TYPE,HopperLowLevel.markAsDataShortArray(self.__internal_segment_addr__,addr,count))
     def markAsDataIntArray(self,addr,count):
         """Mark the address as being an int array."""
-        return HopperLowLevel.markAsDataIntArray(self.__internal_segment_addr__,addr,count)
+        return self.__modified(addr,count * 4,Segment.CHANGE_TYPE,HopperLowLevel.markAsDataIntArray(self.__internal_segment_addr__,addr,count))
     def isThumbAtAddress(self,addr):
         """Returns True is instruction at address addr is ARM Thumb mode."""
         return HopperLowLevel.isThumbAtAddress(self.__internal_segment_addr__,addr)
     def setThumbModeAtAddress(self,addr):
         """Set the Thumb mode at the given address."""
-        return HopperLowLevel.setThumbModeAtAddress(self.__internal_segment_addr__,addr)
+        return self.__modified(addr,1,Segment.CHANGE_TYPE,HopperLowLevel.setThumbModeAtAddress(self.__internal_segment_addr__,addr))
     def setARMModeAtAddress(self,addr):
         """Set the ARM mode at the given address."""
-        return HopperLowLevel.setARMModeAtAddress(self.__internal_segment_addr__,addr)
+        return self.__modified(addr,1,Segment.CHANGE_TYPE,HopperLowLevel.setARMModeAtAddress(self.__internal_segment_addr__,addr))
     def getTypeAtAddress(self,addr):
         """Returns the type of the byte at a given address."""
         """The type can be <b>TYPE_UNDEFINED</b>, <b>TYPE_NEXT</b>, <b>TYPE_INT8</b>, ..."""
@@ -598,7 +786,7 @@ class Segment:
     def setTypeAtAddress(self,addr,length,typeValue):
         """Set the type of a byte range."""
         """The type must be <b>TYPE_UNDEFINED</b>, <b>TYPE_INT8</b>, ..."""
-        return HopperLowLevel.setTypeAtAddress(self.__internal_segment_addr__,addr,length,typeValue)
+        return self.__modified(addr,length,Segment.CHANGE_TYPE,HopperLowLevel.setTypeAtAddress(self.__internal_segment_addr__,addr,length,typeValue))
     def getNextAddressWithType(self,addr,typeValue):
         """Returns the next address of a given type."""
         """The search begins at the given address, so the returned value can be the given address itself."""
@@ -609,7 +797,7 @@ class Segment:
         return HopperLowLevel.disassembleWholeSegment(self.__internal_segment_addr__)
     def setNameAtAddress(self,addr,name):
         """Set the label name at a given address."""
-        return (HopperLowLevel.setNameAtAddress(self.__internal_segment_addr__,addr,name) == 1)
+        return self.__modified(addr,1,Segment.CHANGE_NAME,HopperLowLevel.setNameAtAddress(self.__internal_segment_addr__,addr,name) == 1)
     def getNameAtAddress(self,addr):
         """Get the label name at a given address."""
         return HopperLowLevel.getNameAtAddress(self.__internal_segment_addr__,addr)
@@ -621,19 +809,49 @@ class Segment:
         return HopperLowLevel.getCommentAtAddress(self.__internal_segment_addr__,addr)
     def setCommentAtAddress(self,addr,comment):
         """Set the prefix comment at a given address."""
-        return HopperLowLevel.setCommentAtAddress(self.__internal_segment_addr__,addr,comment)
+        return self.__modified(addr,1,Segment.CHANGE_COMMENT,HopperLowLevel.setCommentAtAddress(self.__internal_segment_addr__,addr,comment))
     def getInlineCommentAtAddress(self,addr):
         """Get the inline comment at a given address."""
         return HopperLowLevel.getInlineCommentAtAddress(self.__internal_segment_addr__,addr)
     def setInlineCommentAtAddress(self,addr,comment):
         """Set the inline comment at a given address."""
-        return HopperLowLevel.setInlineCommentAtAddress(self.__internal_segment_addr__,addr,comment)
+        return self.__modified(addr,1,Segment.CHANGE_COMMENT,HopperLowLevel.setInlineCommentAtAddress(self.__internal_segment_addr__,addr,comment))
     def getInstructionAtAddress(self,addr):
-        """Get the disassembled instruction at a given address."""
+        """Get the disassembled instruction at a given address. Decoded instructions are cached, so the returned object must not be modified."""
+        key = (self.__internal_segment_addr__,addr)
+        with Segment.__decoded_instructions_lock__:
+            instr = Segment.__decoded_instructions__.get(key)
+            if instr != None:
+                Segment.__decoded_instructions__.move_to_end(key)
+                return instr
         infos = HopperLowLevel.getInstructionAtAddress(self.__internal_segment_addr__,addr)
         if infos == None:
             return None
-        return Instruction(infos[0], infos[1], infos[2], infos[3], infos[4], infos[5], infos[6])
+        instr = Instruction(infos[0], infos[1], infos[2], infos[3], infos[4], infos[5], infos[6])
+        with Segment.__decoded_instructions_lock__:
+            cache = Segment.__decoded_instructions__
+            if key not in cache:
+                Segment.__decoded_addresses__.setdefault(self.__internal_segment_addr__,set()).add(addr)
+            cache[key] = instr
+            # A single budget shared by all the segments of all the documents
+            while len(cache) > Segment.DECODED_INSTRUCTION_CACHE_SIZE:
+                (segment_internal,address),_ = cache.popitem(last=False)
+                addresses = Segment.__decoded_addresses__[segment_internal]
+                addresses.discard(address)
+                if len(addresses) == 0:
+                    del Segment.__decoded_addresses__[segment_internal]
+        return instr
+    def getInstructionsInRange(self,start,end):
+        """Decode all the instructions from 'start' up to 'end' (excluded), one after the other. Returns a list of (address, Instruction) tuples."""
+        instructions = []
+        addr = start
+        while addr < end:
+            instr = self.getInstructionAtAddress(addr)
+            if instr == None:
+                break
+            instructions.append((addr,instr))
+            addr += max(instr.getInstructionLength(),1)
+        return instructions
     def getReferencesOfAddress(self,addr):
         """Get the list of addresses that reference a given address."""
         return HopperLowLevel.getReferencesOfAddress(self.__internal_segment_addr__,addr)
@@ -642,10 +860,10 @@ class Segment:
         return HopperLowLevel.getReferencesFromAddress(self.__internal_segment_addr__,addr)
     def addReference(self,addr,referenced):
         """Add a cross reference to the 'referenced' address from 'addr' address."""
-        return HopperLowLevel.addReference(self.__internal_segment_addr__,addr,referenced)
+        return self.__referenced(addr,referenced,True,HopperLowLevel.addReference(self.__internal_segment_addr__,addr,referenced))
     def removeReference(self,addr,referenced):
         """Remove the cross reference to the 'referenced' address from 'addr' address."""
-        return HopperLowLevel.removeReference(self.__internal_segment_addr__,addr,referenced)
+        return self.__referenced(addr,referenced,False,HopperLowLevel.removeReference(self.__internal_segment_addr__,addr,referenced))
     def getLabelCount(self):
         """Get the number of named addresses."""
         return HopperLowLevel.getLabelCount(self.__internal_segment_addr__)
@@ -701,6 +919,197 @@ class Segment:
         """Returns the size in bytes of a single element of the array, or 0 if not inside an array."""
         return HopperLowLevel.arrayElementSize(self.__internal_segment_addr__,address)
 
+class PatchBatch:
+    """A PatchBatch collects many writes, and applies them later as a single transaction."""
+    """Adjacent and overlapping writes are merged into the fewest possible contiguous ranges, so that"""
+    """each range costs a single write. When two writes overlap, the last one wins.<br/>"""
+    """Writes are applied all or none: if a range cannot be written, the ranges already written are restored."""
+    """Once committed, the original bytes are kept in an undo journal, and the whole batch can be reverted with <b>undo()</b>.<br/>"""
+    """A PatchBatch is obtained using <b>Document.newPatchBatch()</b> or <b>Segment.newPatchBatch()</b>."""
+    def __init__(self,target):
+        self.__target__ = target
+        self.__patches__ = []
+        self.__journal__ = []
+    def writeBytes(self,addr,bytesStr):
+        """Queue bytes to be written at a given address."""
+        if len(bytesStr) > 0:
+            self.__patches__.append((addr,bytes(bytesStr)))
+    def writeByte(self,addr,value):
+        """Queue a byte to be written at a given address."""
+        self.__patches__.append((addr,struct.pack("B", value & 0xFF)))
+    def writeUInt16LE(self,addr,value):
+        """Queue a 16 bits little endian integer to be written at a given address."""
+        self.__patches__.append((addr,_UINT16LE.pack(value & 0xFFFF)))
+    def writeUInt32LE(self,addr,value):
+        """Queue a 32 bits little endian integer to be written at a given address."""
+        self.__patches__.append((addr,_UINT32LE.pack(value & 0xFFFFFFFF)))
+    def writeUInt64LE(self,addr,value):
+        """Queue a 64 bits little endian integer to be written at a given address."""
+        self.__patches__.append((addr,_UINT64LE.pack(value & 0xFFFFFFFFFFFFFFFF)))
+    def writeUInt16BE(self,addr,value):
+        """Queue a 16 bits big endian integer to be written at a given address."""
+        self.__patches__.append((addr,_UINT16BE.pack(value & 0xFFFF)))
+    def writeUInt32BE(self,addr,value):
+        """Queue a 32 bits big endian integer to be written at a given address."""
+        self.__patches__.append((addr,_UINT32BE.pack(value & 0xFFFFFFFF)))
+    def writeUInt64BE(self,addr,value):
+        """Queue a 64 bits big endian integer to be written at a given address."""
+        self.__patches__.append((addr,_UINT64BE.pack(value & 0xFFFFFFFFFFFFFFFF)))
+    def getPendingCount(self):
+        """Returns the number of writes that are waiting to be committed."""
+        return len(self.__patches__)
+    def getCoalescedRanges(self):
+        """Returns the list of (address, bytes) ranges that will be written by <b>commit()</b>, sorted by address."""
+        if len(self.__patches__) == 0:
+            return []
+        order = sorted(range(len(self.__patches__)), key=lambda index: self.__patches__[index][0])
+        starts = []
+        ends = []
+        for index in order:
+            addr, data = self.__patches__[index]
+            if len(starts) > 0 and addr <= ends[-1]:
+                ends[-1] = max(ends[-1], addr + len(data))
+            else:
+                starts.append(addr)
+                ends.append(addr + len(data))
+        buffers = [bytearray(ends[index] - starts[index]) for index in range(len(starts))]
+        # Replay the writes in their original order, so that the last write wins on overlaps
+        for addr, data in self.__patches__:
+            run = bisect.bisect_right(starts, addr) - 1
+            offset = addr - starts[run]
+            buffers[run][offset:offset + len(data)] = data
+        return [(starts[index], bytes(buffers[index])) for index in range(len(starts))]
+    def commit(self):
+        """Apply all the pending writes. Returns True if succeeded. If any range cannot be written, nothing is modified and the method returns False."""
+        """A successful commit is recorded in the undo journal."""
+        writes = []
+        for addr, data in self.getCoalescedRanges():
+            segment = self.__segmentForRange(addr,len(data))
+            if segment == None:
+                return False
+            original = segment.readBytes(addr,len(data))
+            if original == False:
+                return False
+            writes.append((segment,addr,data,original))
+        applied = []
+        for segment, addr, data, original in writes:
+            if not segment.writeBytes(addr,data):
+                for undo_segment, undo_addr, undo_data in reversed(applied):
+                    undo_segment.writeBytes(undo_addr,undo_data)
+                return False
+            applied.append((segment,addr,original))
+        self.__journal__.append(applied)
+        self.__patches__ = []
+        return True
+    def discard(self):
+        """Drop all the pending writes."""
+        self.__patches__ = []
+    def canUndo(self):
+        """Returns True if a committed transaction can be reverted."""
+        return len(self.__journal__) > 0
+    def undo(self):
+        """Revert the last committed transaction by restoring the original bytes. Returns True if succeeded."""
+        if len(self.__journal__) == 0:
+            return False
+        applied = self.__journal__.pop()
+        result = True
+        for segment, addr, original in reversed(applied):
+            result = segment.writeBytes(addr,original) and result
+        return result
+    def __segmentForRange(self,addr,length):
+        if isinstance(self.__target__, Segment):
+            segment = self.__target__
+        else:
+            segment = self.__target__.getSegmentAtAddress(addr)
+            if segment == None:
+                return None
+        start = segment.getStartingAddress()
+        if addr < start or addr + length > start + segment.getLength():
+            return None
+        return segment
+
+class AddressIntervalIndex: # NO_DOC
+    """Sorted intervals of the segments and sections of a document, searched with bisect."""
+    def __init__(self,document_internal):
+        self.segment_starts = []
+        self.segment_ends = []
+        self.segments = []
+        self.section_starts = []
+        self.section_ends = []
+        self.sections = []
+        segment_ranges = []
+        section_ranges = []
+        for index in range(HopperLowLevel.getSegmentCount(document_internal)):
+            segment_addr = HopperLowLevel.getSegmentAddress(document_internal,index)
+            if segment_addr == 0:
+                continue
+            segment = Segment(segment_addr)
+            start = segment.getStartingAddress()
+            segment_ranges.append((start,start + segment.getLength(),index,segment))
+            for section_index in range(segment.getSectionCount()):
+                section = segment.getSection(section_index)
+                if section == None:
+                    continue
+                section_start = section.getStartingAddress()
+                section_ranges.append((section_start,section_start + section.getLength(),section))
+        segment_ranges.sort(key=lambda entry: entry[0])
+        section_ranges.sort(key=lambda entry: entry[0])
+        self.segment_starts = [entry[0] for entry in segment_ranges]
+        self.segment_ends = [entry[1] for entry in segment_ranges]
+        self.segment_indexes = [entry[2] for entry in segment_ranges]
+        self.segments = [entry[3] for entry in segment_ranges]
+        self.section_starts = [entry[0] for entry in section_ranges]
+        self.section_ends = [entry[1] for entry in section_ranges]
+        self.sections = [entry[2] for entry in section_ranges]
+
+    def segmentSlot(self,addr):
+        slot = bisect.bisect_right(self.segment_starts,addr) - 1
+        if slot < 0 or addr >= self.segment_ends[slot]:
+            return -1
+        return slot
+
+    def sectionAt(self,addr):
+        slot = bisect.bisect_right(self.section_starts,addr) - 1
+        if slot < 0 or addr >= self.section_ends[slot]:
+            return None
+        return self.sections[slot]
+
+class ProcedureIntervalIndex: # NO_DOC
+    """Sorted (entry point, end) ranges of all the procedures of a document, searched with bisect."""
+    def __init__(self,document_internal):
+        entries = []
+        self.segment_addrs = set()
+        for index in range(HopperLowLevel.getSegmentCount(document_internal)):
+            segment_addr = HopperLowLevel.getSegmentAddress(document_internal,index)
+            if segment_addr == 0:
+                continue
+            self.segment_addrs.add(segment_addr)
+            for procedure_index in range(HopperLowLevel.getProcedureCount(segment_addr)):
+                entry_point = HopperLowLevel.getProcedureEntryPoint(segment_addr,procedure_index)
+                end = entry_point + 1
+                for block_index in range(HopperLowLevel.getBasicBlockCount(segment_addr,procedure_index)):
+                    end = max(end, HopperLowLevel.getBasicBlockEndingAddress(segment_addr,procedure_index,block_index))
+                entries.append((entry_point,end,segment_addr,procedure_index))
+        entries.sort(key=lambda entry: entry[0])
+        self.entry_points = [entry[0] for entry in entries]
+        self.ends = [entry[1] for entry in entries]
+        self.segments = [entry[2] for entry in entries]
+        self.procedure_indexes = [entry[3] for entry in entries]
+        # Running maximum of the ends, so that the backward walk on overlapping procedures stops as soon as possible
+        self.max_ends = []
+        max_end = 0
+        for end in self.ends:
+            max_end = max(max_end, end)
+            self.max_ends.append(max_end)
+
+    def procedureSlot(self,addr):
+        slot = bisect.bisect_right(self.entry_points,addr) - 1
+        while slot >= 0 and self.max_ends[slot] > addr:
+            if self.ends[slot] > addr:
+                return slot
+            slot -= 1
+        return -1
+
 class Document:
     """This class represents the disassembled document. A document is a set of segments."""
     
@@ -722,7 +1131,11 @@ class Document:
     FORMAT_NEGATE = 0x20
     FORMAT_LEADINGZEROES = 0x40
     FORMAT_SIGNED = 0x80
-    
+
+    __address_indexes__ = {}
+    __procedure_indexes__ = {}
+    __documents_generation__ = 0
+
     def __init__(self,addr):
         self.__internal_document_addr__ = addr
     def __eq__(self,other):
@@ -732,6 +1145,7 @@ class Document:
     @staticmethod
     def newDocument():
         """Creates and returns a new empty document."""
+        Document.__documents_generation__ += 1
         return Document(HopperLowLevel.newDocument())
     @staticmethod
     def getCurrentDocument():
@@ -742,6 +1156,11 @@ class Document:
         """Returns a list of all currently opened documents."""
         return [Document(d) for d in HopperLowLevel.allDocuments()]
     @staticmethod
+    def getDocumentsGeneration():
+        """Returns a cheap token that changes when a document is opened or closed, or renamed using setDocumentName."""
+        """It can be compared with a previous value to know if a cache of documents is still valid, without asking every document for its name."""
+        return (Document.__documents_generation__, tuple(HopperLowLevel.allDocuments()))
+    @staticmethod
     def ask(msg):
         """Open a window containing a text field, and wait for the user to give a string value. Returns the string, or returns None if the Cancel button is hit."""
         return HopperLowLevel.ask(msg)
@@ -759,9 +1178,17 @@ class Document:
         return HopperLowLevel.message(msg,buttons)
     def closeDocument(self):
         """Close the document."""
+        self.clearDecodedInstructions()
+        self.invalidateAddressIndex()
+        self.invalidateProcedureIndex()
+        Document.__documents_generation__ += 1
         HopperLowLevel.closeDocument(self.__internal_document_addr__)
     def loadDocumentAt(self,path):
         """Load a document at a given path."""
+        self.clearDecodedInstructions()
+        self.invalidateAddressIndex()
+        self.invalidateProcedureIndex()
+        Document.__documents_generation__ += 1
         HopperLowLevel.loadDocumentAt(self.__internal_document_addr__,path)
     def saveDocument(self):
         """Save the document."""
@@ -774,6 +1201,7 @@ class Document:
         return HopperLowLevel.documentName(self.__internal_document_addr__)
     def setDocumentName(self,name):
         """Set the document display name."""
+        Document.__documents_generation__ += 1
         HopperLowLevel.setDocumentName(self.__internal_document_addr__,name)
     def backgroundProcessActive(self):
         """Returns True if the background analysis is still running."""
@@ -803,13 +1231,21 @@ class Document:
     def newSegment(self,start_address,length):
         """Create a new segment of 'length' bytes starting at 'start_address'."""
         HopperLowLevel.newSegment(self.__internal_document_addr__,start_address,length)
+        self.invalidateAddressIndex()
         return self.getSegmentAtAddress(start_address)
     def deleteSegment(self,seg_index):
         """Delete the segment at a given index. Return True if succeeded."""
-        return HopperLowLevel.deleteSegment(self.__internal_document_addr__,seg_index)
+        segment_internal = HopperLowLevel.getSegmentAddress(self.__internal_document_addr__,seg_index)
+        result = HopperLowLevel.deleteSegment(self.__internal_document_addr__,seg_index)
+        self.invalidateAddressIndex()
+        self.invalidateProcedureIndex()
+        Segment.clearDecodedInstructionsOfSegments([segment_internal])
+        return result
     def renameSegment(self,seg_index,name):
         """Rename the segment at a given index. Return True if succeeded."""
-        return HopperLowLevel.renameSegment(self.__internal_document_addr__,seg_index,name)
+        result = HopperLowLevel.renameSegment(self.__internal_document_addr__,seg_index,name)
+        self.invalidateAddressIndex()
+        return result
     def getSegmentCount(self):
         """Returns the number of segment the document contains."""
         return HopperLowLevel.getSegmentCount(self.__internal_document_addr__);
@@ -834,21 +1270,95 @@ class Document:
     def getSegmentsList(self):
         """Returns a list containing all the segments."""
         return [self.getSegment(x) for x in xrange(self.getSegmentCount())]
+    def getSegmentInternals(self): # NO_DOC
+        return [HopperLowLevel.getSegmentAddress(self.__internal_document_addr__,x) for x in xrange(self.getSegmentCount())]
+    def clearDecodedInstructions(self):
+        """Forget the decoded instructions of the segments of the document, ie after the background analysis or the user interface changed its code or its labels."""
+        Segment.clearDecodedInstructionsOfSegments(self.getSegmentInternals())
     def getSegmentIndexAtAddress(self,addr):
         """Returns the segment index for a particular address."""
-        return HopperLowLevel.getSegmentIndexAtAddress(self.__internal_document_addr__,addr)
+        index = self.__getAddressIndex()
+        slot = index.segmentSlot(addr)
+        if slot == -1:
+            return self.__resolveUnindexedAddress(addr)
+        return index.segment_indexes[slot]
     def getSegmentAtAddress(self,addr):
         """Returns the segment for a particular address."""
-        idx=self.getSegmentIndexAtAddress(addr)
+        index = self.__getAddressIndex()
+        slot = index.segmentSlot(addr)
+        if slot != -1:
+            return index.segments[slot]
+        idx=self.__resolveUnindexedAddress(addr)
         if idx == -1:
             return None
         return self.getSegment(idx)
     def getSectionAtAddress(self,addr):
         """Returns the section for a particular address."""
-        seg=self.getSegmentAtAddress(addr)
-        if seg == None:
+        index = self.__getAddressIndex()
+        if index.segmentSlot(addr) == -1:
+            seg=self.getSegmentAtAddress(addr)
+            if seg == None:
+                return None
+            return seg.getSectionAtAddress(addr)
+        return index.sectionAt(addr)
+    def resolveAddresses(self,addrs):
+        """Resolve many addresses at once. Returns a list containing, for each address, a (Segment, Section) tuple."""
+        """Each element of the tuple is None if the address is not mapped."""
+        index = self.__getAddressIndex()
+        result = []
+        for addr in addrs:
+            slot = index.segmentSlot(addr)
+            if slot == -1:
+                seg = self.getSegmentAtAddress(addr)
+                result.append((seg, seg.getSectionAtAddress(addr) if seg != None else None))
+                index = self.__getAddressIndex()
+            else:
+                result.append((index.segments[slot], index.sectionAt(addr)))
+        return result
+    def invalidateAddressIndex(self):
+        """Drop the cached segment and section ranges used to resolve addresses. They are rebuilt on the next lookup."""
+        """This is done automatically by newSegment, deleteSegment and renameSegment. Call it if the segments"""
+        """are modified by other means."""
+        Document.__address_indexes__.pop(self.__internal_document_addr__, None)
+    def __getAddressIndex(self):
+        index = Document.__address_indexes__.get(self.__internal_document_addr__)
+        if index == None:
+            index = AddressIntervalIndex(self.__internal_document_addr__)
+            Document.__address_indexes__[self.__internal_document_addr__] = index
+        return index
+    def __resolveUnindexedAddress(self,addr):
+        # The address is not covered by the cached ranges: ask Hopper, and rebuild the index if the layout has changed behind our back
+        idx = HopperLowLevel.getSegmentIndexAtAddress(self.__internal_document_addr__,addr)
+        if idx != -1:
+            self.invalidateAddressIndex()
+        return idx
+    def getProcedureAtAddress(self,addr):
+        """Returns the Procedure object containing a given address, whatever the segment, or None if there is no procedure there."""
+        """The procedure ranges of the whole document are computed once, and reused until the background analysis changes them."""
+        if self.backgroundProcessActive():
+            # Procedures are still being created: do not trust, nor build, the cached ranges
+            self.invalidateProcedureIndex()
+            seg = self.getSegmentAtAddress(addr)
+            if seg == None:
+                return None
+            return seg.getProcedureAtAddress(addr)
+        index = Document.__procedure_indexes__.get(self.__internal_document_addr__)
+        if index == None:
+            index = ProcedureIntervalIndex(self.__internal_document_addr__)
+            Document.__procedure_indexes__[self.__internal_document_addr__] = index
+        slot = index.procedureSlot(addr)
+        if slot == -1:
             return None
-        return seg.getSectionAtAddress(addr)
+        return Procedure(index.segments[slot],index.procedure_indexes[slot])
+    def invalidateProcedureIndex(self):
+        """Drop the cached procedure ranges used by getProcedureAtAddress. They are rebuilt on the next lookup."""
+        """This is done automatically by deleteSegment, and when the type of bytes is changed through Segment. Call it if"""
+        """the procedures are modified by other means."""
+        Document.__procedure_indexes__.pop(self.__internal_document_addr__, None)
+    @staticmethod
+    def invalidateProcedureIndexesOfSegment(segment_internal): # NO_DOC
+        for document_internal in [document_internal for document_internal, index in Document.__procedure_indexes__.items() if segment_internal in index.segment_addrs]:
+            Document.__procedure_indexes__.pop(document_internal, None)
     def getCurrentSegmentIndex(self):
         """Returns the segment index where the cursor is. Returns -1 if the current segment cannot be located."""
         return HopperLowLevel.getCurrentSegmentIndex(self.__internal_document_addr__)
@@ -1028,6 +1538,21 @@ class Document:
         segment = self.getSegmentAtAddress(addr)
         if segment == None: return False
         return segment.readUInt64BE(addr)
+    def readUInt32Array(self,addr,count,bigEndian=False):
+        """Read an array of 'count' 32 bits integers from a mapped segment, with a single read. Returns False if no segments was found for this address."""
+        segment = self.getSegmentAtAddress(addr)
+        if segment == None: return False
+        return segment.readUInt32Array(addr,count,bigEndian)
+    def readUInt64Array(self,addr,count,bigEndian=False):
+        """Read an array of 'count' 64 bits integers from a mapped segment, with a single read. Returns False if no segments was found for this address."""
+        segment = self.getSegmentAtAddress(addr)
+        if segment == None: return False
+        return segment.readUInt64Array(addr,count,bigEndian)
+    def readStruct(self,fmt,addr,count=1):
+        """Read 'count' records described by the struct module format 'fmt' from a mapped segment. Returns False if no segments was found for this address."""
+        segment = self.getSegmentAtAddress(addr)
+        if segment == None: return False
+        return segment.readStruct(fmt,addr,count)
     def writeBytes(self,addr,byteStr):
         """Write bytes to a mapped segment. Bytes are given as a string. Returns False if no segments was found for this range."""
         segment = self.getSegmentAtAddress(addr)
@@ -1068,6 +1593,9 @@ class Document:
         segment = self.getSegmentAtAddress(addr)
         if segment == None: return False
         return segment.writeUInt64BE(addr,value)
+    def newPatchBatch(self):
+        """Returns a new PatchBatch object collecting writes to any mapped segment, to be applied at once."""
+        return PatchBatch(self)
     def getOperandFormat(self,addr,index):
         """Returns the format requested by the user for a given intruction operand."""
         return HopperLowLevel.getOperandFormat(self.__internal_document_addr__,addr,index)
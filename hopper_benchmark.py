@@ -0,0 +1,94 @@
+#
+#  hopper_benchmark.py
+#  IDA Objc
+#
+#  Memory and allocation benchmark of the hopper_api wrapper objects. Run from Hopper's script menu on an analyzed document
+#
+
+import time
+import tracemalloc
+import typing
+
+if typing.TYPE_CHECKING:
+    from hopper_api import BasicBlock, Document, Procedure, Section, Segment
+
+
+class LegacySegment(object):
+    """The dict-backed wrappers, as hopper_api defined them before __slots__ and interning"""
+
+    def __init__(self, addr):
+        self.__internal_segment_addr__ = addr
+
+
+class LegacySection(object):
+    def __init__(self, addr):
+        self.__internal_section_addr__ = addr
+
+
+class LegacyProcedure(object):
+    def __init__(self, segment_internal, procedure_index):
+        self.__segment_internal__ = segment_internal
+        self.__procedure_index__ = procedure_index
+
+
+class LegacyBasicBlock(object):
+    def __init__(self, procedure, basic_block_index):
+        self.__procedure__ = procedure
+        self.__basic_block_index__ = basic_block_index
+
+
+def document_layout(document):
+    """(internal segment, internal sections, block count of each procedure) of every segment, read once"""
+    layout = []
+    for segment in document.getSegmentsList():
+        section_internals = [segment.getSection(index).__internal_section_addr__ for index in range(segment.getSectionCount())]
+        block_counts = [segment.getProcedureAtIndex(index).getBasicBlockCount() for index in range(segment.getProcedureCount())]
+        layout.append((segment.__internal_segment_addr__, section_internals, block_counts))
+    return layout
+
+
+def walk(layout, segment_class, section_class, procedure_class, basic_block_class):
+    """Build the wrappers a walk over every basic block allocates: a Procedure per procedure, and a BasicBlock, its
+    Segment and its Section per block, as block.getProcedure().getSegment() and getSectionAtAddress() would.
+    All of them are kept alive, like the results of a whole-document query
+    """
+    kept = []
+    for segment_internal, section_internals, block_counts in layout:
+        for procedure_index, block_count in enumerate(block_counts):
+            procedure = procedure_class(segment_internal, procedure_index)
+            for block_index in range(block_count):
+                section = section_class(section_internals[block_index % len(section_internals)]) if section_internals else None
+                kept.append((basic_block_class(procedure, block_index), segment_class(segment_internal), section))
+    return kept
+
+
+def measure(layout, classes):
+    tracemalloc.start()
+    started = time.perf_counter()
+    kept = walk(layout, *classes)
+    elapsed = time.perf_counter() - started
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    distinct_segments = len(set(id(entry[1]) for entry in kept))
+    return {"blocks": len(kept), "seconds": elapsed, "retained_bytes": retained, "peak_bytes": peak, "segment_objects": distinct_segments}
+
+
+def run_benchmark(document):
+    """Compare the legacy wrappers with the current ones, and print the results"""
+    layout = document_layout(document)
+    results = {
+        "legacy": measure(layout, (LegacySegment, LegacySection, LegacyProcedure, LegacyBasicBlock)),
+        "current": measure(layout, (Segment, Section, Procedure, BasicBlock)),
+    }
+    for name, result in results.items():
+        print(
+            f"{name:>8}: {result['blocks']} blocks in {result['seconds']:.3f}s, "
+            f"{result['retained_bytes'] / 1024 / 1024:.1f} MiB retained, {result['peak_bytes'] / 1024 / 1024:.1f} MiB peak, "
+            f"{result['segment_objects']} Segment objects"
+        )
+    return results
+
+
+if __name__ == "__main__":
+    run_benchmark(Document.getCurrentDocument())
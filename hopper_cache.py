@@ -0,0 +1,360 @@
+#
+#  hopper_cache.py
+#  IDA Objc
+#
+#  Two-tier cache of decompiled pseudocode: an in-memory LRU backed by an optional sqlite store
+#
+
+import bisect
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Bytes of pseudocode kept by the in-memory tier
+DEFAULT_MEMORY_SIZE = 64 * 1024 * 1024
+# Seconds an analysis stamp is reused before the document's procedures and names are hashed again
+ANALYSIS_STAMP_INTERVAL = 5
+
+
+class DecompilationCache(object):
+    """Pseudocode keyed by (executable, procedure entry point, generation), the executable being the hash of
+    the analyzed file and the architecture of the document, as the slices of a FAT file share one hash.
+
+    The generation of an executable is bumped by invalidate_executable(), which orphans every entry computed
+    before. It is bumped when the analysis stamp of the document changes: a hash of its procedure count and
+    labels, so a redone analysis or a rename made in Hopper's UI invalidates the pseudocode, even one cached
+    by a previous session. Once installed, modifications of bytes, types and local names made through
+    hopper_api drop the cached procedures overlapping the modified range. A label may be printed by any
+    procedure referencing it, so renaming one bumps the generation.
+    """
+
+    def __init__(self, path=None, memory_size=DEFAULT_MEMORY_SIZE):
+        self.memory_size = memory_size
+        self._memory = OrderedDict()
+        self._memory_used = 0
+        self._lock = threading.RLock()
+
+        # executable -> generation
+        self._generations = {}
+        # executable -> sorted [(entry point, end)] of the cached procedures, and the largest end - entry point
+        self._ranges = {}
+        self._max_spans = {}
+        # internal segment -> executable, to route the modification notifications
+        self._segment_executables = {}
+        # executable path -> (size, mtime, hash)
+        self._executable_hashes = {}
+        # executable -> analysis stamp of its pseudocode, and internal document -> (time, executable, stamp)
+        self._stamps = {}
+        self._document_stamps = {}
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        # Called with (executable, start, end, code) when code is cached for the procedure starting at start,
+        # or with code None when the procedures within [start, end[ are dropped (end None: all of them)
+        self._listeners = []
+
+        self._change_name = None
+        self._change_comment = None
+        self._database = None
+        if path:
+            self._database = sqlite3.connect(path, check_same_thread=False)
+            self._database.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS pseudocode (
+                    executable TEXT NOT NULL,
+                    entry_point INTEGER NOT NULL,
+                    end_address INTEGER NOT NULL,
+                    generation INTEGER NOT NULL,
+                    code TEXT NOT NULL,
+                    PRIMARY KEY (executable, entry_point, generation)
+                );
+                CREATE INDEX IF NOT EXISTS pseudocode_range ON pseudocode (executable, entry_point, end_address);
+                CREATE TABLE IF NOT EXISTS generations (
+                    executable TEXT PRIMARY KEY,
+                    generation INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS analysis_stamps (
+                    executable TEXT PRIMARY KEY,
+                    stamp TEXT NOT NULL
+                );
+                """
+            )
+            for executable, generation in self._database.execute("SELECT executable, generation FROM generations"):
+                self._generations[executable] = generation
+            for executable, stamp in self._database.execute("SELECT executable, stamp FROM analysis_stamps"):
+                self._stamps[executable] = stamp
+
+    def close(self):
+        with self._lock:
+            if self._database:
+                self._database.close()
+                self._database = None
+
+    def install(self, segment_class):
+        """Listen to the modifications made through hopper_api. segment_class is hopper_api.Segment"""
+        self._change_name = segment_class.CHANGE_NAME
+        self._change_comment = segment_class.CHANGE_COMMENT
+        segment_class.addModificationObserver(self.on_modification)
+
+    def uninstall(self, segment_class):
+        segment_class.removeModificationObserver(self.on_modification)
+
+    def add_listener(self, callback):
+        """Follow the pseudocode entering and leaving the cache, see _listeners"""
+        with self._lock:
+            self._listeners = self._listeners + [callback]
+
+    def remove_listener(self, callback):
+        with self._lock:
+            self._listeners = [listener for listener in self._listeners if listener != callback]
+
+    def _notify(self, executable, start, end, code):
+        for listener in self._listeners:
+            listener(executable, start, end, code)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_used,
+                "memory_size": self.memory_size,
+            }
+
+    def executable_hash(self, document):
+        """sha256 of the analyzed executable, recomputed only when its size or mtime change"""
+        path = document.getExecutableFilePath()
+        try:
+            status = os.stat(path)
+        except (OSError, TypeError):
+            # The executable is gone: fall back on its path
+            return hashlib.sha256(str(path).encode("utf-8")).hexdigest()
+
+        known = self._executable_hashes.get(path)
+        if known and known[0] == status.st_size and known[1] == status.st_mtime:
+            return known[2]
+
+        digest = hashlib.sha256()
+        with open(path, "rb") as executable:
+            for block in iter(lambda: executable.read(1024 * 1024), b""):
+                digest.update(block)
+        self._executable_hashes[path] = (status.st_size, status.st_mtime, digest.hexdigest())
+        return digest.hexdigest()
+
+    def executable_key(self, document):
+        """The executable of the entries of a document, after orphaning them if its analysis stamp changed"""
+        return self.document_stamp(document)[0]
+
+    def document_stamp(self, document):
+        """(executable, analysis stamp) of a document. The stamp is recomputed after ANALYSIS_STAMP_INTERVAL seconds,
+        and the entries of the executable are orphaned when it changed
+        """
+        now = time.monotonic()
+        with self._lock:
+            known = self._document_stamps.get(document.__internal_document_addr__)
+            if known and now - known[0] < ANALYSIS_STAMP_INTERVAL:
+                return known[1:]
+
+        executable = f"{self.executable_hash(document)}:{self.architecture(document)}"
+        stamp = self.analysis_stamp(document)
+        with self._lock:
+            self._document_stamps[document.__internal_document_addr__] = (now, executable, stamp)
+            if self._stamps.get(executable) != stamp:
+                if executable in self._stamps:
+                    self.invalidate_executable(executable)
+                self._stamps[executable] = stamp
+                if self._database:
+                    with self._database:
+                        self._database.execute("INSERT OR REPLACE INTO analysis_stamps VALUES (?, ?)", (executable, stamp))
+        return executable, stamp
+
+    def forget_document(self, document):
+        """Drop the analysis stamp of a closed document"""
+        with self._lock:
+            self._document_stamps.pop(document.__internal_document_addr__, None)
+
+    @staticmethod
+    def architecture(document):
+        """The architecture of the instruction at the entry point, or the address size without one"""
+        entry_point = document.getEntryPoint()
+        segment = document.getSegmentAtAddress(entry_point)
+        if segment is not None:
+            return str(segment.getInstructionAtAddress(entry_point).getArchitecture())
+        return "64" if document.is64Bits() else "32"
+
+    @staticmethod
+    def analysis_stamp(document):
+        """Hash of the procedure count and labels of a document, which change with its analysis and renames"""
+        digest = hashlib.sha256()
+        for segment in document.getSegmentsList():
+            digest.update(f"{segment.getStartingAddress():x}:{segment.getProcedureCount()}\n".encode("utf-8"))
+            for address, name in zip(segment.getNamedAddresses(), segment.getLabelsList()):
+                digest.update(f"{address:x}={name}\n".encode("utf-8"))
+        return digest.hexdigest()
+
+    def decompile(self, document, procedure):
+        """Cached procedure.decompile(). Nothing is cached while the background analysis is running, and the
+        pseudocode is still returned when it could not be stored
+        """
+        if document.backgroundProcessActive():
+            with self._lock:
+                self.misses += 1
+            return procedure.decompile()
+
+        executable = self.executable_key(document)
+        entry_point = procedure.getEntryPoint()
+        # Registered on hits too: a cache warmed from disk must still be invalidated by the segments it covers
+        with self._lock:
+            self._segment_executables[procedure.getSegment().__internal_segment_addr__] = executable
+        code = self.get(executable, entry_point)
+        if code is not None:
+            return code
+
+        code = procedure.decompile()
+        if code is not None:
+            end = entry_point + 1
+            for block_index in range(procedure.getBasicBlockCount()):
+                end = max(end, procedure.getBasicBlock(block_index).getEndingAddress())
+            try:
+                self.put(executable, entry_point, end, code)
+            except sqlite3.Error:
+                pass
+        return code
+
+    def get(self, executable, entry_point):
+        with self._lock:
+            generation = self._generations.get(executable, 0)
+            key = (executable, entry_point, generation)
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return entry[1]
+
+            if self._database:
+                row = self._database.execute(
+                    "SELECT end_address, code FROM pseudocode WHERE executable = ? AND entry_point = ? AND generation = ?", key
+                ).fetchone()
+                if row:
+                    self.disk_hits += 1
+                    self._remember(key, row[0], row[1])
+                    return row[1]
+
+            self.misses += 1
+            return None
+
+    def put(self, executable, entry_point, end, code):
+        """Cache code. When it cannot be written to disk, the sqlite3.Error is raised and nothing is cached"""
+        with self._lock:
+            key = (executable, entry_point, self._generations.get(executable, 0))
+            if self._database:
+                with self._database:
+                    self._database.execute("INSERT OR REPLACE INTO pseudocode VALUES (?, ?, ?, ?, ?)", key[:2] + (end,) + key[2:] + (code,))
+            self._remember(key, end, code)
+            self._notify(executable, entry_point, end, code)
+
+    def cached_pseudocode(self, executable):
+        """Yield (entry point, code) of every procedure of an executable cached for its current generation"""
+        with self._lock:
+            generation = self._generations.get(executable, 0)
+            entries = {key[1]: entry[1] for key, entry in self._memory.items() if key[0] == executable and key[2] == generation}
+            if self._database:
+                for entry_point, code in self._database.execute(
+                    "SELECT entry_point, code FROM pseudocode WHERE executable = ? AND generation = ?", (executable, generation)
+                ):
+                    entries.setdefault(entry_point, code)
+        return iter(entries.items())
+
+    def _remember(self, key, end, code):
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_used -= len(previous[1])
+        else:
+            ranges = self._ranges.setdefault(key[0], [])
+            bisect.insort(ranges, (key[1], end))
+            self._max_spans[key[0]] = max(self._max_spans.get(key[0], 0), end - key[1])
+
+        self._memory[key] = (end, code)
+        self._memory_used += len(code)
+        while self._memory_used > self.memory_size and len(self._memory) > 1:
+            evicted_key, (evicted_end, evicted_code) = self._memory.popitem(last=False)
+            self._memory_used -= len(evicted_code)
+            self._forget_range(evicted_key[0], evicted_key[1], evicted_end)
+            self.evictions += 1
+
+    def _forget_range(self, executable, entry_point, end):
+        ranges = self._ranges.get(executable, [])
+        index = bisect.bisect_left(ranges, (entry_point, end))
+        if index < len(ranges) and ranges[index] == (entry_point, end):
+            del ranges[index]
+
+    def invalidate_range(self, executable, start, end):
+        """Drop the procedures of an executable overlapping [start, end["""
+        with self._lock:
+            ranges = self._ranges.get(executable, [])
+            lowest_entry_point = start - self._max_spans.get(executable, 0)
+            index = bisect.bisect_left(ranges, (end,)) - 1
+            overlapping = []
+            while index >= 0 and ranges[index][0] >= lowest_entry_point:
+                if ranges[index][1] > start:
+                    overlapping.append(index)
+                index -= 1
+
+            generation = self._generations.get(executable, 0)
+            for index in overlapping:
+                entry_point, entry_end = ranges.pop(index)
+                entry = self._memory.pop((executable, entry_point, generation), None)
+                if entry is not None:
+                    self._memory_used -= len(entry[1])
+                self.invalidations += 1
+
+            if self._database:
+                with self._database:
+                    cursor = self._database.execute(
+                        "DELETE FROM pseudocode WHERE executable = ? AND entry_point < ? AND end_address > ?", (executable, end, start)
+                    )
+                    self.invalidations += max(cursor.rowcount - len(overlapping), 0)
+            self._notify(executable, start, end, None)
+
+    def invalidate_executable(self, executable):
+        """Orphan every entry of an executable by bumping its generation"""
+        with self._lock:
+            generation = self._generations.get(executable, 0) + 1
+            self._generations[executable] = generation
+            self._ranges.pop(executable, None)
+            self._max_spans.pop(executable, None)
+            for key in [key for key in self._memory if key[0] == executable]:
+                self._memory_used -= len(self._memory.pop(key)[1])
+            self.invalidations += 1
+
+            if self._database:
+                with self._database:
+                    self._database.execute("INSERT OR REPLACE INTO generations VALUES (?, ?)", (executable, generation))
+                    self._database.execute("DELETE FROM pseudocode WHERE executable = ? AND generation < ?", (executable, generation))
+            self._notify(executable, 0, None, None)
+
+    def on_modification(self, segment_internal, addr, length, kind):
+        """hopper_api modification observer. Comments are not part of the pseudocode"""
+        if kind == self._change_comment:
+            return
+        with self._lock:
+            executable = self._segment_executables.get(segment_internal)
+            if executable is None:
+                return
+
+            if kind == self._change_name:
+                self.invalidate_executable(executable)
+                return
+
+            self.invalidate_range(executable, addr, addr + max(length, 1))
@@ -0,0 +1,318 @@
+#
+#  hopper_callgraph.py
+#  IDA Objc
+#
+#  Whole-document call graph in compressed sparse row form, for traversals that would otherwise cost
+#  bridge calls at every step
+#
+
+import bisect
+import threading
+from array import array
+from collections import deque
+
+# Traversal directions
+CALLEES = "callees"
+CALLERS = "callers"
+
+
+class CallGraph(object):
+    """Every call edge of a document, gathered once from Procedure.getAllCallees().
+
+    Nodes are procedure entry points, plus the called addresses that are not inside any procedure (ie, stubs
+    and imports), numbered by increasing address. Edges keep their call site and CallReference call type, and
+    are stored twice, as CSR arrays: node i calls callee_nodes[callee_offsets[i]:callee_offsets[i + 1]], and is
+    called from caller_nodes[caller_offsets[i]:caller_offsets[i + 1]]. The queries take and return addresses.
+
+    Once installed, modifications made through hopper_api mark the procedures they touch, and refresh() only
+    gathers the edges of those, and of the procedures that appeared since the last refresh.
+    """
+
+    def __init__(self, document):
+        self.document = document
+        self._lock = threading.RLock()
+        # Procedure entry point -> [(call site, called address, call type)], as returned by Hopper
+        self._edges = {}
+        # Called address -> node address, ie the entry point of the procedure containing it, or itself
+        self._targets = {}
+        # (address, length) of the modifications made since the last refresh
+        self._modified_ranges = []
+        self._change_name = None
+        self._change_local_name = None
+        self._change_comment = None
+
+        self.refresh(full=True)
+
+    def install(self, segment_class):
+        """Listen to the modifications made through hopper_api. segment_class is hopper_api.Segment"""
+        self._change_name = segment_class.CHANGE_NAME
+        self._change_local_name = segment_class.CHANGE_LOCAL_NAME
+        self._change_comment = segment_class.CHANGE_COMMENT
+        segment_class.addModificationObserver(self.on_modification)
+
+    def uninstall(self, segment_class):
+        segment_class.removeModificationObserver(self.on_modification)
+
+    def on_modification(self, segment_internal, addr, length, kind):
+        """hopper_api modification observer. Names and comments do not change the calls"""
+        if kind in (self._change_name, self._change_local_name, self._change_comment):
+            return
+        with self._lock:
+            self._modified_ranges.append((addr, max(length, 1)))
+
+    def refresh(self, full=False, addresses=()):
+        """Gather the edges again for the procedures that are new, that were modified, or that contain one of
+        addresses. full gathers every procedure again. Returns the number of procedures gathered
+        """
+        with self._lock:
+            procedures = {}
+            for segment in self.document.getSegmentsList():
+                for procedure_index in range(segment.getProcedureCount()):
+                    procedure = segment.getProcedureAtIndex(procedure_index)
+                    procedures[procedure.getEntryPoint()] = procedure
+
+            if full or procedures.keys() != self._edges.keys():
+                # Procedures appeared or vanished: the called addresses may now resolve to other nodes
+                self._targets = {}
+
+            stale = set(procedures) if full else set(procedures) - set(self._edges)
+            modified_addresses = list(addresses)
+            for addr, length in self._modified_ranges:
+                modified_addresses.append(addr)
+                modified_addresses.append(addr + length - 1)
+            for addr in modified_addresses:
+                procedure = self.document.getProcedureAtAddress(addr)
+                if procedure:
+                    stale.add(procedure.getEntryPoint())
+            self._modified_ranges = []
+
+            edges = {}
+            for entry_point, procedure in procedures.items():
+                if entry_point in stale:
+                    references = procedure.getAllCallees() or []
+                    edges[entry_point] = [(reference.fromAddress(), reference.toAddress(), reference.type()) for reference in references]
+                else:
+                    edges[entry_point] = self._edges[entry_point]
+            self._edges = edges
+
+            self._build()
+            return len(stale & set(procedures))
+
+    def _resolve_target(self, address):
+        node_address = self._targets.get(address)
+        if node_address is None:
+            node_address = address
+            if address not in self._edges:
+                procedure = self.document.getProcedureAtAddress(address)
+                if procedure:
+                    node_address = procedure.getEntryPoint()
+            self._targets[address] = node_address
+        return node_address
+
+    def _build(self):
+        resolved = []
+        node_addresses = set(self._edges)
+        for entry_point, references in self._edges.items():
+            for call_site, called_address, call_type in references:
+                target = self._resolve_target(called_address)
+                node_addresses.add(target)
+                resolved.append((entry_point, target, call_site, call_type))
+
+        self.addresses = array("Q", sorted(node_addresses))
+        node_of = {address: node for node, address in enumerate(self.addresses)}
+        edges = [(node_of[source], node_of[target], call_site, call_type) for source, target, call_site, call_type in resolved]
+
+        self.callee_offsets, self.callee_nodes, self.callee_sites, self.callee_types = self._compress(edges, 0, 1)
+        self.caller_offsets, self.caller_nodes, self.caller_sites, self.caller_types = self._compress(edges, 1, 0)
+
+    def _compress(self, edges, source_field, target_field):
+        node_count = len(self.addresses)
+        offsets = array("q", bytes(8 * (node_count + 1)))
+        for edge in edges:
+            offsets[edge[source_field] + 1] += 1
+        for node in range(node_count):
+            offsets[node + 1] += offsets[node]
+
+        edge_count = len(edges)
+        nodes = array("q", bytes(8 * edge_count))
+        sites = array("Q", bytes(8 * edge_count))
+        types = array("b", bytes(edge_count))
+        cursors = array("q", offsets[:-1])
+        for edge in edges:
+            slot = cursors[edge[source_field]]
+            cursors[edge[source_field]] += 1
+            nodes[slot] = edge[target_field]
+            sites[slot] = edge[2]
+            types[slot] = edge[3]
+        return offsets, nodes, sites, types
+
+    def node_count(self):
+        return len(self.addresses)
+
+    def edge_count(self):
+        return len(self.callee_nodes)
+
+    def is_procedure(self, address):
+        return address in self._edges
+
+    def _node(self, address):
+        node = bisect.bisect_left(self.addresses, address)
+        if node == len(self.addresses) or self.addresses[node] != address:
+            raise KeyError(f"{address:#x} is not a node of the call graph")
+        return node
+
+    def _adjacency(self, direction):
+        if direction == CALLEES:
+            return self.callee_offsets, self.callee_nodes, self.callee_types
+        if direction == CALLERS:
+            return self.caller_offsets, self.caller_nodes, self.caller_types
+        raise ValueError(f"unknown direction {direction}")
+
+    def _neighbours(self, node, adjacency, call_types):
+        offsets, nodes, types = adjacency
+        for slot in range(offsets[node], offsets[node + 1]):
+            if call_types is None or types[slot] in call_types:
+                yield nodes[slot]
+
+    def callees(self, address):
+        """(call site, called node address, call type) of the calls made by a procedure"""
+        node = self._node(address)
+        return [
+            (self.callee_sites[slot], self.addresses[self.callee_nodes[slot]], self.callee_types[slot])
+            for slot in range(self.callee_offsets[node], self.callee_offsets[node + 1])
+        ]
+
+    def callers(self, address):
+        """(call site, calling procedure entry point, call type) of the calls to a node"""
+        node = self._node(address)
+        return [
+            (self.caller_sites[slot], self.addresses[self.caller_nodes[slot]], self.caller_types[slot])
+            for slot in range(self.caller_offsets[node], self.caller_offsets[node + 1])
+        ]
+
+    def bfs(self, start, direction=CALLEES, max_depth=None, call_types=None):
+        """Yield (address, depth) of the nodes reachable from start, start included, nearest first.
+        call_types restricts the followed edges to some CallReference types
+        """
+        adjacency = self._adjacency(direction)
+        start_node = self._node(start)
+        visited = bytearray(len(self.addresses))
+        visited[start_node] = 1
+        queue = deque([(start_node, 0)])
+        while queue:
+            node, depth = queue.popleft()
+            yield self.addresses[node], depth
+            if max_depth is not None and depth >= max_depth:
+                continue
+            for neighbour in self._neighbours(node, adjacency, call_types):
+                if not visited[neighbour]:
+                    visited[neighbour] = 1
+                    queue.append((neighbour, depth + 1))
+
+    def dfs(self, start, direction=CALLEES, call_types=None):
+        """Yield the addresses of the nodes reachable from start, in depth-first preorder"""
+        adjacency = self._adjacency(direction)
+        visited = bytearray(len(self.addresses))
+        stack = [self._node(start)]
+        while stack:
+            node = stack.pop()
+            if visited[node]:
+                continue
+            visited[node] = 1
+            yield self.addresses[node]
+            neighbours = [neighbour for neighbour in self._neighbours(node, adjacency, call_types) if not visited[neighbour]]
+            stack.extend(reversed(neighbours))
+
+    def reachable(self, start, direction=CALLEES, call_types=None):
+        """Set of the addresses reachable from start, start included"""
+        return set(address for address, _ in self.bfs(start, direction, call_types=call_types))
+
+    def is_reachable(self, source, target, call_types=None):
+        """True if source eventually calls target"""
+        self._node(target)
+        for address, _ in self.bfs(source, CALLEES, call_types=call_types):
+            if address == target:
+                return True
+        return False
+
+    def shortest_caller_chain(self, target, sources=None, call_types=None):
+        """Shortest list of node addresses from one of sources to target, each calling the next. Without sources,
+        the chain starts at the nearest procedure that has no caller. Returns None if no such chain exists
+        """
+        adjacency = self._adjacency(CALLERS)
+        target_node = self._node(target)
+        source_nodes = None if sources is None else set(self._node(source) for source in sources)
+
+        # Breadth-first over the callers, so that the first source met is the nearest one
+        parents = {target_node: -1}
+        queue = deque([target_node])
+        while queue:
+            node = queue.popleft()
+            callers = list(self._neighbours(node, adjacency, call_types))
+            if (node in source_nodes) if source_nodes is not None else not callers:
+                chain = []
+                while node != -1:
+                    chain.append(self.addresses[node])
+                    node = parents[node]
+                return chain
+            for caller in callers:
+                if caller not in parents:
+                    parents[caller] = node
+                    queue.append(caller)
+        return None
+
+    def strongly_connected_components(self, min_size=2, call_types=None):
+        """Lists of the addresses of the mutually recursive procedures. min_size=1 also returns every other node,
+        and self-recursive procedures are returned from min_size=2 on anyway
+        """
+        adjacency = self._adjacency(CALLEES)
+        node_count = len(self.addresses)
+        indexes = array("q", [-1]) * node_count
+        lowlinks = array("q", bytes(8 * node_count))
+        on_stack = bytearray(node_count)
+        stack = []
+        components = []
+        next_index = 0
+
+        # Iterative Tarjan: the recursion would overflow on deep call chains
+        for root in range(node_count):
+            if indexes[root] != -1:
+                continue
+            work = [(root, iter(list(self._neighbours(root, adjacency, call_types))))]
+            indexes[root] = lowlinks[root] = next_index
+            next_index += 1
+            stack.append(root)
+            on_stack[root] = 1
+            while work:
+                node, neighbours = work[-1]
+                descended = False
+                for neighbour in neighbours:
+                    if indexes[neighbour] == -1:
+                        indexes[neighbour] = lowlinks[neighbour] = next_index
+                        next_index += 1
+                        stack.append(neighbour)
+                        on_stack[neighbour] = 1
+                        work.append((neighbour, iter(list(self._neighbours(neighbour, adjacency, call_types)))))
+                        descended = True
+                        break
+                    if on_stack[neighbour]:
+                        lowlinks[node] = min(lowlinks[node], indexes[neighbour])
+                if descended:
+                    continue
+
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlinks[parent] = min(lowlinks[parent], lowlinks[node])
+                if lowlinks[node] == indexes[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack[member] = 0
+                        component.append(member)
+                        if member == node:
+                            break
+                    self_recursive = len(component) == 1 and node in self._neighbours(node, adjacency, call_types)
+                    if len(component) >= min_size or self_recursive:
+                        components.append(sorted(self.addresses[member] for member in component))
+        return components
@@ -0,0 +1,211 @@
+#
+#  hopper_cfg.py
+#  IDA Objc
+#
+#  Control flow graphs of procedures as compact arrays, with dominator trees and loop nesting
+#
+
+from array import array
+
+
+class ControlFlowGraph(object):
+    """Basic blocks and edges of a procedure. Block i spans [starts[i], ends[i][, and its successors are the block
+    indexes successors[successor_offsets[i]:successor_offsets[i + 1]]. entry is the index of the entry block
+    """
+
+    def __init__(self, entry_point, starts, ends, successor_offsets, successors):
+        self.entry_point = entry_point
+        self.starts = starts
+        self.ends = ends
+        self.successor_offsets = successor_offsets
+        self.successors = successors
+
+        self.entry = 0
+        for block_index, start in enumerate(starts):
+            if start == entry_point:
+                self.entry = block_index
+                break
+
+        self._dominators = None
+        self._loops = None
+
+    @classmethod
+    def from_procedure(cls, procedure):
+        """Walk the blocks of a hopper_api Procedure once"""
+        starts = array("Q")
+        ends = array("Q")
+        successor_offsets = array("l", [0])
+        successors = array("l")
+        for block in procedure.basicBlockIterator():
+            starts.append(block.getStartingAddress())
+            ends.append(block.getEndingAddress())
+            for successor_index in range(block.getSuccessorCount()):
+                successors.append(block.getSuccessorIndexAtIndex(successor_index))
+            successor_offsets.append(len(successors))
+        return cls(procedure.getEntryPoint(), starts, ends, successor_offsets, successors)
+
+    @classmethod
+    def from_snapshot(cls, snapshot, procedure):
+        """Read a procedure row of a hopper_snapshot.Snapshot"""
+        blocks = snapshot.basic_blocks(procedure["id"])
+        edges = snapshot.successors(procedure["id"])
+        starts = array("Q", (block["start"] for block in blocks))
+        ends = array("Q", (block["end"] for block in blocks))
+        successor_offsets = array("l", [0]) * (len(blocks) + 1)
+        for edge in edges:
+            successor_offsets[edge["block_index"] + 1] += 1
+        for block_index in range(len(blocks)):
+            successor_offsets[block_index + 1] += successor_offsets[block_index]
+        # The snapshot rows are sorted by block, then by successor
+        successors = array("l", (edge["successor_index"] for edge in edges))
+        return cls(procedure["entry_point"], starts, ends, successor_offsets, successors)
+
+    def block_count(self):
+        return len(self.starts)
+
+    def block_successors(self, block_index):
+        return self.successors[self.successor_offsets[block_index]:self.successor_offsets[block_index + 1]]
+
+    def predecessors(self):
+        """List of the predecessor block indexes of each block"""
+        predecessors = [[] for _ in range(len(self.starts))]
+        for block_index in range(len(self.starts)):
+            for successor in self.block_successors(block_index):
+                predecessors[successor].append(block_index)
+        return predecessors
+
+    def reverse_postorder(self):
+        """Indexes of the blocks reachable from the entry block, in reverse postorder"""
+        visited = bytearray(len(self.starts))
+        postorder = []
+        if not self.starts:
+            return postorder
+
+        visited[self.entry] = 1
+        work = [(self.entry, iter(self.block_successors(self.entry)))]
+        while work:
+            block_index, successors = work[-1]
+            for successor in successors:
+                if not visited[successor]:
+                    visited[successor] = 1
+                    work.append((successor, iter(self.block_successors(successor))))
+                    break
+            else:
+                work.pop()
+                postorder.append(block_index)
+        postorder.reverse()
+        return postorder
+
+    def immediate_dominators(self):
+        """Immediate dominator of each block, -1 for the entry block and for the unreachable ones.
+        Cooper, Harvey and Kennedy's iterative algorithm
+        """
+        if self._dominators is not None:
+            return self._dominators
+
+        order = self.reverse_postorder()
+        rank = [-1] * len(self.starts)
+        for position, block_index in enumerate(order):
+            rank[block_index] = position
+        predecessors = self.predecessors()
+
+        dominators = [-1] * len(self.starts)
+        if order:
+            dominators[self.entry] = self.entry
+
+        def intersect(first, second):
+            while first != second:
+                while rank[first] > rank[second]:
+                    first = dominators[first]
+                while rank[second] > rank[first]:
+                    second = dominators[second]
+            return first
+
+        changed = True
+        while changed:
+            changed = False
+            for block_index in order[1:]:
+                new_dominator = -1
+                for predecessor in predecessors[block_index]:
+                    if dominators[predecessor] == -1:
+                        continue
+                    new_dominator = predecessor if new_dominator == -1 else intersect(predecessor, new_dominator)
+                if new_dominator != dominators[block_index]:
+                    dominators[block_index] = new_dominator
+                    changed = True
+
+        if order:
+            dominators[self.entry] = -1
+        self._dominators = dominators
+        return dominators
+
+    def dominates(self, dominator, block_index):
+        dominators = self.immediate_dominators()
+        while block_index != -1:
+            if block_index == dominator:
+                return True
+            block_index = dominators[block_index]
+        return False
+
+    def loops(self):
+        """Natural loops, as dicts {"header", "blocks", "back_edges", "parent", "depth"}: the header block index,
+        the sorted block indexes of the body (header included), the source blocks of the back edges, the index of
+        the innermost enclosing loop (None at the top level) and the nesting depth (1 at the top level).
+        Loops sharing a header are merged. Irreducible cycles, entered other than through a dominating header, are not loops
+        """
+        if self._loops is not None:
+            return self._loops
+
+        predecessors = self.predecessors()
+        dominators = self.immediate_dominators()
+        back_edges = {}
+        for block_index in self.reverse_postorder():
+            for successor in self.block_successors(block_index):
+                if self.dominates(successor, block_index):
+                    back_edges.setdefault(successor, []).append(block_index)
+
+        loops = []
+        for header, sources in back_edges.items():
+            body = {header}
+            stack = [source for source in sources if source != header]
+            while stack:
+                block_index = stack.pop()
+                # Unreachable blocks may jump into a loop, but are not part of it
+                if block_index in body or (dominators[block_index] == -1 and block_index != self.entry):
+                    continue
+                body.add(block_index)
+                stack.extend(predecessors[block_index])
+            loops.append({"header": header, "blocks": sorted(body), "back_edges": sorted(sources), "parent": None, "depth": 1})
+
+        # Outer loops first: the innermost enclosing loop of a loop is then the last one containing its header
+        loops.sort(key=lambda loop: -len(loop["blocks"]))
+        bodies = [set(loop["blocks"]) for loop in loops]
+        for loop_index, loop in enumerate(loops):
+            for outer_index in range(loop_index - 1, -1, -1):
+                if loop["header"] in bodies[outer_index]:
+                    loop["parent"] = outer_index
+                    loop["depth"] = loops[outer_index]["depth"] + 1
+                    break
+
+        self._loops = loops
+        return loops
+
+    def to_json(self, dominators=False, loops=False):
+        """Compact representation: parallel arrays of block bounds, and of edge sources and targets"""
+        edge_sources = []
+        for block_index in range(len(self.starts)):
+            edge_sources.extend([block_index] * (self.successor_offsets[block_index + 1] - self.successor_offsets[block_index]))
+
+        cfg = {
+            "address": self.entry_point,
+            "entry": self.entry,
+            "starts": list(self.starts),
+            "ends": list(self.ends),
+            "edge_sources": edge_sources,
+            "edge_targets": list(self.successors),
+        }
+        if dominators:
+            cfg["immediate_dominators"] = self.immediate_dominators()
+        if loops:
+            cfg["loops"] = self.loops()
+        return cfg
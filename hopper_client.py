@@ -0,0 +1,285 @@
+#
+#  hopper_client.py
+#  IDA Objc
+#
+#  Client for the HTTP API served by hopper_proxy and by the hopper_helper plugin
+#
+
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_HOST = "localhost"
+DEFAULT_PORT = 52349
+# Seconds to wait for a response. Decompiling a large procedure can take a while
+DEFAULT_TIMEOUT = 60
+# Attempts made when the connection to the server cannot be established
+DEFAULT_RETRIES = 3
+DEFAULT_CONCURRENCY = 16
+
+
+class HopperClientError(Exception):
+    """The server answered with an error"""
+
+    def __init__(self, path, error):
+        super().__init__(f"{path}: {error}")
+        self.path = path
+        self.error = error
+
+
+class HopperClient(object):
+    """Synchronous client. Connections are pooled and kept alive across requests, and are safe to share
+    between threads
+    """
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, pool_size=DEFAULT_CONCURRENCY):
+        self.base_url = f"http://{host}:{port}"
+        self.timeout = timeout
+
+        # Only connection failures are retried: a request that reached the server may have had side effects
+        retry = Retry(total=retries, connect=retries, read=0, status=0, backoff_factor=0.2, allowed_methods=None)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get(self, path):
+        response = self.session.get(self.base_url + path, timeout=self.timeout)
+        return self._unwrap(path, self._decode(path, response))
+
+    def post(self, path, **arguments):
+        response = self.session.post(self.base_url + path, data=json.dumps(arguments), timeout=self.timeout)
+        return self._unwrap(path, self._decode(path, response))
+
+    def stream(self, path, **arguments):
+        """Yield the items of a streamed (NDJSON) response as they arrive"""
+        arguments["stream"] = True
+        with self.session.post(self.base_url + path, data=json.dumps(arguments), timeout=self.timeout, stream=True) as response:
+            if not response.ok:
+                self._unwrap(path, self._decode(path, response))
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                yield self._unwrap(path, json.loads(line))
+
+    @staticmethod
+    def _decode(path, response):
+        """The JSON body of a response. A server without the route, like the hopper_helper plugin for the routes
+        only hopper_proxy serves, answers with an error status and no JSON body: that is a HopperClientError too
+        """
+        try:
+            body = response.json()
+        except ValueError:
+            body = None
+        if not isinstance(body, dict):
+            raise HopperClientError(path, f"HTTP {response.status_code} without a JSON response")
+        if not response.ok and not body.get("error"):
+            raise HopperClientError(path, f"HTTP {response.status_code}")
+        return body
+
+    @staticmethod
+    def _unwrap(path, response):
+        if response.get("error"):
+            raise HopperClientError(path, response["error"])
+        return response.get("data")
+
+    def documents(self):
+        return self.get("/documents")
+
+    def segments(self, document_name, **selection):
+        """selection: the start, end, offset, limit, cursor and fields listing arguments"""
+        return self.post("/segments", document_name=document_name, **selection)
+
+    def procedures(self, document_name, **selection):
+        return self.post("/procedures", document_name=document_name, **selection)
+
+    def strings(self, document_name, **selection):
+        return self.post("/strings", document_name=document_name, **selection)
+
+    def search(self, document_name, query, regex=False, case_sensitive=False, kinds=None, limit=None, scan_comments=False):
+        """{"kind", "address", "text"} of the strings, labels, comments and cached pseudocode matching query. Only the
+        comments at labels are searched, unless scan_comments, see hopper_proxy.SearchDocument
+        """
+        return self.post(
+            "/search",
+            document_name=document_name,
+            query=query,
+            regex=regex,
+            case_sensitive=case_sensitive,
+            kinds=kinds,
+            limit=limit,
+            scan_comments=scan_comments,
+        )
+
+    def scan(self, document_name, signatures, segments=None, start=None, end=None):
+        """{"id", "address"} of the matches of byte signatures with ?? wildcards, see hopper_signatures"""
+        return self.post("/scan", document_name=document_name, signatures=signatures, segments=segments, start=start, end=end)
+
+    def decompile(self, document_name, procedure_address):
+        return self.post("/decompile", document_name=document_name, procedure_address=procedure_address)
+
+    def pipeline(self, document_name, output_path=None, worker_count=None):
+        """Start the resumable decompilation of the whole document into output_path, or get its progress without output_path"""
+        return self.post("/pipeline", document_name=document_name, output_path=output_path, worker_count=worker_count)
+
+    def cancel_pipeline(self, document_name):
+        return self.post("/pipeline_cancel", document_name=document_name)
+
+    def disassemble(self, document_name, procedure_address, fields=None):
+        """The text listing, or with fields the list of instruction records"""
+        if fields is None:
+            return self.post("/disassemble", document_name=document_name, procedure_address=procedure_address)
+        return self.post("/disassemble", document_name=document_name, procedure_address=procedure_address, fields=fields)
+
+    def cfg(self, document_name, procedure_address=None, dominators=False, loops=False):
+        return self.post("/cfg", document_name=document_name, procedure_address=procedure_address, dominators=dominators, loops=loops)
+
+    def xrefs(self, document_name, procedure_address):
+        return self.post("/xrefs", document_name=document_name, procedure_address=procedure_address)
+
+    def references(self, document_name, direction="to", addresses=None, start=None, end=None):
+        """{"from", "to"} of the references to or from some addresses, or an address range"""
+        return self.post("/references", document_name=document_name, direction=direction, addresses=addresses, start=start, end=end)
+
+    def procedure_signature(self, document_name, procedure_address):
+        return self.post("/procedure_signature", document_name=document_name, procedure_address=procedure_address)
+
+    def events(self, after=None, timeout=30, types=None):
+        """Wait up to timeout seconds for the document events following the sequence after. Returns
+        {"sequence", "events", "documents"}, see hopper_proxy.DocumentEventsHandler. timeout must stay below the client timeout
+        """
+        return self.post("/events", after=after, timeout=timeout, types=types)
+
+    def status(self, document_name):
+        return self.post("/status", document_name=document_name)
+
+    def analysis(self, document_name):
+        return self.post("/analysis", document_name=document_name)
+
+    def filepath(self, document_name):
+        return self.post("/filepath", document_name=document_name)
+
+    def logs(self, document_name):
+        return self.post("/logs", document_name=document_name)
+
+    def all_code(self, document_name):
+        return self.post("/all_code", document_name=document_name)
+
+    def batch(self, document_name, batch_requests, concurrent=False):
+        """batch_requests: list of {"path": ..., "args": {...}}. Returns one {"data"} or {"error"} per item"""
+        return self.post("/batch", document_name=document_name, requests=batch_requests, concurrent=concurrent)
+
+    def terminate(self):
+        try:
+            self.post("/terminate")
+        except requests.exceptions.ConnectionError:
+            # Hopper exits without answering
+            pass
+
+
+class AsyncHopperClient(object):
+    """asyncio client. At most `concurrency` requests are in flight at once, over as many pooled
+    keep-alive connections, so thousands of calls can be fanned out with asyncio.gather
+    """
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, concurrency=DEFAULT_CONCURRENCY):
+        self.client = HopperClient(host, port, timeout, retries, pool_size=concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="hopper_client")
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.client.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    async def _call(self, method, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, lambda: method(*args, **kwargs))
+
+    async def get(self, path):
+        return await self._call(self.client.get, path)
+
+    async def post(self, path, **arguments):
+        return await self._call(self.client.post, path, **arguments)
+
+    async def documents(self):
+        return await self._call(self.client.documents)
+
+    async def segments(self, document_name, **selection):
+        return await self._call(self.client.segments, document_name, **selection)
+
+    async def procedures(self, document_name, **selection):
+        return await self._call(self.client.procedures, document_name, **selection)
+
+    async def strings(self, document_name, **selection):
+        return await self._call(self.client.strings, document_name, **selection)
+
+    async def search(self, document_name, query, regex=False, case_sensitive=False, kinds=None, limit=None, scan_comments=False):
+        return await self._call(self.client.search, document_name, query, regex, case_sensitive, kinds, limit, scan_comments)
+
+    async def scan(self, document_name, signatures, segments=None, start=None, end=None):
+        return await self._call(self.client.scan, document_name, signatures, segments, start, end)
+
+    async def decompile(self, document_name, procedure_address):
+        return await self._call(self.client.decompile, document_name, procedure_address)
+
+    async def pipeline(self, document_name, output_path=None, worker_count=None):
+        return await self._call(self.client.pipeline, document_name, output_path, worker_count)
+
+    async def cancel_pipeline(self, document_name):
+        return await self._call(self.client.cancel_pipeline, document_name)
+
+    async def disassemble(self, document_name, procedure_address, fields=None):
+        return await self._call(self.client.disassemble, document_name, procedure_address, fields)
+
+    async def cfg(self, document_name, procedure_address=None, dominators=False, loops=False):
+        return await self._call(self.client.cfg, document_name, procedure_address, dominators, loops)
+
+    async def xrefs(self, document_name, procedure_address):
+        return await self._call(self.client.xrefs, document_name, procedure_address)
+
+    async def references(self, document_name, direction="to", addresses=None, start=None, end=None):
+        return await self._call(self.client.references, document_name, direction, addresses, start, end)
+
+    async def procedure_signature(self, document_name, procedure_address):
+        return await self._call(self.client.procedure_signature, document_name, procedure_address)
+
+    async def events(self, after=None, timeout=30, types=None):
+        return await self._call(self.client.events, after, timeout, types)
+
+    async def status(self, document_name):
+        return await self._call(self.client.status, document_name)
+
+    async def analysis(self, document_name):
+        return await self._call(self.client.analysis, document_name)
+
+    async def filepath(self, document_name):
+        return await self._call(self.client.filepath, document_name)
+
+    async def logs(self, document_name):
+        return await self._call(self.client.logs, document_name)
+
+    async def all_code(self, document_name):
+        return await self._call(self.client.all_code, document_name)
+
+    async def batch(self, document_name, batch_requests, concurrent=False):
+        return await self._call(self.client.batch, document_name, batch_requests, concurrent)
+
+    async def terminate(self):
+        return await self._call(self.client.terminate)
@@ -0,0 +1,154 @@
+#
+#  hopper_events.py
+#  IDA Objc
+#
+#  Document lifecycle events (opened, renamed, closed, analysis finished) for clients to wait on instead of polling
+#
+
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger("hopper_events")
+
+# Event types
+DOCUMENT_OPENED = "opened"
+DOCUMENT_RENAMED = "renamed"
+DOCUMENT_CLOSED = "closed"
+ANALYSIS_FINISHED = "analysis_finished"
+EVENT_TYPES = (DOCUMENT_OPENED, DOCUMENT_RENAMED, DOCUMENT_CLOSED, ANALYSIS_FINISHED)
+
+# Seconds between two looks at the documents when nothing wakes the watcher up earlier
+WATCH_INTERVAL = 0.5
+# Events kept for the clients that fall behind
+EVENT_LOG_SIZE = 1024
+
+
+class DocumentEvents(object):
+    """Watches the open documents from inside Hopper and records their lifecycle events in a log numbered by
+    increasing sequence numbers. Clients wait for the events following the last one they saw.
+
+    A watcher thread compares the documents every WATCH_INTERVAL, which costs a few bridge calls and no HTTP
+    request. Each document under analysis also has a thread blocked in waitForBackgroundProcessToEnd(), which
+    wakes the watcher as soon as the analysis ends.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._events = deque(maxlen=EVENT_LOG_SIZE)
+        self._next_sequence = 1
+        # Internal document -> (name, executable path, analysis running)
+        self._documents = {}
+        self._waiting_analyses = set()
+        self._document_class = None
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._last_error = None
+
+    def start(self, document_class):
+        """Start watching. document_class is hopper_api.Document"""
+        self._document_class = document_class
+        self._stopped.clear()
+        # The documents open at startup are not reported as opened
+        self._poll(initial=True)
+        self._thread = threading.Thread(target=self._watch, name="hopper_events", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _watch(self):
+        while not self._stopped.is_set():
+            self._wake.wait(WATCH_INTERVAL)
+            self._wake.clear()
+            try:
+                self._poll()
+                self._last_error = None
+            except Exception as e:
+                # A document closed while it was being read: the next poll sees it gone. A failure repeated at
+                # every poll is only logged once
+                if str(e) != self._last_error:
+                    logger.warning("failed to look at the documents: %s", e)
+                    self._last_error = str(e)
+
+    def _poll(self, initial=False):
+        documents = {}
+        for document in self._document_class.getAllDocuments():
+            documents[document.__internal_document_addr__] = (
+                document.getDocumentName(),
+                document.getExecutableFilePath(),
+                document.backgroundProcessActive(),
+            )
+
+        events = []
+        for internal, (name, path, active) in documents.items():
+            previous = self._documents.get(internal)
+            if previous is None:
+                if not initial:
+                    events.append({"type": DOCUMENT_OPENED, "document": name, "path": path, "analyzing": active})
+            else:
+                previous_name, previous_path, previous_active = previous
+                if previous_name != name:
+                    events.append({"type": DOCUMENT_RENAMED, "document": name, "previous_name": previous_name, "path": path})
+                if previous_active and not active:
+                    events.append({"type": ANALYSIS_FINISHED, "document": name, "path": path})
+            if active:
+                self._wait_for_analysis(internal)
+        for internal, (name, path, _) in self._documents.items():
+            if internal not in documents:
+                events.append({"type": DOCUMENT_CLOSED, "document": name, "path": path})
+
+        with self._condition:
+            self._documents = documents
+            for event in events:
+                event["sequence"] = self._next_sequence
+                self._next_sequence += 1
+                self._events.append(event)
+            if events:
+                self._condition.notify_all()
+
+    def _wait_for_analysis(self, internal):
+        if internal in self._waiting_analyses:
+            return
+        self._waiting_analyses.add(internal)
+        document = self._document_class(internal)
+
+        def wait():
+            try:
+                document.waitForBackgroundProcessToEnd()
+            finally:
+                self._waiting_analyses.discard(internal)
+                self._wake.set()
+
+        threading.Thread(target=wait, name="hopper_events_analysis", daemon=True).start()
+
+    def state(self):
+        """(sequence of the last event, {"document", "path", "analyzing"} of the documents open at the last look)"""
+        with self._condition:
+            sequence = self._next_sequence - 1
+            documents = list(self._documents.values())
+        return sequence, [{"document": name, "path": path, "analyzing": active} for name, path, active in documents]
+
+    def _after(self, after, event_types):
+        return [event for event in self._events if event["sequence"] > after and (event_types is None or event["type"] in event_types)]
+
+    def wait(self, after=0, timeout=None, event_types=None):
+        """Events of sequence greater than after, waiting up to timeout seconds for one to happen. Returns an empty
+        list on timeout. Events older than the EVENT_LOG_SIZE last ones are lost
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while True:
+                events = self._after(after, event_types)
+                if events:
+                    return events
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return []
+                self._condition.wait(remaining)
@@ -0,0 +1,504 @@
+#
+#  hopper_orchestrator.py
+#  IDA Objc
+#
+#  Runs a persistent queue of binaries through a pool of Hopper instances: open, wait for the analysis, export a
+#  snapshot, close
+#
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import random
+import sqlite3
+import subprocess
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+
+import requests
+
+from hopper_client import HopperClient, HopperClientError
+
+logger = logging.getLogger("hopper_orchestrator")
+
+HOPPER_PATH = "/Applications/Hopper Disassembler v4.app/Contents/MacOS/Hopper Disassembler v4"
+# Instances serve on consecutive ports from this one
+BASE_PORT = 52400
+DEFAULT_INSTANCE_COUNT = 4
+# Attempts made for a job before it is marked as failed
+DEFAULT_MAX_ATTEMPTS = 3
+# Seconds given to an instance to answer after it is started, and to a binary to be analyzed
+STARTUP_TIMEOUT = 120
+ANALYSIS_TIMEOUT = 3600
+# Seconds each /events long poll waits for the documents to change
+EVENTS_WAIT = 20
+# Seconds to wait for the snapshot export of a large binary
+EXPORT_TIMEOUT = 3600
+
+# Job states
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# Job phases, timed separately
+PHASES = ("open", "analysis", "export", "close")
+
+QUEUE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    binary TEXT,
+    arch_flag TEXT,
+    output TEXT,
+    state TEXT,
+    attempts INTEGER DEFAULT 0,
+    instance INTEGER,
+    error TEXT,
+    phase_seconds TEXT,
+    enqueued_at REAL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id);
+"""
+
+
+class JobQueue(object):
+    """Jobs stored in a sqlite file, so that a stopped orchestrator resumes where it was. Safe to share between threads"""
+
+    def __init__(self, path, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._database = sqlite3.connect(path, check_same_thread=False)
+        self._database.row_factory = sqlite3.Row
+        with self._database:
+            self._database.executescript(QUEUE_SCHEMA)
+
+    def close(self):
+        self._database.close()
+
+    def enqueue(self, binary, arch_flag, output):
+        """Add a job. Returns its id"""
+        with self._lock, self._database:
+            cursor = self._database.execute(
+                "INSERT INTO jobs (binary, arch_flag, output, state, enqueued_at) VALUES (?, ?, ?, ?, ?)",
+                (str(binary), arch_flag, str(output), PENDING, time.time()),
+            )
+            return cursor.lastrowid
+
+    def claim(self, instance):
+        """Mark the oldest pending job as running on an instance, and return it as a dict. None if there is none"""
+        with self._lock, self._database:
+            row = self._database.execute("SELECT * FROM jobs WHERE state = ? ORDER BY id LIMIT 1", (PENDING,)).fetchone()
+            if row is None:
+                return None
+            self._database.execute(
+                "UPDATE jobs SET state = ?, instance = ?, attempts = attempts + 1, started_at = ? WHERE id = ?", (RUNNING, instance, time.time(), row["id"])
+            )
+            job = dict(row)
+            job["attempts"] += 1
+            return job
+
+    def complete(self, job_id, phase_seconds):
+        with self._lock, self._database:
+            self._database.execute(
+                "UPDATE jobs SET state = ?, error = NULL, phase_seconds = ?, finished_at = ? WHERE id = ?",
+                (DONE, json.dumps(phase_seconds), time.time(), job_id),
+            )
+
+    def fail(self, job_id, error):
+        """Put a job back in the queue, or mark it as failed once it has used max_attempts. Returns its new state"""
+        with self._lock, self._database:
+            attempts = self._database.execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]
+            state = FAILED if attempts >= self.max_attempts else PENDING
+            self._database.execute("UPDATE jobs SET state = ?, error = ?, finished_at = ? WHERE id = ?", (state, str(error), time.time(), job_id))
+            return state
+
+    def requeue_running(self):
+        """Put back the jobs left running by an orchestrator that stopped. Returns their count"""
+        with self._lock, self._database:
+            return self._database.execute("UPDATE jobs SET state = ? WHERE state = ?", (PENDING, RUNNING)).rowcount
+
+    def counts(self):
+        """Number of jobs in each state"""
+        with self._lock:
+            rows = self._database.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        counts = {state: 0 for state in (PENDING, RUNNING, DONE, FAILED)}
+        counts.update({state: count for state, count in rows})
+        return counts
+
+    def report(self, since=None):
+        """Throughput and latencies of the jobs done since a time (all of them if None): {"done", "failed",
+        "jobs_per_hour", "phases": {phase: {"count", "mean", "p50", "p95", "max"}}}, in seconds
+        """
+        since = since or 0
+        with self._lock:
+            rows = self._database.execute(
+                "SELECT state, phase_seconds, started_at, finished_at FROM jobs WHERE state IN (?, ?) AND finished_at >= ?", (DONE, FAILED, since)
+            ).fetchall()
+
+        done = [row for row in rows if row["state"] == DONE]
+        phases = {phase: [] for phase in PHASES}
+        for row in done:
+            for phase, seconds in json.loads(row["phase_seconds"]).items():
+                phases.setdefault(phase, []).append(seconds)
+
+        jobs_per_hour = None
+        if done:
+            first_start = min(row["started_at"] for row in done)
+            last_finish = max(row["finished_at"] for row in done)
+            if last_finish > first_start:
+                jobs_per_hour = len(done) * 3600 / (last_finish - first_start)
+
+        return {
+            "done": len(done),
+            "failed": len(rows) - len(done),
+            "jobs_per_hour": jobs_per_hour,
+            "phases": {phase: latency_summary(seconds) for phase, seconds in phases.items() if seconds},
+        }
+
+
+def latency_summary(seconds):
+    seconds = sorted(seconds)
+    return {
+        "count": len(seconds),
+        "mean": sum(seconds) / len(seconds),
+        "p50": seconds[len(seconds) // 2],
+        "p95": seconds[min(int(len(seconds) * 0.95), len(seconds) - 1)],
+        "max": seconds[-1],
+    }
+
+
+class HopperSpawner(object):
+    """Runs Hopper instances serving hopper_proxy on their own port. Hopper only opens executables from its command
+    line, so each job gets a fresh Hopper process, which also keeps a crash from affecting the next job. The proxy
+    script is run at startup with Hopper's -Y option, and reads its port from HOPPER_PROXY_PORT
+    """
+
+    def __init__(self, hopper_path=HOPPER_PATH, proxy_script=None):
+        self.hopper_path = hopper_path
+        self.proxy_script = proxy_script or Path(__file__).with_name("hopper_proxy.py")
+
+    def start(self, port):
+        """Instance state handed back to the other methods"""
+        return {"port": port, "process": None}
+
+    def open_binary(self, instance, binary, arch_flag):
+        self.stop(instance)
+        arguments = [self.hopper_path, "-e", str(binary), "-l", "Mach-O", arch_flag, "-Y", str(self.proxy_script)]
+        if b"the fat file" in subprocess.check_output(["/usr/bin/lipo", "-info", str(binary)]):
+            arguments += ["-l", "FAT"]
+        environment = dict(os.environ, HOPPER_PROXY_PORT=str(instance["port"]))
+        instance["process"] = subprocess.Popen(arguments, env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def alive(self, instance):
+        return instance["process"] is None or instance["process"].poll() is None
+
+    def stop(self, instance):
+        process = instance["process"]
+        instance["process"] = None
+        if process is not None and process.poll() is None:
+            process.terminate()
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+class StubBackend(object):
+    """In-process HTTP server answering the /events, /export and /close requests the orchestrator makes, like
+    hopper_proxy would. A binary opens as an "Untitled" document under analysis, and gets its name once
+    analysis_time has elapsed. crash_rate is the probability that opening a binary kills the backend.
+
+    Like hopper_events, each open, rename, end of analysis and close is an event numbered by an increasing
+    sequence, and /events with after waits until an event follows it or its timeout elapses
+    """
+
+    def __init__(self, port, analysis_time=0.05, crash_rate=0.0):
+        self.analysis_time = analysis_time
+        self.crash_rate = crash_rate
+        self.crashed = False
+        self._condition = threading.Condition()
+        # Document name -> [path, analysis end]
+        self._documents = {}
+        self._opened = 0
+        self._events = []
+
+        backend = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                posted_data = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                try:
+                    body = {"data": backend.handle(self.path, posted_data)}
+                    self.send_response(200)
+                except Exception as e:
+                    body = {"data": None, "error": str(e)}
+                    self.send_response(500)
+                body = json.dumps(body).encode("utf-8")
+                self.send_header("Content-type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *arguments):
+                pass
+
+        self._server = HTTPServer(("localhost", port), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, name=f"stub_backend_{port}", daemon=True)
+        self._thread.start()
+
+    def open(self, binary):
+        with self._condition:
+            self._opened += 1
+            name = f"Untitled {self._opened}"
+            self._documents[name] = [str(binary), time.monotonic() + self.analysis_time]
+            self._event({"type": "opened", "document": name, "path": str(binary), "analyzing": True})
+        if random.random() < self.crash_rate:
+            self.stop()
+
+    def stop(self):
+        if not self.crashed:
+            self.crashed = True
+            self._server.shutdown()
+            self._server.server_close()
+
+    def _event(self, event):
+        """Record an event. Called with the condition held"""
+        event["sequence"] = len(self._events) + 1
+        self._events.append(event)
+        self._condition.notify_all()
+
+    def _update(self):
+        """End the analyses whose time has come, and return the time of the next one to end. Called with the condition held"""
+        now = time.monotonic()
+        next_end = None
+        for name, (path, analysis_end) in list(self._documents.items()):
+            if analysis_end is None:
+                continue
+            if now < analysis_end:
+                next_end = analysis_end if next_end is None else min(next_end, analysis_end)
+                continue
+            # The analysis is over: Hopper renames the document after the executable
+            del self._documents[name]
+            renamed = Path(path).name + ".hop"
+            self._documents[renamed] = [path, None]
+            self._event({"type": "renamed", "document": renamed, "previous_name": name, "path": path})
+            self._event({"type": "analysis_finished", "document": renamed, "path": path})
+        return next_end
+
+    def events(self, after=None, timeout=0):
+        """{"sequence", "events", "documents"}, like hopper_proxy's /events"""
+        deadline = time.monotonic() + max(timeout or 0, 0)
+        with self._condition:
+            while True:
+                next_end = self._update()
+                events = [] if after is None else self._events[after:]
+                remaining = deadline - time.monotonic()
+                if after is None or events or remaining <= 0:
+                    break
+                self._condition.wait(remaining if next_end is None else min(remaining, max(next_end - time.monotonic(), 0)))
+            documents = [{"document": name, "path": path, "analyzing": analysis_end is not None} for name, (path, analysis_end) in self._documents.items()]
+            return {"sequence": len(self._events) if after is None or events else after, "events": events, "documents": documents}
+
+    def handle(self, path, arguments):
+        if path == "/events":
+            return self.events(arguments.get("after"), arguments.get("timeout", 0))
+        if path == "/export":
+            Path(arguments["output_path"]).write_text(json.dumps({"document": arguments["document_name"]}))
+            return arguments["output_path"]
+        if path == "/close":
+            with self._condition:
+                document = self._documents.pop(arguments["document_name"], None)
+                if document is None:
+                    raise Exception("failed to find specified document")
+                self._event({"type": "closed", "document": arguments["document_name"], "path": document[0]})
+            return True
+        raise Exception(f"unknown path {path}")
+
+
+class StubSpawner(object):
+    """Spawner of StubBackend instances, to run the whole scheduler without Hopper"""
+
+    def __init__(self, analysis_time=0.05, crash_rate=0.0):
+        self.analysis_time = analysis_time
+        self.crash_rate = crash_rate
+
+    def start(self, port):
+        return {"port": port, "backend": StubBackend(port, self.analysis_time, self.crash_rate)}
+
+    def open_binary(self, instance, binary, arch_flag):
+        instance["backend"].open(binary)
+
+    def alive(self, instance):
+        return not instance["backend"].crashed
+
+    def stop(self, instance):
+        instance["backend"].stop()
+
+
+class Orchestrator(object):
+    """Runs the jobs of a JobQueue on instance_count instances made by spawner, on the ports from base_port on.
+    A spawner implements start(port) -> instance, open_binary(instance, binary, arch_flag), alive(instance) and
+    stop(instance); see HopperSpawner and StubSpawner. A job failing on a dead instance restarts it, and is retried
+    until the queue's max_attempts
+    """
+
+    def __init__(self, queue, spawner, instance_count=DEFAULT_INSTANCE_COUNT, base_port=BASE_PORT, analysis_timeout=ANALYSIS_TIMEOUT):
+        self.queue = queue
+        self.spawner = spawner
+        self.instance_count = instance_count
+        self.base_port = base_port
+        self.analysis_timeout = analysis_timeout
+        self._stopping = threading.Event()
+
+    def stop(self):
+        """Let the running jobs finish, and start no other"""
+        self._stopping.set()
+
+    def run(self, until_empty=True, poll_interval=1):
+        """Process the queue. Returns once it is empty if until_empty, otherwise once stop() is called"""
+        requeued = self.queue.requeue_running()
+        if requeued:
+            logger.info(f"requeued {requeued} interrupted jobs")
+
+        started_at = time.time()
+        workers = [
+            threading.Thread(target=self._work, args=(index, until_empty, poll_interval), name=f"hopper_orchestrator_{index}")
+            for index in range(self.instance_count)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return self.queue.report(since=started_at)
+
+    def _work(self, index, until_empty, poll_interval):
+        port = self.base_port + index
+        instance = self.spawner.start(port)
+        client = HopperClient(port=port, timeout=EVENTS_WAIT + 10, retries=0)
+        export_client = HopperClient(port=port, timeout=EXPORT_TIMEOUT, retries=0)
+        try:
+            while not self._stopping.is_set():
+                job = self.queue.claim(index)
+                if job is None:
+                    if until_empty:
+                        return
+                    self._stopping.wait(poll_interval)
+                    continue
+
+                try:
+                    phase_seconds = self._run_job(instance, client, export_client, job)
+                except Exception as e:
+                    state = self.queue.fail(job["id"], e)
+                    logger.warning(f"instance {index}: job {job['id']} ({job['binary']}) failed, attempt {job['attempts']}, now {state}: {e}")
+                    if not self.spawner.alive(instance) or isinstance(e, (requests.exceptions.ConnectionError, TimeoutError)):
+                        logger.info(f"instance {index}: restarting")
+                        self.spawner.stop(instance)
+                        instance = self.spawner.start(port)
+                    continue
+
+                self.queue.complete(job["id"], phase_seconds)
+                logger.info(f"instance {index}: job {job['id']} ({job['binary']}) done in {sum(phase_seconds.values()):.1f}s")
+        finally:
+            client.close()
+            export_client.close()
+            self.spawner.stop(instance)
+
+    def _run_job(self, instance, client, export_client, job):
+        phase_seconds = {}
+
+        started = time.monotonic()
+        self.spawner.open_binary(instance, job["binary"], job["arch_flag"])
+        phase_seconds["open"] = time.monotonic() - started
+
+        started = time.monotonic()
+        document_name = self._wait_for_analysis(instance, client, job["binary"])
+        phase_seconds["analysis"] = time.monotonic() - started
+
+        started = time.monotonic()
+        output = Path(job["output"])
+        output.parent.mkdir(parents=True, exist_ok=True)
+        # An attempt that died while exporting may have left a partial file
+        if output.exists():
+            output.unlink()
+        export_client.post("/export", document_name=document_name, output_path=job["output"])
+        phase_seconds["export"] = time.monotonic() - started
+
+        started = time.monotonic()
+        client.post("/close", document_name=document_name)
+        phase_seconds["close"] = time.monotonic() - started
+        return phase_seconds
+
+    def _wait_for_analysis(self, instance, client, binary):
+        """Name of the document of binary once analyzed, waiting on the instance's /events"""
+        deadline = time.monotonic() + self.analysis_timeout
+        startup_deadline = time.monotonic() + STARTUP_TIMEOUT
+        after = None
+        delay = 0.25
+        while True:
+            if not self.spawner.alive(instance):
+                raise Exception("the instance died")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"the analysis of {binary} did not finish in {self.analysis_timeout}s")
+
+            try:
+                state = client.events(after=after, timeout=min(EVENTS_WAIT, remaining))
+            except requests.exceptions.ConnectionError:
+                # The instance is still starting
+                if time.monotonic() > startup_deadline:
+                    raise
+                time.sleep(delay)
+                delay = min(delay * 2, 5)
+                continue
+            except HopperClientError:
+                # Every /events slot of the instance is taken
+                time.sleep(delay)
+                delay = min(delay * 2, 5)
+                continue
+
+            for document in state["documents"]:
+                if document["path"] == str(binary) and not document["analyzing"] and "Untitle" not in document["document"]:
+                    return document["document"]
+            after = state["sequence"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run binaries through a pool of Hopper instances, exporting a snapshot of each")
+    parser.add_argument("queue", help="sqlite job queue, created if missing")
+    parser.add_argument("binaries", nargs="*", help="binaries to add to the queue")
+    parser.add_argument("--arch", default="--aarch64", help="Hopper architecture flag of the added binaries")
+    parser.add_argument("--output", default="snapshots", help="directory receiving the snapshots of the added binaries")
+    parser.add_argument("--instances", type=int, default=DEFAULT_INSTANCE_COUNT)
+    parser.add_argument("--base-port", type=int, default=BASE_PORT)
+    parser.add_argument("--max-attempts", type=int, default=DEFAULT_MAX_ATTEMPTS)
+    parser.add_argument("--watch", action="store_true", help="keep waiting for new jobs once the queue is empty")
+    parser.add_argument("--stub", action="store_true", help="run against stub backends instead of Hopper")
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s:   %(message)s")
+    queue = JobQueue(arguments.queue, arguments.max_attempts)
+    for binary in arguments.binaries:
+        binary = Path(binary).resolve()
+        # Binaries of the same name in different directories get their own snapshot
+        path_hash = hashlib.sha1(str(binary).encode("utf-8")).hexdigest()[:8]
+        queue.enqueue(binary, arguments.arch, Path(arguments.output).resolve() / f"{binary.name}-{path_hash}.snapshot")
+
+    spawner = StubSpawner() if arguments.stub else HopperSpawner()
+    orchestrator = Orchestrator(queue, spawner, arguments.instances, arguments.base_port)
+    try:
+        report = orchestrator.run(until_empty=not arguments.watch)
+    except KeyboardInterrupt:
+        orchestrator.stop()
+        raise
+    print(json.dumps({"queue": queue.counts(), "report": report}, indent=2))
+    queue.close()
+
+
+if __name__ == "__main__":
+    main()
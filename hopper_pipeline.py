@@ -0,0 +1,234 @@
+#
+#  hopper_pipeline.py
+#  IDA Objc
+#
+#  Resumable whole-document decompilation: a bounded pool of workers, results streamed to disk as they finish
+#
+
+import json
+import os
+import threading
+import time
+import typing
+from contextlib import nullcontext
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+if typing.TYPE_CHECKING:
+    from hopper_api import Document
+
+DEFAULT_WORKER_COUNT = 4
+# Failures listed by DecompilationPipeline.status(), the first ones
+STATUS_FAILURE_COUNT = 100
+
+# Pipeline states
+PENDING = "pending"
+RUNNING = "running"
+FINISHED = "finished"
+CANCELLED = "cancelled"
+FAILED = "failed"
+
+
+def read_results(output_path):
+    """(header, {entry point: pseudocode}) of a pipeline output file. A line cut short by a crash is ignored"""
+    header = None
+    results = {}
+    with open(output_path, "r", encoding="utf-8") as output:
+        for line in output:
+            if not line.endswith("\n"):
+                break
+            record = json.loads(line)
+            if header is None:
+                header = record
+            else:
+                results[record["address"]] = record["pseudocode"]
+    return header, results
+
+
+class DecompilationPipeline(object):
+    """Decompiles every procedure of a document into output_path, an NDJSON file: a header line describing the
+    document, then one {"address", "pseudocode"} line per procedure, written as soon as it is decompiled.
+
+    The output file is also the checkpoint. Running a pipeline again on the same file skips the procedures it
+    already holds, so a crashed or cancelled run resumes where it stopped. Procedures are scheduled largest first,
+    so that the long ones do not end up running alone at the end, and at most worker_count run at once. Procedures
+    that fail to decompile are not written, and are tried again by the next run.
+
+    lock returns a context manager held around each access to the document, so that the document can not be
+    modified or closed under a worker. Once cancelled, the workers that get the lock skip their procedure.
+    """
+
+    def __init__(self, document, output_path, worker_count=DEFAULT_WORKER_COUNT, decompilation_cache=None, progress=None, lock=None):
+        self.document = document
+        self.output_path = output_path
+        self.worker_count = worker_count
+        self.decompilation_cache = decompilation_cache
+        # Called with the pipeline after each procedure
+        self.progress = progress
+        self.lock = lock or nullcontext
+
+        self.state = PENDING
+        self.error = None
+        self.total = 0
+        self.skipped = 0
+        self.done = 0
+        # {"address", "error"} of the procedures that failed to decompile. error is None when no pseudocode was produced
+        self.failed = []
+        self.started_at = None
+        self.finished_at = None
+        self._cancelled = threading.Event()
+        self._thread = None
+
+    def header(self):
+        return {"document": self.document.getDocumentName(), "executable_path": self.document.getExecutableFilePath()}
+
+    def procedures(self):
+        """(size in bytes, entry point, procedure) of every procedure, largest first"""
+        procedures = []
+        for segment in self.document.getSegmentsList():
+            for procedure_index in range(segment.getProcedureCount()):
+                procedure = segment.getProcedureAtIndex(procedure_index)
+                size = sum(block.getEndingAddress() - block.getStartingAddress() for block in procedure.basicBlockIterator())
+                procedures.append((size, procedure.getEntryPoint(), procedure))
+        procedures.sort(key=lambda entry: (-entry[0], entry[1]))
+        return procedures
+
+    def _resume(self):
+        """Entry points already in the output file, which is truncated after its last complete line"""
+        if not os.path.exists(self.output_path) or os.path.getsize(self.output_path) == 0:
+            return set()
+
+        header, results = read_results(self.output_path)
+        if header is not None and header.get("executable_path") != self.document.getExecutableFilePath():
+            raise Exception(f"{self.output_path} holds the pseudocode of {header.get('executable_path')}")
+
+        # Drop the line a crash may have cut short, so that the next one starts on its own line
+        with open(self.output_path, "rb+") as output:
+            data = output.read()
+            output.truncate(data.rfind(b"\n") + 1)
+        return set(results)
+
+    def _decompile(self, procedure):
+        """The pseudocode of the procedure, or None when the pipeline was cancelled before it got the lock"""
+        with self.lock():
+            if self._cancelled.is_set():
+                return None
+            if self.decompilation_cache:
+                code = self.decompilation_cache.decompile(self.document, procedure)
+            else:
+                code = procedure.decompile()
+        if code is None:
+            raise Exception("no pseudocode was produced")
+        return code
+
+    def run(self):
+        """Decompile every remaining procedure, blocking until done or cancelled. Returns the final state"""
+        self.state = RUNNING
+        self.started_at = time.time()
+        try:
+            with self.lock():
+                # Cancelled before it started: the document may be closed already
+                if self._cancelled.is_set():
+                    self.state = CANCELLED
+                    self.finished_at = time.time()
+                    return self.state
+                completed = self._resume()
+                procedures = self.procedures()
+                header = self.header()
+            self.total = len(procedures)
+            pending = [(entry_point, procedure) for _, entry_point, procedure in procedures if entry_point not in completed]
+            self.skipped = self.total - len(pending)
+
+            new_file = not os.path.exists(self.output_path) or os.path.getsize(self.output_path) == 0
+            with open(self.output_path, "a", encoding="utf-8") as output:
+                if new_file:
+                    output.write(json.dumps(header) + "\n")
+                    output.flush()
+                self._run_workers(pending, output)
+            self.state = CANCELLED if self._cancelled.is_set() else FINISHED
+        except Exception as e:
+            self.error = str(e)
+            self.state = FAILED
+        self.finished_at = time.time()
+        return self.state
+
+    def _run_workers(self, pending, output):
+        pending = iter(pending)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.worker_count, thread_name_prefix="hopper_pipeline") as executor:
+            while True:
+                # Only worker_count procedures are submitted at once, so that a cancel takes effect right away
+                while len(running) < self.worker_count and not self._cancelled.is_set():
+                    entry = next(pending, None)
+                    if entry is None:
+                        break
+                    entry_point, procedure = entry
+                    running[executor.submit(self._decompile, procedure)] = entry_point
+                if not running:
+                    return
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    entry_point = running.pop(future)
+                    try:
+                        code = future.result()
+                    except Exception as e:
+                        self.failed.append({"address": entry_point, "error": str(e)})
+                        code = None
+                    # None is also a procedure skipped after a cancel, left for the next run
+                    if code is not None:
+                        # The only writer is this thread: each line is whole, and flushed as soon as it is written
+                        output.write(json.dumps({"address": entry_point, "pseudocode": code}) + "\n")
+                        output.flush()
+                        self.done += 1
+                    if self.progress:
+                        self.progress(self)
+
+    def start(self):
+        """Run in a background thread"""
+        # Running from now on, so that a second start is refused before the thread is scheduled
+        self.state = RUNNING
+        self._thread = threading.Thread(target=self.run, name="hopper_pipeline", daemon=True)
+        self._thread.start()
+
+    def join(self, timeout=None):
+        if self._thread:
+            self._thread.join(timeout)
+
+    def cancel(self):
+        """Stop scheduling procedures, and ask Hopper to stop its background processing. The procedures being
+        decompiled finish, and are written
+        """
+        self._cancelled.set()
+        self.document.requestBackgroundProcessStop()
+
+    def status(self):
+        """{"state", "total", "skipped", "done", "failed", "failures", "remaining", "seconds", "procedures_per_second",
+        "error"}. failures lists the {"address", "error"} of the first STATUS_FAILURE_COUNT failed procedures
+        """
+        seconds = ((self.finished_at or time.time()) - self.started_at) if self.started_at else 0
+        return {
+            "state": self.state,
+            "total": self.total,
+            "skipped": self.skipped,
+            "done": self.done,
+            "failed": len(self.failed),
+            "failures": self.failed[:STATUS_FAILURE_COUNT],
+            "remaining": max(self.total - self.skipped - self.done - len(self.failed), 0),
+            "seconds": seconds,
+            "procedures_per_second": self.done / seconds if seconds > 0 else None,
+            "error": self.error,
+        }
+
+
+if __name__ == "__main__":
+    document = Document.getCurrentDocument()
+    path = Document.askFile("Pseudocode output file (an existing one is resumed)", None, True)
+    if path:
+
+        def report(pipeline):
+            status = pipeline.status()
+            processed = status["done"] + status["failed"]
+            if processed % 100 == 0 or status["remaining"] == 0:
+                document.log(f"decompiled {status['skipped'] + processed}/{status['total']} procedures, {status['failed']} failed")
+
+        DecompilationPipeline(document, path, progress=report).run()
@@ -6,27 +6,287 @@
 #  Copyright (c) 2021 Ethan Arbuckle and Tanner Bennett. All rights reserved.
 #
 
+import base64
+import inspect
 import json
+import os
+import re
 import subprocess
+import threading
+import time
 import typing
 from abc import abstractmethod
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from http.server import BaseHTTPRequestHandler, HTTPServer
 
+from hopper_cache import DecompilationCache
+from hopper_cfg import ControlFlowGraph
+from hopper_events import EVENT_TYPES, DocumentEvents
+from hopper_pipeline import RUNNING, DecompilationPipeline
+from hopper_search import KINDS, SearchIndexCache
+from hopper_signatures import SignatureScanner
+from hopper_snapshot import export_snapshot
+from hopper_strings import StringTableCache
+from hopper_xrefs import FROM, TO, XrefIndexCache
+
 if typing.TYPE_CHECKING:
-    from hopper_api import Document
+    from hopper_api import Document, Segment
+
+DEFAULT_PORT = 52349
+DEFAULT_WORKER_COUNT = 8
+# Seconds an idle keep-alive connection may hold a worker. Short, as the worker serves no other connection meanwhile:
+# clients reconnect transparently after it closed
+KEEP_ALIVE_TIMEOUT = 2
+# A streamed response is flushed once this many bytes are buffered, or after STREAM_FLUSH_INTERVAL seconds
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_FLUSH_INTERVAL = 0.2
+# Threads running the items of a concurrent /batch request
+BATCH_WORKER_COUNT = 4
+# Procedures decompiled at once by a /pipeline
+DEFAULT_PIPELINE_WORKER_COUNT = 4
+# Longest wait of an /events request, kept below the clients' read timeout
+EVENTS_MAX_TIMEOUT = 30
+
+# Pseudocode served by /decompile and /all_code. start_server() replaces it to add an on-disk tier
+decompilation_cache = DecompilationCache()
+# Strings served by /strings, extracted once per document
+string_tables = StringTableCache()
+# Indexes served by /search, built once per document and updated as it changes
+search_indexes = SearchIndexCache()
+# Cross references served by /references, gathered once per document
+xref_indexes = XrefIndexCache()
+# Lifecycle events of the documents, served by /events
+document_events = DocumentEvents()
+# /events requests waiting at once. start_server() keeps it below its worker count, so that waiters can not hold every worker
+events_waiters = threading.BoundedSemaphore(max(DEFAULT_WORKER_COUNT // 2, 1))
+# Internal document -> analysis stamp of the decoded instructions hopper_api caches for /disassemble
+decoded_instruction_stamps = {}
+# Document name -> its last DecompilationPipeline, started by /pipeline
+pipelines = {}
+pipelines_lock = threading.Lock()
+
+
+class ReadWriteLock(object):
+    """Many concurrent readers, or a single writer"""
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+
+    def acquire_read(self):
+        with self._condition:
+            while self._writer:
+                self._condition.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._condition:
+            self._readers -= 1
+            if self._readers == 0:
+                self._condition.notify_all()
+
+    def acquire_write(self):
+        with self._condition:
+            while self._writer or self._readers > 0:
+                self._condition.wait()
+            self._writer = True
+
+    def release_write(self):
+        with self._condition:
+            self._writer = False
+            self._condition.notify_all()
+
+
+# Document name -> [ReadWriteLock, number of requests holding or waiting for it]
+_document_locks = {}
+_document_locks_guard = threading.Lock()
+
+
+@contextmanager
+def document_lock(document_name, write):
+    """Hold the ReadWriteLock serializing mutations of a document: exclusive to write, else shared. Requests without
+    a document share the None lock. A lock only exists while requests use it, so the names of closed or missing
+    documents do not pile up
+    """
+    with _document_locks_guard:
+        entry = _document_locks.get(document_name)
+        if entry is None:
+            entry = [ReadWriteLock(), 0]
+            _document_locks[document_name] = entry
+        entry[1] += 1
+
+    lock = entry[0]
+    try:
+        if write:
+            lock.acquire_write()
+            try:
+                yield
+            finally:
+                lock.release_write()
+        else:
+            lock.acquire_read()
+            try:
+                yield
+            finally:
+                lock.release_read()
+    finally:
+        with _document_locks_guard:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _document_locks[document_name]
+
+
+@contextmanager
+def handler_lock(handler, posted_data):
+    """Hold the requested document's lock while a handler runs: shared for reads, exclusive for mutations"""
+    if not handler.LOCKS_DOCUMENT:
+        yield
+        return
+
+    with document_lock(posted_data.get("document_name"), handler.MUTATES):
+        yield
 
 
 class HopperHandler(object):
+    # Request path served by a handler. Handlers are the direct subclasses of HopperHandler
+    PATH = None
+    # Handlers that modify their document set this, so that they run alone on it
+    MUTATES = False
+    # Handlers that take the document locks themselves clear this
+    LOCKS_DOCUMENT = True
+    # Handlers producing large lists also implement an iterate() generator taking the same
+    # arguments as run(). Clients opt into streaming its items with "stream": true
+    iterate = None
+
+    # Document name -> Document, valid as long as Document.getDocumentsGeneration() does not change
+    _documents_by_name = {}
+    _documents_generation = None
+    _documents_lock = threading.Lock()
+
     @abstractmethod
     def run(cls):
         pass
 
     @classmethod
     def get_document_named(cls, document_name):
-        for document in Document.getAllDocuments():
-            if document.getDocumentName() == document_name:
+        with HopperHandler._documents_lock:
+            generation = Document.getDocumentsGeneration()
+            if generation != HopperHandler._documents_generation:
+                # A document appeared, was closed or was renamed
+                cls.invalidate_document_cache()
+                HopperHandler._documents_generation = generation
+
+            document = HopperHandler._documents_by_name.get(document_name)
+            # Hopper renames documents on its own, without changing the generation: check the hit still has its name
+            if document and document.getDocumentName() == document_name:
                 return document
-        raise Exception("failed to find specified document")
+
+            # Cache miss. Hopper may have renamed a document on its own (ie, once the initial analysis is over), so rescan
+            documents_by_name = {}
+            for document in Document.getAllDocuments():
+                documents_by_name[document.getDocumentName()] = document
+            HopperHandler._documents_by_name = documents_by_name
+
+        document = documents_by_name.get(document_name)
+        if not document:
+            raise Exception("failed to find specified document")
+        return document
+
+    @classmethod
+    def handler_for_path(cls, path):
+        for handler in cls.__subclasses__():
+            if path == handler.PATH:
+                return handler
+        return None
+
+    @staticmethod
+    def dispatch(handler, arguments):
+        """Run a handler with the posted arguments, under the document lock"""
+        with handler_lock(handler, arguments):
+            return handler.run(**arguments)
+
+    @classmethod
+    def encode_response(cls, data_response):
+        return json.dumps({"data": data_response})
+
+    @classmethod
+    def invalidate_document_cache(cls):
+        """Forget the known document names. The next lookup rescans all documents"""
+        HopperHandler._documents_by_name = {}
+
+    @staticmethod
+    def parse_address(address):
+        """Addresses may be posted as integers, or as strings like "0x100003f20" """
+        if isinstance(address, str):
+            return int(address, 0)
+        return address
+
+    @staticmethod
+    def encode_cursor(address):
+        return base64.urlsafe_b64encode(f"{address:x}".encode("ascii")).decode("ascii")
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            return int(base64.urlsafe_b64decode(cursor.encode("ascii")), 16)
+        except ValueError:
+            raise Exception("invalid cursor")
+
+    @classmethod
+    def projected_fields(cls, fields):
+        """Validate a requested field projection against the handler's FIELDS. None selects the legacy item shape"""
+        if fields is None:
+            return None
+        unknown_fields = set(fields) - set(cls.FIELDS)
+        if unknown_fields:
+            raise Exception(f"unknown fields: {', '.join(sorted(unknown_fields))}")
+        return set(fields)
+
+    @classmethod
+    def select(cls, entries, offset=0, limit=None, cursor=None, start=None, end=None):
+        """Filter listing entries. entries yields (address, build_item) sorted by address, so that items
+        are only built for the selected slice: [start, end[, from the cursor on, skipping offset, at most limit
+        """
+        start = cls.parse_address(start)
+        end = cls.parse_address(end)
+        if cursor:
+            cursor_address = cls.decode_cursor(cursor)
+            start = cursor_address if start is None else max(start, cursor_address)
+
+        selected = 0
+        for address, build_item in entries:
+            if start is not None and address < start:
+                continue
+            if end is not None and address >= end:
+                break
+            if offset > 0:
+                offset -= 1
+                continue
+            if limit is not None and selected >= limit:
+                break
+            selected += 1
+            yield address, build_item
+
+    @classmethod
+    def page(cls, entries, offset=0, limit=None, cursor=None, start=None, end=None):
+        """Build a listing response. Without limit nor cursor this is the plain list of items. Otherwise it is
+        {"items": [...], "next_cursor": ...}, where next_cursor is passed back to get the following page (None on the last one)
+        """
+        paginated = limit is not None or cursor is not None
+        selection = cls.select(entries, offset, None if limit is None else limit + 1, cursor, start, end)
+        items = []
+        next_cursor = None
+        for address, build_item in selection:
+            if limit is not None and len(items) == limit:
+                next_cursor = cls.encode_cursor(address)
+                break
+            items.append(build_item())
+
+        if not paginated:
+            return items
+        return {"items": items, "next_cursor": next_cursor}
 
 
 class TerminateHopper(HopperHandler):
@@ -53,54 +313,188 @@ class TerminateHopper(HopperHandler):
 
 class ListSegments(HopperHandler):
     PATH = "/segments"
+    FIELDS = ("name", "start", "length")
 
     @classmethod
-    def run(cls, document_name):
+    def run(cls, document_name, fields=None, **selection):
+        return cls.page(cls.entries(document_name, fields), **selection)
+
+    @classmethod
+    def entries(cls, document_name, fields):
         document = cls.get_document_named(document_name)
-        segments = document.getSegmentsList()
-        return [segment.getName() for segment in segments]
+        fields = cls.projected_fields(fields)
+
+        segments = [(segment.getStartingAddress(), segment) for segment in document.getSegmentsList()]
+        segments.sort(key=lambda entry: entry[0])
+        for segment_start, segment in segments:
+            if fields is None:
+                yield segment_start, segment.getName
+                continue
+
+            def build_item(segment=segment, segment_start=segment_start):
+                item = {}
+                if "name" in fields:
+                    item["name"] = segment.getName()
+                if "start" in fields:
+                    item["start"] = segment_start
+                if "length" in fields:
+                    item["length"] = segment.getLength()
+                return item
+
+            yield segment_start, build_item
 
 
 class ListProcedures(HopperHandler):
     PATH = "/procedures"
+    FIELDS = ("label", "address")
 
     @classmethod
-    def run(cls, document_name):
+    def run(cls, document_name, fields=None, **selection):
+        return cls.page(cls.entries(document_name, fields), **selection)
+
+    @classmethod
+    def iterate(cls, document_name, fields=None, **selection):
+        for _, build_item in cls.select(cls.entries(document_name, fields), **selection):
+            yield build_item()
+
+    @classmethod
+    def entries(cls, document_name, fields):
         document = cls.get_document_named(document_name)
+        fields = cls.projected_fields(fields) or set(cls.FIELDS)
 
-        named_procedures = []
-        for segment_name in ListSegments.run():
-            segment = document.getSegmentByName(segment_name)
-            for label_address in segment.getNamedAddresses():
-                named_procedures.append(
-                    {
-                        "label": segment.getDemangledNameAtAddress(label_address),
-                        "address": label_address,
-                    }
-                )
+        segments = [(segment.getStartingAddress(), segment) for segment in document.getSegmentsList()]
+        segments.sort(key=lambda entry: entry[0])
+        for _, segment in segments:
+            for label_address in sorted(segment.getNamedAddresses()):
 
-        return named_procedures
+                # Demangling is only paid for the labels that are actually returned
+                def build_item(segment=segment, label_address=label_address):
+                    item = {}
+                    if "label" in fields:
+                        item["label"] = segment.getDemangledNameAtAddress(label_address)
+                    if "address" in fields:
+                        item["address"] = label_address
+                    return item
+
+                yield label_address, build_item
 
 
 class ListStrings(HopperHandler):
     PATH = "/strings"
+    FIELDS = ("string", "address", "section")
 
     @classmethod
-    def run(cls, document_name):
+    def run(cls, document_name, fields=None, sections=None, **selection):
+        return cls.page(cls.entries(document_name, fields, sections), **selection)
+
+    @classmethod
+    def iterate(cls, document_name, fields=None, sections=None, **selection):
+        for _, build_item in cls.select(cls.entries(document_name, fields, sections), **selection):
+            yield build_item()
+
+    @classmethod
+    def entries(cls, document_name, fields, sections):
+        """Strings of the given sections, among hopper_strings.STRING_SECTIONS. By default, all of them, except
+        for the legacy shape (without fields) which only lists __cstring
+        """
+        document = cls.get_document_named(document_name)
+        fields = cls.projected_fields(fields)
+        if fields is None and sections is None:
+            sections = ("__cstring",)
+
+        for string_address, section_name, string in string_tables.table(document).in_sections(sections):
+
+            def build_item(string_address=string_address, section_name=section_name, string=string):
+                string = string.strip()
+                if fields is None:
+                    return string
+                item = {}
+                if "string" in fields:
+                    item["string"] = string
+                if "address" in fields:
+                    item["address"] = string_address
+                if "section" in fields:
+                    item["section"] = section_name
+                return item
+
+            yield string_address, build_item
+
+
+class SearchDocument(HopperHandler):
+    PATH = "/search"
+
+    @classmethod
+    def run(cls, document_name, query, regex=False, case_sensitive=False, kinds=None, limit=None, scan_comments=False):
+        """{"kind", "address", "text"} of the strings, labels, comments and cached pseudocode containing
+        query, or matching it as a regex. kinds restricts the search to some of hopper_search.KINDS.
+        Only the comments at labels, or set through hopper_api, are searched unless scan_comments: the
+        comments at every instruction are then indexed once, which reads the whole document
+        """
+        return list(cls.iterate(document_name, query, regex, case_sensitive, kinds, limit, scan_comments))
+
+    @classmethod
+    def iterate(cls, document_name, query, regex=False, case_sensitive=False, kinds=None, limit=None, scan_comments=False):
+        if not query:
+            raise Exception("did not specify a query")
+        if kinds is not None:
+            unknown_kinds = set(kinds) - set(KINDS)
+            if unknown_kinds:
+                raise Exception(f"unknown kinds: {', '.join(sorted(unknown_kinds))}")
+
+        document = cls.get_document_named(document_name)
+        index = search_indexes.index(document, string_tables.table(document), decompilation_cache, scan_comments)
+        try:
+            results = index.search(query, regex, case_sensitive, kinds, limit)
+        except re.error as error:
+            raise Exception(f"invalid regex: {error}")
+        yield from results
+
+
+class ScanSignatures(HopperHandler):
+    PATH = "/scan"
+
+    @classmethod
+    def run(cls, document_name, signatures, segments=None, start=None, end=None):
+        """{"id", "address"} of the matches of byte signatures like "48 8B ?? 05", sorted by address. signatures is
+        a list, whose ids are the indexes, or a dict of id -> signature. A signature may also be a {"bytes", "mask"}
+        dict of hex strings. segments restricts the scan to some segment names, start and end to an address range
+        """
+        return list(cls.iterate(document_name, signatures, segments, start, end))
+
+    @classmethod
+    def iterate(cls, document_name, signatures, segments=None, start=None, end=None):
         document = cls.get_document_named(document_name)
+        try:
+            scanner = SignatureScanner(signatures)
+        except (ValueError, KeyError) as error:
+            raise Exception(f"invalid signature: {error}")
+
+        matches = scanner.scan(document, None if segments is None else set(segments), cls.parse_address(start), cls.parse_address(end))
+        for pattern_id, address in matches:
+            yield {"id": pattern_id, "address": address}
 
-        cstrings_sect = document.getSectionByName("__cstring")
-        text_seg = document.getSegmentByName("__TEXT")
-        cstring_start = cstrings_sect.getStartingAddress()
 
-        string_cursor = 0
-        strings = []
-        while string_cursor < cstrings_sect.getLength():
-            stringlen = text_seg.getObjectLength(cstring_start + string_cursor)
-            string = text_seg.readBytes(cstring_start + string_cursor, stringlen - 1).strip()
-            string_cursor += max(stringlen, 1)
-            strings.append(string)
-        return strings
+class AllPseudoCode(HopperHandler):
+    PATH = "/all_code"
+
+    @classmethod
+    def run(cls, document_name):
+        return list(cls.iterate(document_name))
+
+    @classmethod
+    def iterate(cls, document_name):
+        """Pseudocode of every procedure in the document. Best requested with "stream": the whole
+        document can run to gigabytes
+        """
+        document = cls.get_document_named(document_name)
+
+        for segment in document.getSegmentsList():
+            for procedure_index in range(segment.getProcedureCount()):
+                procedure = segment.getProcedureAtIndex(procedure_index)
+                yield {
+                    "address": procedure.getEntryPoint(),
+                    "pseudocode": decompilation_cache.decompile(document, procedure),
+                }
 
 
 class DecompileProcedure(HopperHandler):
@@ -113,52 +507,215 @@ class DecompileProcedure(HopperHandler):
 
         document = cls.get_document_named(document_name)
 
-        # Hopper's API requires you to know the segment that contains a procedure (even though procs are
-        # referenced by their absolute address in the binary).
-        # Try all known segments
-        for segment_name in ListSegments.run():
-            segment = document.getSegmentByName(segment_name)
-            procedure_candidate = segment.getProcedureAtAddress(procedure_address)
-            if procedure_candidate:
-                return procedure_candidate.decompile()
+        # Procedures are referenced by their absolute address: the document's procedure index finds
+        # the containing segment without trying every one of them
+        procedure = document.getProcedureAtAddress(cls.parse_address(procedure_address))
+        if not procedure:
+            raise Exception("Failed to find the specified procedure")
+
+        return decompilation_cache.decompile(document, procedure)
 
-        raise Exception("Failed to find the specified procedure")
+
+class DecompilationPipelineHandler(HopperHandler):
+    PATH = "/pipeline"
+
+    @classmethod
+    def run(cls, document_name, output_path=None, worker_count=None):
+        """Start decompiling every procedure of the document into output_path, on the machine running Hopper, in the
+        background. An existing output file is resumed. Without output_path, or while a pipeline runs, returns the
+        status of the document's last pipeline (see DecompilationPipeline.status) with its output_path
+        """
+        document = cls.get_document_named(document_name)
+        with pipelines_lock:
+            pipeline = pipelines.get(document_name)
+            if output_path is not None and (pipeline is None or pipeline.state != RUNNING):
+                # The workers share the document's lock with the requests, as readers
+                pipeline = DecompilationPipeline(
+                    document,
+                    output_path,
+                    worker_count or DEFAULT_PIPELINE_WORKER_COUNT,
+                    decompilation_cache=decompilation_cache,
+                    lock=lambda: handler_lock(cls, {"document_name": document_name}),
+                )
+                pipelines[document_name] = pipeline
+                pipeline.start()
+        if pipeline is None:
+            raise Exception("no pipeline was started for the document")
+        return dict(pipeline.status(), output_path=pipeline.output_path)
+
+
+class CancelDecompilationPipeline(HopperHandler):
+    PATH = "/pipeline_cancel"
+
+    @classmethod
+    def run(cls, document_name):
+        """Cancel the running pipeline of the document. The output file keeps what was decompiled, and is resumed
+        by the next /pipeline
+        """
+        with pipelines_lock:
+            pipeline = pipelines.get(document_name)
+        if pipeline is None:
+            raise Exception("no pipeline was started for the document")
+        pipeline.cancel()
+        pipeline.join()
+        return dict(pipeline.status(), output_path=pipeline.output_path)
+
+
+class DecompilationCacheStats(HopperHandler):
+    PATH = "/decompile_cache"
+
+    @classmethod
+    def run(cls):
+        """Hit, miss and eviction counters of the pseudocode cache"""
+        return decompilation_cache.stats()
 
 
 class DisassembleProcedure(HopperHandler):
     PATH = "/disassemble"
+    FIELDS = ("address", "length", "mnemonic", "operands", "conditional_jump", "unconditional_jump", "block")
 
     @classmethod
-    def run(cls, document_name, procedure_address):
+    def run(cls, document_name, procedure_address, fields=None):
+        """Without fields, the legacy text listing, one "mnemonic  operands" line per instruction.
+        Otherwise the list of instruction records, restricted to fields
+        """
+        if fields is None:
+            lines = [record["mnemonic"] + "  " + ", ".join(record["operands"]) + "\n" for record in cls.records(document_name, procedure_address)]
+            return "".join(lines)
+        return list(cls.iterate(document_name, procedure_address, fields))
+
+    @classmethod
+    def iterate(cls, document_name, procedure_address, fields=None):
+        fields = cls.projected_fields(fields)
+        for record in cls.records(document_name, procedure_address):
+            if fields is not None:
+                record = {field: value for field, value in record.items() if field in fields}
+            yield record
+
+    @classmethod
+    def records(cls, document_name, procedure_address):
+        """Yield a record per instruction of the procedure, block by block. Instructions are decoded once, and cached by hopper_api"""
         document = cls.get_document_named(document_name)
         if not procedure_address:
             raise Exception("did not specify procedure address")
 
-        disassembly = ""
+        procedure = document.getProcedureAtAddress(cls.parse_address(procedure_address))
+        if not procedure:
+            raise Exception("Failed to find the specified procedure")
+
+        document_internal = document.__internal_document_addr__
+        if document.backgroundProcessActive():
+            # The analysis changes the code under the cached decoded instructions
+            document.clearDecodedInstructions()
+            decoded_instruction_stamps.pop(document_internal, None)
+        else:
+            # Operands print label names: renames made in the user interface change the analysis stamp
+            stamp = decompilation_cache.document_stamp(document)[1]
+            if decoded_instruction_stamps.get(document_internal) != stamp:
+                document.clearDecodedInstructions()
+                decoded_instruction_stamps[document_internal] = stamp
+
+        for block_index, basic_block in enumerate(procedure.basicBlockIterator()):
+            for instr_address, instr in basic_block.getInstructionList():
+                yield {
+                    "address": instr_address,
+                    "length": instr.getInstructionLength(),
+                    "mnemonic": instr.getInstructionString(),
+                    "operands": instr.getFormattedArguments(),
+                    "conditional_jump": instr.isAConditionalJump(),
+                    "unconditional_jump": instr.isAnInconditionalJump(),
+                    "block": block_index,
+                }
 
-        # Hopper's API requires you to know the segment that contains a procedure (even though procs are
-        # referenced by their absolute address in the binary).
-        # Try all known segments
-        for segment_name in ListSegments.run():
-            segment = document.getSegmentByName(segment_name)
-            procedure_candidate = segment.getProcedureAtAddress(procedure_address)
-            if procedure_candidate:
 
-                for basic_block in procedure_candidate.basicBlockIterator():
-                    basic_block_start = basic_block.getStartingAddress()
-                    instr_cursor = basic_block_start
-                    while instr_cursor < basic_block.getEndingAddress():
-                        instr = segment.getInstructionAtAddress(instr_cursor)
-                        instr_args = [instr.getFormattedArgument(i) for i in xrange(instr.getArgumentCount())]
+class ProcedureControlFlowGraph(HopperHandler):
+    PATH = "/cfg"
 
-                        instr_string = instr.getInstructionString() + "  "
-                        instr_string += ", ".join(instr_args)
-                        instr_string += "\n"
-                        disassembly += instr_string
+    @classmethod
+    def run(cls, document_name, procedure_address=None, dominators=False, loops=False):
+        """Blocks and edges of a procedure as parallel arrays, with its immediate dominators and natural
+        loops on demand. Without procedure_address, the list of the graphs of every procedure
+        """
+        if procedure_address is not None:
+            return next(cls.iterate(document_name, procedure_address, dominators, loops))
+        return list(cls.iterate(document_name, procedure_address, dominators, loops))
+
+    @classmethod
+    def iterate(cls, document_name, procedure_address=None, dominators=False, loops=False):
+        document = cls.get_document_named(document_name)
+
+        if procedure_address is not None:
+            procedure = document.getProcedureAtAddress(cls.parse_address(procedure_address))
+            if not procedure:
+                raise Exception("Failed to find the specified procedure")
+            yield ControlFlowGraph.from_procedure(procedure).to_json(dominators, loops)
+            return
+
+        for segment in document.getSegmentsList():
+            for procedure_index in range(segment.getProcedureCount()):
+                procedure = segment.getProcedureAtIndex(procedure_index)
+                yield ControlFlowGraph.from_procedure(procedure).to_json(dominators, loops)
+
+
+class ListReferences(HopperHandler):
+    PATH = "/references"
+
+    @classmethod
+    def run(cls, document_name, direction=TO, addresses=None, start=None, end=None):
+        """{"from", "to"} of the references to (or, with direction "from", made from) each of addresses, or the
+        addresses of [start, end[. Sorted by the queried side, then by the other one
+        """
+        return list(cls.iterate(document_name, direction, addresses, start, end))
+
+    @classmethod
+    def iterate(cls, document_name, direction=TO, addresses=None, start=None, end=None):
+        if direction not in (TO, FROM):
+            raise Exception(f"unknown direction {direction}")
+        if addresses is None and (start is None or end is None):
+            raise Exception("did not specify addresses nor a start and end")
+
+        document = cls.get_document_named(document_name)
+        if addresses is not None:
+            addresses = [cls.parse_address(address) for address in addresses]
 
-                        instr_cursor += instr.getInstructionLength()
-        # Maybe this should return a list of instructions, instead of combining them into 1 string?
-        return disassembly
+        if document.backgroundProcessActive():
+            # The analysis adds references behind the index: ask Hopper directly until it is over, and only
+            # build the index then
+            xref_indexes.invalidate(document)
+            if addresses is None:
+                raise Exception("the analysis of the document is not finished, query addresses instead of a range")
+            for address in addresses:
+                segment = document.getSegmentAtAddress(address)
+                if segment is None:
+                    continue
+                if direction == TO:
+                    for source in sorted(segment.getReferencesOfAddress(address) or ()):
+                        yield {"from": source, "to": address}
+                else:
+                    for target in sorted(segment.getReferencesFromAddress(address) or ()):
+                        yield {"from": address, "to": target}
+            return
+
+        index = xref_indexes.index(document)
+        if addresses is not None:
+            if direction == TO:
+                for address, sources in index.references_to_many(addresses).items():
+                    for source in sources:
+                        yield {"from": source, "to": address}
+            else:
+                for address, targets in index.references_from_many(addresses).items():
+                    for target in targets:
+                        yield {"from": address, "to": target}
+            return
+
+        start = cls.parse_address(start)
+        end = cls.parse_address(end)
+        if direction == TO:
+            for target, source in index.references_to_range(start, end):
+                yield {"from": source, "to": target}
+        else:
+            for source, target in index.references_from_range(start, end):
+                yield {"from": source, "to": target}
 
 
 class ListDocuments(HopperHandler):
@@ -174,6 +731,113 @@ class ListDocuments(HopperHandler):
         return documents
 
 
+class DocumentEventsHandler(HopperHandler):
+    PATH = "/events"
+    LOCKS_DOCUMENT = False
+
+    @classmethod
+    def run(cls, after=None, timeout=EVENTS_MAX_TIMEOUT, types=None):
+        """Long poll for the document events (see hopper_events.EVENT_TYPES) of sequence greater than after, waiting
+        up to timeout seconds for one. Returns {"sequence", "events", "documents"}: sequence is passed back as after
+        by the next request, and documents lists the open documents. Without after, returns at once the current
+        sequence and documents
+        """
+        types = cls.event_types(types)
+        if after is None:
+            sequence, documents = document_events.state()
+            return {"sequence": sequence, "events": [], "documents": documents}
+
+        with cls.waiter():
+            events = document_events.wait(after, min(max(timeout, 0), EVENTS_MAX_TIMEOUT), types)
+        _, documents = document_events.state()
+        return {"sequence": events[-1]["sequence"] if events else after, "events": events, "documents": documents}
+
+    @classmethod
+    def iterate(cls, after=None, timeout=EVENTS_MAX_TIMEOUT, types=None):
+        """Stream the events as they happen, for timeout seconds"""
+        types = cls.event_types(types)
+        if after is None:
+            after, _ = document_events.state()
+
+        deadline = time.monotonic() + min(max(timeout, 0), EVENTS_MAX_TIMEOUT)
+        with cls.waiter():
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                for event in document_events.wait(after, remaining, types):
+                    after = event["sequence"]
+                    yield event
+
+    @staticmethod
+    @contextmanager
+    def waiter():
+        """Count a waiting request against events_waiters. Refused when all the waiting slots are taken"""
+        if not events_waiters.acquire(blocking=False):
+            raise Exception("too many /events requests are waiting, retry later")
+        try:
+            yield
+        finally:
+            events_waiters.release()
+
+    @staticmethod
+    def event_types(types):
+        if types is None:
+            return None
+        unknown_types = set(types) - set(EVENT_TYPES)
+        if unknown_types:
+            raise Exception(f"unknown event types: {', '.join(sorted(unknown_types))}")
+        return set(types)
+
+
+class ExportSnapshot(HopperHandler):
+    PATH = "/export"
+
+    @classmethod
+    def run(cls, document_name, output_path, instructions=True, pseudocode=False):
+        """Write a hopper_snapshot of the document to output_path, on the machine running Hopper. Returns output_path"""
+        document = cls.get_document_named(document_name)
+        if document.backgroundProcessActive():
+            raise Exception("the analysis of the document is not finished")
+        export_snapshot(document, output_path, instructions, pseudocode, decompilation_cache)
+        return output_path
+
+
+class CloseDocument(HopperHandler):
+    PATH = "/close"
+    MUTATES = True
+    # The pipeline of the document is stopped before taking the lock its workers wait on
+    LOCKS_DOCUMENT = False
+
+    @staticmethod
+    def cancel_pipeline(document_name):
+        with pipelines_lock:
+            pipeline = pipelines.pop(document_name, None)
+        if pipeline is not None:
+            pipeline.cancel()
+        return pipeline
+
+    @classmethod
+    def run(cls, document_name):
+        pipeline = cls.cancel_pipeline(document_name)
+        if pipeline is not None:
+            pipeline.join()
+
+        with document_lock(document_name, write=True):
+            # A pipeline started in the meantime skips its procedures once it gets the lock, after the close
+            cls.cancel_pipeline(document_name)
+            document = cls.get_document_named(document_name)
+            # The pseudocode stays cached: it is keyed by the executable, and is still valid if it is opened again
+            decompilation_cache.forget_document(document)
+            decoded_instruction_stamps.pop(document.__internal_document_addr__, None)
+            string_tables.invalidate(document)
+            search_indexes.invalidate(document)
+            xref_indexes.invalidate(document)
+            document.closeDocument()
+            cls.invalidate_document_cache()
+        return True
+
+
 class BackgroundProcessActive(HopperHandler):
     PATH = "/analysis"
 
@@ -192,40 +856,195 @@ class DocumentFilePath(HopperHandler):
         return document.getExecutableFilePath()
 
 
+class BatchRequest(HopperHandler):
+    PATH = "/batch"
+    LOCKS_DOCUMENT = False
+
+    @classmethod
+    def run(cls, requests, document_name=None, concurrent=False):
+        """Run many requests in one round trip. requests is a list of {"path": ..., "args": {...}}; the items
+        without a document_name in their args use the batch's one when their handler takes a document_name.
+        Independent items may run in parallel with concurrent. Returns, in order, one {"data": ...} or
+        {"data": None, "error": ...} per item
+        """
+        if document_name is not None:
+            # Resolve the document once, and fail early if it is missing. The items then hit the name cache
+            cls.get_document_named(document_name)
+
+        def run_item(request):
+            try:
+                handler = HopperHandler.handler_for_path(request.get("path"))
+                if not handler:
+                    raise Exception(f"unknown path {request.get('path')}")
+                if handler is BatchRequest:
+                    raise Exception("batches cannot be nested")
+
+                arguments = dict(request.get("args") or {})
+                arguments.pop("stream", None)
+                if document_name is not None and "document_name" in inspect.signature(handler.run).parameters:
+                    arguments.setdefault("document_name", document_name)
+                return {"data": cls.dispatch(handler, arguments)}
+            except Exception as e:
+                return {"data": None, "error": str(e)}
+
+        if not concurrent:
+            return [run_item(request) for request in requests]
+
+        with ThreadPoolExecutor(max_workers=BATCH_WORKER_COUNT, thread_name_prefix="hopper_proxy_batch") as executor:
+            return list(executor.map(run_item, requests))
+
+    @classmethod
+    def encode_response(cls, data_response):
+        try:
+            return json.dumps({"data": data_response})
+        except TypeError:
+            pass
+
+        # Some items cannot be serialized: report them individually instead of failing the whole batch
+        encoded_items = []
+        for item in data_response:
+            try:
+                encoded_items.append(json.dumps(item))
+            except TypeError as e:
+                encoded_items.append(json.dumps({"data": None, "error": str(e)}))
+        return '{"data": [' + ", ".join(encoded_items) + "]}"
+
+
 class RequestHandler(BaseHTTPRequestHandler):
+    # Persistent connections: every response carries a Content-Length
+    protocol_version = "HTTP/1.1"
+    timeout = KEEP_ALIVE_TIMEOUT
+    # The served handlers are the direct subclasses of this class
+    handlers = HopperHandler
+
     def do_POST(self):
         content_length = int(self.headers.get("Content-Length", 0))
         posted_data = json.loads(self.rfile.read(content_length)) if content_length > 0 else {}
+        stream = posted_data.pop("stream", False)
+
+        handler = self.handlers.handler_for_path(self.path)
+        if not handler:
+            self.send_response(404)
+            self.send_json(json.dumps({"data": None, "error": f"unknown path {self.path}"}))
+            return
+
+        if stream and handler.iterate:
+            self.stream_handler(handler, posted_data)
+            return
+
+        try:
+            data_response = HopperHandler.dispatch(handler, posted_data)
+            body = handler.encode_response(data_response)
+            self.send_response(200)
+        except Exception as e:
+            # TypeError also covers a response that cannot be serialized
+            body = json.dumps({"data": None, "error": str(e)})
+            self.send_response(500)
+
+        self.send_json(body)
+
+    def do_GET(self):
+        # Argument-less requests, like the plugin's GET /documents
+        handler = self.handlers.handler_for_path(self.path)
+        if not handler:
+            self.send_response(404)
+            self.send_json(json.dumps({"data": None, "error": f"unknown path {self.path}"}))
+            return
 
-        data_response = None
-        error = None
+        try:
+            body = handler.encode_response(HopperHandler.dispatch(handler, {}))
+            self.send_response(200)
+        except Exception as e:
+            body = json.dumps({"data": None, "error": str(e)})
+            self.send_response(500)
 
-        for handler in HopperHandler.__subclasses__():
-            if self.path == handler.PATH:
+        self.send_json(body)
 
-                try:
-                    data_response = handler.run(**posted_data)
-                    json.dumps(data_response)
-                    self.send_response(200)
-                except TypeError as e:
-                    self.send_response(500)
-                    error = str(e)
-                except Exception as e:
-                    self.send_response(500)
-                    error = str(e)
+    def send_json(self, body):
+        body = body.encode("utf-8")
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
-                response = {"data": data_response}
-                if error:
-                    response["error"] = error
+    def stream_handler(self, handler, posted_data):
+        """Send the items of handler.iterate() as chunked NDJSON, while they are produced.
+        Each line is {"data": item}. A failure ends the stream with an {"error": ...} line
+        """
+        self.send_response(200)
+        self.send_header("Content-type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
 
-                self.send_header("Content-type", "application/json")
-                self.end_headers()
-                self.wfile.write(json.dumps(response).encode("utf-8"))
+        pending = []
+        pending_size = 0
+        last_flush = time.monotonic()
+        try:
+            with handler_lock(handler, posted_data):
+                for item in handler.iterate(**posted_data):
+                    line = json.dumps({"data": item}) + "\n"
+                    pending.append(line)
+                    pending_size += len(line)
+                    if pending_size >= STREAM_CHUNK_SIZE or time.monotonic() - last_flush >= STREAM_FLUSH_INTERVAL:
+                        self.write_chunk("".join(pending))
+                        pending = []
+                        pending_size = 0
+                        last_flush = time.monotonic()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away, stop producing
+            self.close_connection = True
+            return
+        except Exception as e:
+            pending.append(json.dumps({"error": str(e)}) + "\n")
 
+        if pending:
+            self.write_chunk("".join(pending))
+        self.wfile.write(b"0\r\n\r\n")
 
-def start_server():
+    def write_chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
 
-    httpd = HTTPServer(("", 52349), RequestHandler)
+
+class ThreadPoolHTTPServer(HTTPServer):
+    """HTTPServer handing each connection to a bounded pool of worker threads"""
+
+    def __init__(self, server_address, handler_class, worker_count=DEFAULT_WORKER_COUNT):
+        super().__init__(server_address, handler_class)
+        self.executor = ThreadPoolExecutor(max_workers=worker_count, thread_name_prefix="hopper_proxy")
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
+
+
+def start_server(port=DEFAULT_PORT, worker_count=DEFAULT_WORKER_COUNT, decompilation_cache_path=None, decompilation_cache_size=None):
+    """Serve the API on the given port. Requests are handled by worker_count threads; each
+    keep-alive connection holds a worker until it is closed or idle for KEEP_ALIVE_TIMEOUT seconds. At most half
+    of the workers wait in /events long polls.
+    Pseudocode is cached in memory, and also in the sqlite file at decompilation_cache_path if given
+    """
+    global decompilation_cache, events_waiters
+    decompilation_cache = DecompilationCache(decompilation_cache_path, decompilation_cache_size or decompilation_cache.memory_size)
+    decompilation_cache.install(Segment)
+    string_tables.install(Segment)
+    search_indexes.install(Segment)
+    xref_indexes.install(Segment)
+    document_events.start(Document)
+    events_waiters = threading.BoundedSemaphore(max(worker_count // 2, 1))
+
+    httpd = ThreadPoolHTTPServer(("", port), RequestHandler, worker_count)
 
     try:
         httpd.serve_forever()
@@ -233,3 +1052,14 @@ def start_server():
         pass
 
     httpd.server_close()
+    decompilation_cache.uninstall(Segment)
+    string_tables.uninstall(Segment)
+    search_indexes.uninstall(Segment)
+    xref_indexes.uninstall(Segment)
+    document_events.stop()
+    decompilation_cache.close()
+
+
+if __name__ == "__main__":
+    # Run by Hopper at startup. HOPPER_PROXY_PORT lets several Hopper instances serve on their own port
+    start_server(int(os.environ.get("HOPPER_PROXY_PORT", DEFAULT_PORT)))
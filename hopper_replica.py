@@ -0,0 +1,331 @@
+#
+#  hopper_replica.py
+#  IDA Objc
+#
+#  Read-only server answering the hopper_proxy API from exported snapshots (see hopper_snapshot), without Hopper
+#
+
+import argparse
+import json
+import re
+import threading
+
+from hopper_cfg import ControlFlowGraph
+from hopper_proxy import DEFAULT_PORT, DEFAULT_WORKER_COUNT, HopperHandler, RequestHandler, ThreadPoolHTTPServer
+from hopper_search import SnapshotSearchIndex
+from hopper_snapshot import Snapshot, loaded_row, stored_address
+
+# Document name -> snapshot path, filled by start_replica()
+snapshot_paths = {}
+
+
+class ReplicaHandler(HopperHandler):
+    """Base of the replica handlers, which are its direct subclasses. Snapshots are never modified,
+    so no document lock is taken
+    """
+
+    LOCKS_DOCUMENT = False
+
+    # Each worker thread has its own sqlite connection to every snapshot
+    _connections = threading.local()
+
+    @classmethod
+    def get_snapshot(cls, document_name):
+        snapshots = getattr(ReplicaHandler._connections, "snapshots", None)
+        if snapshots is None:
+            snapshots = ReplicaHandler._connections.snapshots = {}
+
+        snapshot = snapshots.get(document_name)
+        if snapshot:
+            return snapshot
+
+        path = snapshot_paths.get(document_name)
+        if not path:
+            raise Exception("failed to find specified document")
+        snapshot = snapshots[document_name] = Snapshot(path)
+        return snapshot
+
+    @classmethod
+    def rows(cls, snapshot, sql, parameters=()):
+        """Lazily iterate the rows of a query, so that a page only reads what it returns. Addresses are converted
+        like Snapshot.query() does
+        """
+        return (loaded_row(row) for row in snapshot.database.execute(sql, parameters))
+
+    @classmethod
+    def get_procedure(cls, snapshot, procedure_address):
+        if not procedure_address:
+            raise Exception("did not specify procedure address")
+        procedure = snapshot.procedure_at(cls.parse_address(procedure_address))
+        if not procedure:
+            raise Exception("Failed to find the specified procedure")
+        return procedure
+
+
+class ReplicaListDocuments(ReplicaHandler):
+    PATH = "/documents"
+
+    @classmethod
+    def run(cls):
+        return list(snapshot_paths)
+
+
+class ReplicaListSegments(ReplicaHandler):
+    PATH = "/segments"
+    FIELDS = ("name", "start", "length")
+
+    @classmethod
+    def run(cls, document_name, fields=None, **selection):
+        return cls.page(cls.entries(document_name, fields), **selection)
+
+    @classmethod
+    def entries(cls, document_name, fields):
+        snapshot = cls.get_snapshot(document_name)
+        fields = cls.projected_fields(fields)
+
+        for row in cls.rows(snapshot, "SELECT name, start, end FROM segments ORDER BY start"):
+            if fields is None:
+                yield row["start"], lambda row=row: row["name"]
+                continue
+
+            def build_item(row=row):
+                item = {}
+                if "name" in fields:
+                    item["name"] = row["name"]
+                if "start" in fields:
+                    item["start"] = row["start"]
+                if "length" in fields:
+                    item["length"] = row["end"] - row["start"]
+                return item
+
+            yield row["start"], build_item
+
+
+class ReplicaListProcedures(ReplicaHandler):
+    PATH = "/procedures"
+    FIELDS = ("label", "address")
+
+    @classmethod
+    def run(cls, document_name, fields=None, **selection):
+        return cls.page(cls.entries(document_name, fields), **selection)
+
+    @classmethod
+    def iterate(cls, document_name, fields=None, **selection):
+        for _, build_item in cls.select(cls.entries(document_name, fields), **selection):
+            yield build_item()
+
+    @classmethod
+    def entries(cls, document_name, fields):
+        snapshot = cls.get_snapshot(document_name)
+        fields = cls.projected_fields(fields) or set(cls.FIELDS)
+
+        # Like the live /procedures, this lists every named address
+        for row in cls.rows(snapshot, "SELECT address, demangled FROM labels ORDER BY address"):
+
+            def build_item(row=row):
+                item = {}
+                if "label" in fields:
+                    item["label"] = row["demangled"]
+                if "address" in fields:
+                    item["address"] = row["address"]
+                return item
+
+            yield row["address"], build_item
+
+
+class ReplicaListStrings(ReplicaHandler):
+    PATH = "/strings"
+    FIELDS = ("string", "address", "section")
+
+    @classmethod
+    def run(cls, document_name, fields=None, sections=None, **selection):
+        return cls.page(cls.entries(document_name, fields, sections), **selection)
+
+    @classmethod
+    def iterate(cls, document_name, fields=None, sections=None, **selection):
+        for _, build_item in cls.select(cls.entries(document_name, fields, sections), **selection):
+            yield build_item()
+
+    @classmethod
+    def entries(cls, document_name, fields, sections):
+        snapshot = cls.get_snapshot(document_name)
+        fields = cls.projected_fields(fields)
+        # Like the live /strings, the legacy shape only lists __cstring
+        if fields is None and sections is None:
+            sections = ("__cstring",)
+
+        sections = None if sections is None else set(sections)
+        for row in cls.rows(snapshot, "SELECT address, section, value FROM strings ORDER BY address"):
+            if sections is not None and row["section"] not in sections:
+                continue
+
+            def build_item(row=row):
+                string = row["value"].strip()
+                if fields is None:
+                    return string
+                item = {}
+                if "string" in fields:
+                    item["string"] = string
+                if "address" in fields:
+                    item["address"] = row["address"]
+                if "section" in fields:
+                    item["section"] = row["section"]
+                return item
+
+            yield row["address"], build_item
+
+
+class ReplicaSearch(ReplicaHandler):
+    PATH = "/search"
+
+    # Document name -> SnapshotSearchIndex, shared by the worker threads
+    _indexes = {}
+    _indexes_lock = threading.Lock()
+
+    @classmethod
+    def run(cls, document_name, query, regex=False, case_sensitive=False, kinds=None, limit=None):
+        return list(cls.iterate(document_name, query, regex, case_sensitive, kinds, limit))
+
+    @classmethod
+    def iterate(cls, document_name, query, regex=False, case_sensitive=False, kinds=None, limit=None):
+        if not query:
+            raise Exception("did not specify a query")
+        with cls._indexes_lock:
+            index = cls._indexes.get(document_name)
+            if index is None:
+                index = cls._indexes[document_name] = SnapshotSearchIndex(cls.get_snapshot(document_name))
+        try:
+            results = index.search(query, regex, case_sensitive, kinds, limit)
+        except re.error as error:
+            raise Exception(f"invalid regex: {error}")
+        yield from results
+
+
+class ReplicaDecompileProcedure(ReplicaHandler):
+    PATH = "/decompile"
+
+    @classmethod
+    def run(cls, document_name, procedure_address):
+        snapshot = cls.get_snapshot(document_name)
+        procedure = cls.get_procedure(snapshot, procedure_address)
+
+        code = snapshot.pseudocode(procedure["id"])
+        if code is None:
+            raise Exception("the snapshot has no pseudocode for the specified procedure")
+        return code
+
+
+class ReplicaDisassembleProcedure(ReplicaHandler):
+    PATH = "/disassemble"
+    FIELDS = ("address", "length", "mnemonic", "operands", "conditional_jump", "unconditional_jump", "block")
+
+    @classmethod
+    def run(cls, document_name, procedure_address, fields=None):
+        if fields is None:
+            lines = [record["mnemonic"] + "  " + ", ".join(record["operands"]) + "\n" for record in cls.records(document_name, procedure_address)]
+            return "".join(lines)
+        return list(cls.iterate(document_name, procedure_address, fields))
+
+    @classmethod
+    def iterate(cls, document_name, procedure_address, fields=None):
+        fields = cls.projected_fields(fields)
+        for record in cls.records(document_name, procedure_address):
+            if fields is not None:
+                record = {field: value for field, value in record.items() if field in fields}
+            yield record
+
+    @classmethod
+    def records(cls, document_name, procedure_address):
+        """Same records as the live /disassemble: the instructions of each basic block, in block order"""
+        snapshot = cls.get_snapshot(document_name)
+        procedure = cls.get_procedure(snapshot, procedure_address)
+
+        for block in snapshot.basic_blocks(procedure["id"]):
+            for row in cls.rows(
+                snapshot,
+                "SELECT * FROM instructions WHERE address >= ? AND address < ? ORDER BY address",
+                (stored_address(block["start"]), stored_address(block["end"])),
+            ):
+                yield {
+                    "address": row["address"],
+                    "length": row["length"],
+                    "mnemonic": row["mnemonic"],
+                    "operands": json.loads(row["operands"]),
+                    "conditional_jump": bool(row["conditional_jump"]),
+                    "unconditional_jump": bool(row["unconditional_jump"]),
+                    "block": block["block_index"],
+                }
+
+
+class ReplicaControlFlowGraph(ReplicaHandler):
+    PATH = "/cfg"
+
+    @classmethod
+    def run(cls, document_name, procedure_address=None, dominators=False, loops=False):
+        if procedure_address is not None:
+            return next(cls.iterate(document_name, procedure_address, dominators, loops))
+        return list(cls.iterate(document_name, procedure_address, dominators, loops))
+
+    @classmethod
+    def iterate(cls, document_name, procedure_address=None, dominators=False, loops=False):
+        snapshot = cls.get_snapshot(document_name)
+
+        if procedure_address is not None:
+            procedure = cls.get_procedure(snapshot, procedure_address)
+            yield ControlFlowGraph.from_snapshot(snapshot, procedure).to_json(dominators, loops)
+            return
+
+        for procedure in snapshot.procedures():
+            yield ControlFlowGraph.from_snapshot(snapshot, procedure).to_json(dominators, loops)
+
+
+class ReplicaBackgroundProcessActive(ReplicaHandler):
+    PATH = "/analysis"
+
+    @classmethod
+    def run(cls, document_name):
+        cls.get_snapshot(document_name)
+        # A snapshot is only taken of a finished analysis
+        return {"active": False}
+
+
+class ReplicaDocumentFilePath(ReplicaHandler):
+    PATH = "/filepath"
+
+    @classmethod
+    def run(cls, document_name):
+        return cls.get_snapshot(document_name).executable_path()
+
+
+class ReplicaRequestHandler(RequestHandler):
+    handlers = ReplicaHandler
+
+
+def start_replica(paths, port=DEFAULT_PORT, worker_count=DEFAULT_WORKER_COUNT):
+    """Serve the snapshots at paths on the given port. Replicas hold no state besides the snapshot files,
+    so any number of them can run behind a load balancer
+    """
+    for path in paths:
+        with Snapshot(path) as snapshot:
+            document_name = snapshot.document_name()
+        if document_name in snapshot_paths:
+            raise Exception(f"two snapshots of the document {document_name}")
+        snapshot_paths[document_name] = path
+
+    httpd = ThreadPoolHTTPServer(("", port), ReplicaRequestHandler, worker_count)
+
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    httpd.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the hopper_proxy API from document snapshots")
+    parser.add_argument("snapshots", nargs="+", help="snapshot files written by hopper_snapshot.export_snapshot")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKER_COUNT)
+    arguments = parser.parse_args()
+    start_replica(arguments.snapshots, arguments.port, arguments.workers)
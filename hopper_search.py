@@ -0,0 +1,343 @@
+#
+#  hopper_search.py
+#  IDA Objc
+#
+#  Trigram index answering substring and regex searches over strings, labels, comments and pseudocode
+#
+
+import re
+import threading
+
+try:
+    import re._parser as _regex_parser
+except ImportError:
+    import sre_parse as _regex_parser
+
+# Kinds of indexed texts
+KIND_STRING = "string"
+KIND_LABEL = "label"
+KIND_COMMENT = "comment"
+KIND_INLINE_COMMENT = "inline_comment"
+KIND_PSEUDOCODE = "pseudocode"
+KINDS = (KIND_STRING, KIND_LABEL, KIND_COMMENT, KIND_INLINE_COMMENT, KIND_PSEUDOCODE)
+
+
+def trigrams(text):
+    """Set of the trigrams of the lowercased text"""
+    text = text.lower()
+    return set(text[index:index + 3] for index in range(len(text) - 2))
+
+
+def required_literals(pattern, flags=0):
+    """Literal strings that every match of a regex contains. An empty list when nothing is required"""
+    literals = []
+    current = []
+
+    def flush():
+        if current:
+            literals.append("".join(current))
+            del current[:]
+
+    def walk(items):
+        for op, argument in items:
+            if op is _regex_parser.LITERAL:
+                current.append(chr(argument))
+            elif op is _regex_parser.SUBPATTERN:
+                walk(argument[-1])
+            elif op in (_regex_parser.MAX_REPEAT, _regex_parser.MIN_REPEAT):
+                minimum, _, repeated = argument
+                flush()
+                if minimum >= 1:
+                    walk(repeated)
+                    flush()
+            elif op is _regex_parser.AT:
+                # Anchors do not consume characters
+                continue
+            else:
+                flush()
+
+    walk(_regex_parser.parse(pattern, flags))
+    flush()
+    return literals
+
+
+def matching_line(text, start):
+    """The line of text containing the offset start"""
+    line_start = text.rfind("\n", 0, start) + 1
+    line_end = text.find("\n", start)
+    return text[line_start:] if line_end == -1 else text[line_start:line_end]
+
+
+class SearchIndex(object):
+    """Inverted index from the trigrams of texts to the texts containing them. A text is identified by its kind
+    and address: adding a text again replaces the previous one. Queries intersect the postings of the trigrams of
+    the searched literals to find the candidate texts, and only run the actual comparison on those
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # Text id -> (kind, address, text)
+        self._texts = {}
+        # (kind, address) -> text id
+        self._ids = {}
+        # Trigram -> set of text ids
+        self._postings = {}
+        self._next_id = 0
+        # Entry point -> end of the indexed pseudocode, to drop it when its range is invalidated
+        self._pseudocode_ends = {}
+
+    def __len__(self):
+        return len(self._texts)
+
+    def add(self, kind, address, text, end=None):
+        """Index a text, replacing the one of the same kind at the same address. An empty text removes it.
+        end is the end of the procedure of some pseudocode
+        """
+        with self._lock:
+            self.remove(kind, address)
+            if not text:
+                return
+            text_id = self._next_id
+            self._next_id += 1
+            self._texts[text_id] = (kind, address, text)
+            self._ids[(kind, address)] = text_id
+            for trigram in trigrams(text):
+                self._postings.setdefault(trigram, set()).add(text_id)
+            if kind == KIND_PSEUDOCODE:
+                self._pseudocode_ends[address] = end if end is not None else address + 1
+
+    def remove(self, kind, address):
+        with self._lock:
+            text_id = self._ids.pop((kind, address), None)
+            if text_id is None:
+                return
+            _, _, text = self._texts.pop(text_id)
+            for trigram in trigrams(text):
+                postings = self._postings.get(trigram)
+                if postings is not None:
+                    postings.discard(text_id)
+                    if not postings:
+                        del self._postings[trigram]
+            if kind == KIND_PSEUDOCODE:
+                self._pseudocode_ends.pop(address, None)
+
+    def remove_pseudocode(self, start, end=None):
+        """Drop the pseudocode of the procedures overlapping [start, end[ (end None: up to the end)"""
+        with self._lock:
+            for entry_point, entry_end in list(self._pseudocode_ends.items()):
+                if entry_end > start and (end is None or entry_point < end):
+                    self.remove(KIND_PSEUDOCODE, entry_point)
+
+    def _candidates(self, literals):
+        """Ids of the texts containing every trigram of the literals, or None when the literals are too short to filter"""
+        required = set()
+        for literal in literals:
+            required |= trigrams(literal)
+        if not required:
+            return None
+
+        postings = sorted((self._postings.get(trigram, set()) for trigram in required), key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            if not candidates:
+                break
+            candidates &= posting
+        return candidates
+
+    def search(self, query, regex=False, case_sensitive=False, kinds=None, limit=None):
+        """Texts containing query, or matching the regex query. Returns a list of {"kind", "address", "text"}
+        sorted by kind then address. For pseudocode, text is the first matching line
+        """
+        if regex:
+            flags = 0 if case_sensitive else re.IGNORECASE
+            compiled = re.compile(query, flags)
+            literals = required_literals(query, flags)
+
+            def find(text):
+                match = compiled.search(text)
+                return match.start() if match else -1
+        else:
+            literals = [query]
+            needle = query if case_sensitive else query.lower()
+
+            def find(text):
+                return (text if case_sensitive else text.lower()).find(needle)
+
+        kinds = None if kinds is None else set(kinds)
+        with self._lock:
+            candidates = self._candidates(literals)
+            if candidates is None:
+                candidates = self._texts.keys()
+            texts = [self._texts[text_id] for text_id in candidates]
+
+        results = []
+        for kind, address, text in sorted(texts, key=lambda entry: (entry[0], entry[1])):
+            if kinds is not None and kind not in kinds:
+                continue
+            offset = find(text)
+            if offset == -1:
+                continue
+            results.append({"kind": kind, "address": address, "text": matching_line(text, offset) if kind == KIND_PSEUDOCODE else text})
+            if limit is not None and len(results) >= limit:
+                break
+        return results
+
+
+class DocumentSearchIndex(SearchIndex):
+    """SearchIndex of a live document: its strings and labels, the comments at its labels (or at every instruction
+    with scan_comments), and its pseudocode cached by a hopper_cache.DecompilationCache. Once installed, the names
+    and comments changed through hopper_api, and the pseudocode entering or leaving the cache, are reindexed.
+
+    Hopper cannot list the commented addresses, so without scan_comments the comments at unnamed addresses are only
+    found once set through hopper_api. Scanning every instruction costs a pass over the whole document
+    """
+
+    def __init__(self, document, string_table, decompilation_cache=None, scan_comments=False):
+        super().__init__()
+        self.executable_path = document.getExecutableFilePath()
+        self.decompilation_cache = decompilation_cache
+        self.scan_comments = scan_comments
+        self.executable = decompilation_cache.executable_key(document) if decompilation_cache else None
+        self._segment_class = None
+        self._segment_internals = set()
+        self.string_table = None
+        self.refresh_strings(string_table)
+
+        for segment in document.getSegmentsList():
+            self._segment_internals.add(segment.__internal_segment_addr__)
+            named_addresses = segment.getNamedAddresses()
+            for address, name in zip(named_addresses, segment.getLabelsList()):
+                self.add(KIND_LABEL, address, name)
+
+            if scan_comments:
+                commented_addresses = []
+                for procedure_index in range(segment.getProcedureCount()):
+                    for block in segment.getProcedureAtIndex(procedure_index).basicBlockIterator():
+                        commented_addresses.extend(address for address, _ in block.getInstructionList())
+            else:
+                commented_addresses = named_addresses
+            for address in commented_addresses:
+                self._index_comments(segment, address)
+
+        if decompilation_cache:
+            for entry_point, code in decompilation_cache.cached_pseudocode(self.executable):
+                self.add(KIND_PSEUDOCODE, entry_point, code)
+
+    def refresh_strings(self, string_table):
+        """Index the strings of a new StringTable of the document, the bytes of its string sections having changed"""
+        with self._lock:
+            if self.string_table is not None:
+                for address, _, _ in self.string_table.strings:
+                    self.remove(KIND_STRING, address)
+            for address, _, string in string_table.strings:
+                self.add(KIND_STRING, address, string)
+            self.string_table = string_table
+
+    def _index_comments(self, segment, address):
+        self.add(KIND_COMMENT, address, segment.getCommentAtAddress(address))
+        self.add(KIND_INLINE_COMMENT, address, segment.getInlineCommentAtAddress(address))
+
+    def install(self, segment_class):
+        """Follow the modifications made through hopper_api, and the decompilation cache. segment_class is hopper_api.Segment"""
+        self._segment_class = segment_class
+        segment_class.addModificationObserver(self.on_modification)
+        if self.decompilation_cache:
+            self.decompilation_cache.add_listener(self.on_pseudocode)
+
+    def uninstall(self, segment_class):
+        segment_class.removeModificationObserver(self.on_modification)
+        if self.decompilation_cache:
+            self.decompilation_cache.remove_listener(self.on_pseudocode)
+
+    def on_modification(self, segment_internal, addr, length, kind):
+        """hopper_api modification observer"""
+        if segment_internal not in self._segment_internals:
+            return
+        segment = self._segment_class(segment_internal)
+        if kind == self._segment_class.CHANGE_NAME:
+            self.add(KIND_LABEL, addr, segment.getNameAtAddress(addr))
+        elif kind == self._segment_class.CHANGE_COMMENT:
+            self._index_comments(segment, addr)
+
+    def on_pseudocode(self, executable, start, end, code):
+        """hopper_cache.DecompilationCache listener"""
+        if executable != self.executable:
+            return
+        if code is None:
+            self.remove_pseudocode(start, end)
+        else:
+            self.add(KIND_PSEUDOCODE, start, code, end)
+
+
+class SnapshotSearchIndex(SearchIndex):
+    """SearchIndex of a hopper_snapshot.Snapshot: its strings, labels, comments and exported pseudocode"""
+
+    def __init__(self, snapshot):
+        super().__init__()
+        for row in snapshot.query("SELECT address, value FROM strings"):
+            self.add(KIND_STRING, row["address"], row["value"])
+        for row in snapshot.query("SELECT address, name FROM labels"):
+            self.add(KIND_LABEL, row["address"], row["name"])
+        for row in snapshot.query("SELECT address, inline, text FROM comments"):
+            self.add(KIND_INLINE_COMMENT if row["inline"] else KIND_COMMENT, row["address"], row["text"])
+        for row in snapshot.query(
+            "SELECT procedures.entry_point, procedures.end, pseudocode.code FROM pseudocode JOIN procedures ON procedures.id = pseudocode.procedure_id"
+        ):
+            self.add(KIND_PSEUDOCODE, row["entry_point"], row["code"], row["end"])
+
+
+class SearchIndexCache(object):
+    """The DocumentSearchIndex of each document, built on first use and kept up to date from then on"""
+
+    def __init__(self):
+        self._indexes = {}
+        self._lock = threading.Lock()
+        self._segment_class = None
+
+    def install(self, segment_class):
+        """segment_class is hopper_api.Segment, which the indexes follow the modifications of"""
+        self._segment_class = segment_class
+
+    def uninstall(self, segment_class):
+        self.invalidate()
+        self._segment_class = None
+
+    def index(self, document, string_table, decompilation_cache=None, scan_comments=False):
+        """The index of a document. An index built without scan_comments is rebuilt when it is requested"""
+        key = document.__internal_document_addr__
+        with self._lock:
+            index = self._indexes.get(key)
+            # Hopper may reuse the internal address of a closed document
+            if (
+                index is not None
+                and index.executable_path == document.getExecutableFilePath()
+                and index.decompilation_cache is decompilation_cache
+                and (index.scan_comments or not scan_comments)
+            ):
+                if index.string_table is not string_table:
+                    index.refresh_strings(string_table)
+                return index
+
+        # Built outside of the lock: reading a whole document takes a while
+        index = DocumentSearchIndex(document, string_table, decompilation_cache, scan_comments)
+        if self._segment_class:
+            index.install(self._segment_class)
+        with self._lock:
+            previous = self._indexes.get(key)
+            self._indexes[key] = index
+        if previous is not None and self._segment_class:
+            previous.uninstall(self._segment_class)
+        return index
+
+    def invalidate(self, document=None):
+        """Drop the index of a document, or of every document"""
+        with self._lock:
+            if document is None:
+                dropped = list(self._indexes.values())
+                self._indexes = {}
+            else:
+                dropped = [self._indexes.pop(document.__internal_document_addr__, None)]
+        if self._segment_class:
+            for index in dropped:
+                if index is not None:
+                    index.uninstall(self._segment_class)
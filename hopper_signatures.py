@@ -0,0 +1,184 @@
+#
+#  hopper_signatures.py
+#  IDA Objc
+#
+#  Scanner matching many byte signatures with wildcards at once over the segments of a document
+#
+
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+# Bytes read from Hopper at once
+SCAN_CHUNK_SIZE = 4 * 1024 * 1024
+SCAN_WORKER_COUNT = 4
+
+
+class Signature(object):
+    """A byte pattern: the bytes at an address match if (byte & mask) == (value & mask) for each byte of the pattern"""
+
+    def __init__(self, values, mask=None):
+        values = bytes(values)
+        mask = bytes(b"\xff" * len(values)) if mask is None else bytes(mask)
+        if len(mask) != len(values):
+            raise ValueError("a signature mask must be as long as its bytes")
+        if not values:
+            raise ValueError("empty signature")
+        if not any(mask):
+            raise ValueError("a signature can not be made of wildcards only")
+        self.values = bytes(value & byte_mask for value, byte_mask in zip(values, mask))
+        self.mask = mask
+
+    def __len__(self):
+        return len(self.values)
+
+    def __repr__(self):
+        return f"Signature({self.to_string()!r})"
+
+    @classmethod
+    def from_string(cls, text):
+        """Parse an IDA or YARA style signature, like "48 8B ?? 05 ?? ?? ?? ?? E8". ? and ?? are wildcard bytes,
+        and 4? or ?4 wildcard one nibble. The spaces are optional between full bytes: "488B??05"
+        """
+        tokens = []
+        for token in text.split():
+            if token in ("?", "??"):
+                tokens.append(token)
+            elif len(token) % 2:
+                raise ValueError(f"invalid signature byte {token}")
+            else:
+                tokens.extend(token[index:index + 2] for index in range(0, len(token), 2))
+
+        values = bytearray()
+        mask = bytearray()
+        for token in tokens:
+            if token in ("?", "??"):
+                values.append(0)
+                mask.append(0)
+                continue
+            high, low = token[0], token[1]
+            try:
+                values.append((0 if high == "?" else int(high, 16) << 4) | (0 if low == "?" else int(low, 16)))
+            except ValueError:
+                raise ValueError(f"invalid signature byte {token}")
+            mask.append((0 if high == "?" else 0xF0) | (0 if low == "?" else 0x0F))
+        return cls(values, mask)
+
+    @classmethod
+    def parse(cls, signature):
+        """A Signature from its string form, or from a {"bytes", "mask"} dict of hex strings"""
+        if isinstance(signature, Signature):
+            return signature
+        if isinstance(signature, str):
+            return cls.from_string(signature)
+        if isinstance(signature, dict):
+            mask = signature.get("mask")
+            return cls(bytes.fromhex(signature["bytes"]), None if mask is None else bytes.fromhex(mask))
+        raise ValueError(f"invalid signature {signature!r}")
+
+    def to_string(self):
+        tokens = []
+        for value, mask in zip(self.values, self.mask):
+            if mask == 0xFF:
+                tokens.append(f"{value:02X}")
+            elif mask == 0:
+                tokens.append("??")
+            else:
+                tokens.append(
+                    ("?" if not mask & 0xF0 else f"{value >> 4:X}") + ("?" if not mask & 0x0F else f"{value & 0x0F:X}")
+                )
+        return " ".join(tokens)
+
+    def regex(self):
+        """bytes regex source matching the signature, for a pattern compiled with re.DOTALL"""
+        parts = []
+        for value, mask in zip(self.values, self.mask):
+            if mask == 0xFF:
+                parts.append(re.escape(bytes([value])))
+            elif mask == 0:
+                parts.append(b".")
+            else:
+                matching = bytes(byte for byte in range(256) if byte & mask == value)
+                parts.append(b"[" + b"".join(re.escape(bytes([byte])) for byte in matching) + b"]")
+        return b"".join(parts)
+
+
+class SignatureScanner(object):
+    """Matches a set of signatures in one pass. signatures maps pattern ids to Signature, or to anything
+    Signature.parse() accepts; a list is numbered from 0.
+
+    All the signatures are compiled into a single regex of lookaheads, which finds the addresses where at least
+    one of them matches, overlapping matches included. Each of those is then checked against the individual
+    signatures, so that several signatures matching at the same address are all reported.
+    """
+
+    def __init__(self, signatures):
+        if not isinstance(signatures, dict):
+            signatures = dict(enumerate(signatures))
+        if not signatures:
+            raise ValueError("no signature to scan for")
+        self.signatures = {pattern_id: Signature.parse(signature) for pattern_id, signature in signatures.items()}
+        self.max_length = max(len(signature) for signature in self.signatures.values())
+
+        self._patterns = [(pattern_id, re.compile(signature.regex(), re.DOTALL)) for pattern_id, signature in self.signatures.items()]
+        self._candidates = re.compile(b"(?=" + b"|".join(pattern.pattern for _, pattern in self._patterns) + b")", re.DOTALL)
+
+    def scan_bytes(self, data, address=0, end=None):
+        """(pattern id, address) of the matches starting in data[:end], data being read at address. The bytes
+        after end only complete the matches starting before it
+        """
+        end = len(data) if end is None else end
+        matches = []
+        for candidate in self._candidates.finditer(data):
+            offset = candidate.start()
+            if offset >= end:
+                break
+            for pattern_id, pattern in self._patterns:
+                if pattern.match(data, offset):
+                    matches.append((pattern_id, address + offset))
+        return matches
+
+    def scan_range(self, reader, start, end, chunk_size=SCAN_CHUNK_SIZE):
+        """(pattern id, address) of the matches starting in [start, end[, reading the bytes with reader(address, length).
+        Consecutive chunks overlap by the length of the longest signature, so that no match is lost at their boundaries
+        """
+        matches = []
+        overlap = self.max_length - 1
+        for chunk_start in range(start, end, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, end)
+            data = reader(chunk_start, min(chunk_end + overlap, end) - chunk_start)
+            if not data:
+                continue
+            matches.extend(self.scan_bytes(data, chunk_start, chunk_end - chunk_start))
+        return matches
+
+    def scan(self, document, segment_names=None, start=None, end=None, worker_count=SCAN_WORKER_COUNT, chunk_size=SCAN_CHUNK_SIZE):
+        """(pattern id, address) of the matches in the segments of a document, sorted by address. segment_names
+        restricts the scan to some segments, and start and end to an address range. The segments are scanned in parallel
+        """
+        ranges = []
+        for segment in document.getSegmentsList():
+            if segment_names is not None and segment.getName() not in segment_names:
+                continue
+            range_start = segment.getStartingAddress()
+            range_end = range_start + segment.getLength()
+            if start is not None:
+                range_start = max(range_start, start)
+            if end is not None:
+                range_end = min(range_end, end)
+            if range_start < range_end:
+                ranges.append((segment, range_start, range_end))
+
+        def scan_segment(entry):
+            segment, range_start, range_end = entry
+            return self.scan_range(segment.readBytes, range_start, range_end, chunk_size)
+
+        matches = []
+        if worker_count > 1 and len(ranges) > 1:
+            with ThreadPoolExecutor(max_workers=worker_count, thread_name_prefix="hopper_signatures") as executor:
+                for segment_matches in executor.map(scan_segment, ranges):
+                    matches.extend(segment_matches)
+        else:
+            for entry in ranges:
+                matches.extend(scan_segment(entry))
+        matches.sort(key=lambda match: match[1])
+        return matches
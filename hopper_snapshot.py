@@ -0,0 +1,370 @@
+#
+#  hopper_snapshot.py
+#  IDA Objc
+#
+#  Export a whole Hopper document to a sqlite snapshot once, then query it offline without Hopper
+#
+
+import json
+import os
+import sqlite3
+
+from hopper_strings import StringTable
+
+SCHEMA_VERSION = 3
+
+# sqlite integers are signed 64 bits: addresses are stored minus ADDRESS_OFFSET, which keeps them in order
+ADDRESS_OFFSET = 1 << 63
+# Segment.BAD_ADDRESS, returned by Hopper when there is no address. Stored as NULL
+BAD_ADDRESS = -1
+# Columns and document properties holding addresses
+ADDRESS_COLUMNS = frozenset(("address", "start", "end", "entry_point", "successor_address", "from_address", "to_address"))
+
+SCHEMA = """
+CREATE TABLE document (key TEXT PRIMARY KEY, value);
+CREATE TABLE segments (id INTEGER PRIMARY KEY, name TEXT, start INTEGER, end INTEGER, file_offset INTEGER);
+CREATE TABLE sections (id INTEGER PRIMARY KEY, segment_id INTEGER, name TEXT, start INTEGER, end INTEGER, flags INTEGER);
+CREATE TABLE labels (address INTEGER, name TEXT, demangled TEXT, segment_id INTEGER);
+CREATE TABLE procedures (id INTEGER PRIMARY KEY, entry_point INTEGER, end INTEGER, segment_id INTEGER, name TEXT, signature TEXT);
+CREATE TABLE basic_blocks (procedure_id INTEGER, block_index INTEGER, start INTEGER, end INTEGER, PRIMARY KEY (procedure_id, block_index));
+CREATE TABLE block_successors (procedure_id INTEGER, block_index INTEGER, successor_index INTEGER, successor_address INTEGER);
+CREATE TABLE call_references (procedure_id INTEGER, from_address INTEGER, to_address INTEGER, call_type INTEGER);
+CREATE TABLE instructions (
+    address INTEGER PRIMARY KEY, procedure_id INTEGER, length INTEGER, mnemonic TEXT, operands TEXT, conditional_jump INTEGER, unconditional_jump INTEGER
+);
+CREATE TABLE strings (address INTEGER PRIMARY KEY, section TEXT, value TEXT);
+CREATE TABLE comments (address INTEGER, inline INTEGER, text TEXT);
+CREATE TABLE tags (address INTEGER, procedure_id INTEGER, block_index INTEGER, name TEXT);
+CREATE TABLE pseudocode (procedure_id INTEGER PRIMARY KEY, code TEXT);
+"""
+
+INDEXES = """
+CREATE INDEX segments_start ON segments (start);
+CREATE INDEX sections_start ON sections (start);
+CREATE INDEX labels_address ON labels (address);
+CREATE INDEX labels_name ON labels (name);
+CREATE INDEX labels_demangled ON labels (demangled);
+CREATE INDEX procedures_entry_point ON procedures (entry_point);
+CREATE INDEX procedures_name ON procedures (name);
+CREATE INDEX basic_blocks_start ON basic_blocks (start);
+CREATE INDEX call_references_from ON call_references (from_address);
+CREATE INDEX call_references_to ON call_references (to_address);
+CREATE INDEX call_references_procedure ON call_references (procedure_id);
+CREATE INDEX instructions_procedure ON instructions (procedure_id);
+CREATE INDEX comments_address ON comments (address);
+CREATE INDEX tags_address ON tags (address);
+CREATE INDEX tags_name ON tags (name);
+"""
+
+
+def stored_address(address):
+    """The sqlite value of an address. None and BAD_ADDRESS are NULL"""
+    if address is None or address == BAD_ADDRESS:
+        return None
+    return address - ADDRESS_OFFSET
+
+
+def loaded_address(value):
+    """The address of a sqlite value"""
+    return None if value is None else value + ADDRESS_OFFSET
+
+
+def loaded_row(row):
+    """A sqlite row as a dict, its address columns converted back to addresses"""
+    row = dict(row)
+    for column in ADDRESS_COLUMNS.intersection(row):
+        row[column] = loaded_address(row[column])
+    return row
+
+
+def export_snapshot(document, path, instructions=True, pseudocode=False, decompilation_cache=None, progress=None):
+    """Walk the document once, and write everything the snapshot tables hold to a new sqlite file at path.
+    instructions: also walk every instruction of every procedure, for disassembly, comments and address tags
+    pseudocode: also decompile every procedure, through decompilation_cache if given
+    progress: called with (procedures done, procedure count)
+
+    The snapshot is written next to path, and replaces the file at path once complete: readers never see a
+    partial snapshot, and an export that failed leaves the previous one in place.
+    """
+    temporary_path = path + ".tmp"
+    if os.path.exists(temporary_path):
+        os.remove(temporary_path)
+    try:
+        _export(document, temporary_path, instructions, pseudocode, decompilation_cache, progress)
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+
+def _export(document, path, instructions, pseudocode, decompilation_cache, progress):
+    database = sqlite3.connect(path)
+    database.executescript("PRAGMA journal_mode = OFF; PRAGMA synchronous = OFF;")
+    database.executescript(SCHEMA)
+
+    document_properties = {
+        "schema_version": SCHEMA_VERSION,
+        "name": document.getDocumentName(),
+        "executable_path": document.getExecutableFilePath(),
+        "entry_point": stored_address(document.getEntryPoint()),
+        "is_64_bits": 1 if document.is64Bits() else 0,
+    }
+    database.executemany("INSERT INTO document VALUES (?, ?)", document_properties.items())
+
+    segments = []
+    section_rows = []
+    for segment_id in range(document.getSegmentCount()):
+        segment = document.getSegment(segment_id)
+        if segment is None:
+            continue
+        segments.append((segment_id, segment))
+        segment_start = segment.getStartingAddress()
+        database.execute(
+            "INSERT INTO segments VALUES (?, ?, ?, ?, ?)",
+            (segment_id, segment.getName(), stored_address(segment_start), stored_address(segment_start + segment.getLength()), segment.getFileOffset()),
+        )
+
+        for section_index in range(segment.getSectionCount()):
+            section = segment.getSection(section_index)
+            if section is None:
+                continue
+            section_start = section.getStartingAddress()
+            section_rows.append(
+                (segment_id, section.getName(), stored_address(section_start), stored_address(section_start + section.getLength()), section.getFlags())
+            )
+
+        database.executemany(
+            "INSERT INTO labels VALUES (?, ?, ?, ?)",
+            (
+                (stored_address(address), name, segment.getDemangledNameAtAddress(address), segment_id)
+                for address, name in zip(segment.getNamedAddresses(), segment.getLabelsList())
+            ),
+        )
+
+    database.executemany("INSERT INTO sections (segment_id, name, start, end, flags) VALUES (?, ?, ?, ?, ?)", section_rows)
+    database.executemany(
+        "INSERT OR IGNORE INTO strings VALUES (?, ?, ?)",
+        ((stored_address(address), section, value) for address, section, value in StringTable(document).strings),
+    )
+
+    procedure_count = sum(segment.getProcedureCount() for _, segment in segments)
+    procedure_id = 0
+    for segment_id, segment in segments:
+        for procedure_index in range(segment.getProcedureCount()):
+            procedure = segment.getProcedureAtIndex(procedure_index)
+            _export_procedure(database, document, segment_id, segment, procedure, procedure_id, instructions, pseudocode, decompilation_cache)
+            procedure_id += 1
+            if progress:
+                progress(procedure_id, procedure_count)
+
+    database.executescript(INDEXES)
+    database.commit()
+    database.close()
+
+
+def _export_procedure(database, document, segment_id, segment, procedure, procedure_id, instructions, pseudocode, decompilation_cache):
+    entry_point = procedure.getEntryPoint()
+
+    end = entry_point + 1
+    block_rows = []
+    successor_rows = []
+    for block_index in range(procedure.getBasicBlockCount()):
+        block = procedure.getBasicBlock(block_index)
+        block_start = block.getStartingAddress()
+        block_end = block.getEndingAddress()
+        end = max(end, block_end)
+        block_rows.append((block_index, block_start, block_end))
+        for successor_index in range(block.getSuccessorCount()):
+            successor_rows.append(
+                (procedure_id, block_index, block.getSuccessorIndexAtIndex(successor_index), stored_address(block.getSuccessorAddressAtIndex(successor_index)))
+            )
+        for tag_index in range(block.getTagCount()):
+            tag = block.getTagAtIndex(tag_index)
+            if tag:
+                database.execute("INSERT INTO tags VALUES (?, ?, ?, ?)", (stored_address(block_start), procedure_id, block_index, tag.getName()))
+
+    database.execute(
+        "INSERT INTO procedures VALUES (?, ?, ?, ?, ?, ?)",
+        (procedure_id, stored_address(entry_point), stored_address(end), segment_id, segment.getNameAtAddress(entry_point), procedure.signatureString()),
+    )
+    database.executemany(
+        "INSERT INTO basic_blocks VALUES (?, ?, ?, ?)",
+        ((procedure_id, block_index, stored_address(block_start), stored_address(block_end)) for block_index, block_start, block_end in block_rows),
+    )
+    database.executemany("INSERT INTO block_successors VALUES (?, ?, ?, ?)", successor_rows)
+    database.executemany(
+        "INSERT INTO call_references VALUES (?, ?, ?, ?)",
+        (
+            (procedure_id, stored_address(reference.fromAddress()), stored_address(reference.toAddress()), reference.type())
+            for reference in procedure.getAllCallees() or []
+        ),
+    )
+    for tag_index in range(procedure.getTagCount()):
+        tag = procedure.getTagAtIndex(tag_index)
+        if tag:
+            database.execute("INSERT INTO tags VALUES (?, ?, NULL, ?)", (stored_address(entry_point), procedure_id, tag.getName()))
+
+    if instructions:
+        for _, block_start, block_end in block_rows:
+            cursor = block_start
+            while cursor < block_end:
+                instruction = segment.getInstructionAtAddress(cursor)
+                if instruction is None:
+                    break
+                # operands is the JSON list of the formatted operands
+                database.execute(
+                    "INSERT OR IGNORE INTO instructions VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        stored_address(cursor),
+                        procedure_id,
+                        instruction.getInstructionLength(),
+                        instruction.getInstructionString(),
+                        json.dumps(instruction.getFormattedArguments()),
+                        1 if instruction.isAConditionalJump() else 0,
+                        1 if instruction.isAnInconditionalJump() else 0,
+                    ),
+                )
+                _export_address_annotations(database, document, segment, cursor)
+                cursor += max(instruction.getInstructionLength(), 1)
+
+    if pseudocode:
+        code = decompilation_cache.decompile(document, procedure) if decompilation_cache else procedure.decompile()
+        if code is not None:
+            database.execute("INSERT INTO pseudocode VALUES (?, ?)", (procedure_id, code))
+
+
+def _export_address_annotations(database, document, segment, address):
+    comment = segment.getCommentAtAddress(address)
+    if comment:
+        database.execute("INSERT INTO comments VALUES (?, 0, ?)", (stored_address(address), comment))
+    inline_comment = segment.getInlineCommentAtAddress(address)
+    if inline_comment:
+        database.execute("INSERT INTO comments VALUES (?, 1, ?)", (stored_address(address), inline_comment))
+    for tag_index in range(document.getTagCountAtAddress(address)):
+        tag = document.getTagAtAddressByIndex(address, tag_index)
+        if tag:
+            database.execute("INSERT INTO tags VALUES (?, NULL, NULL, ?)", (stored_address(address), tag.getName()))
+
+
+class Snapshot(object):
+    """Read-only queries over an exported snapshot. Rows are returned as dicts. Safe to open from many processes at once.
+    Addresses are stored offset by ADDRESS_OFFSET: SQL comparing them to values goes through stored_address()
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.database = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        self.database.row_factory = sqlite3.Row
+        schema_version = self.property("schema_version")
+        if schema_version != SCHEMA_VERSION:
+            raise Exception(f"unsupported snapshot schema version {schema_version}")
+
+    def close(self):
+        self.database.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def query(self, sql, parameters=()):
+        """Run any read-only SQL against the snapshot tables. The columns named like the address columns are
+        converted back to addresses
+        """
+        return [loaded_row(row) for row in self.database.execute(sql, parameters)]
+
+    def _one(self, sql, parameters=()):
+        row = self.database.execute(sql, parameters).fetchone()
+        return loaded_row(row) if row else None
+
+    def property(self, key):
+        row = self.database.execute("SELECT value FROM document WHERE key = ?", (key,)).fetchone()
+        if not row:
+            return None
+        return loaded_address(row[0]) if key in ADDRESS_COLUMNS else row[0]
+
+    def document_name(self):
+        return self.property("name")
+
+    def executable_path(self):
+        return self.property("executable_path")
+
+    def segments(self):
+        return self.query("SELECT * FROM segments ORDER BY start")
+
+    def sections(self):
+        return self.query("SELECT * FROM sections ORDER BY start")
+
+    def segment_at(self, address):
+        address = stored_address(address)
+        return self._one("SELECT * FROM segments WHERE start <= ? AND ? < end ORDER BY start DESC LIMIT 1", (address, address))
+
+    def section_at(self, address):
+        address = stored_address(address)
+        return self._one("SELECT * FROM sections WHERE start <= ? AND ? < end ORDER BY start DESC LIMIT 1", (address, address))
+
+    def labels(self, start=None, end=None):
+        return self.query("SELECT * FROM labels WHERE address BETWEEN ? AND ? ORDER BY address", _address_range(start, end))
+
+    def label_at(self, address):
+        return self._one("SELECT * FROM labels WHERE address = ?", (stored_address(address),))
+
+    def address_of(self, name):
+        """Address of a label, by mangled or demangled name"""
+        row = self.database.execute("SELECT address FROM labels WHERE name = ? OR demangled = ? LIMIT 1", (name, name)).fetchone()
+        return loaded_address(row[0]) if row else None
+
+    def procedures(self, start=None, end=None):
+        return self.query("SELECT * FROM procedures WHERE entry_point BETWEEN ? AND ? ORDER BY entry_point", _address_range(start, end))
+
+    def procedure_at(self, address):
+        """The procedure containing an address"""
+        address = stored_address(address)
+        return self._one(
+            "SELECT procedures.* FROM basic_blocks JOIN procedures ON procedures.id = basic_blocks.procedure_id "
+            "WHERE basic_blocks.start <= ? AND ? < basic_blocks.end ORDER BY basic_blocks.start DESC LIMIT 1",
+            (address, address),
+        ) or self._one("SELECT * FROM procedures WHERE entry_point = ?", (address,))
+
+    def basic_blocks(self, procedure_id):
+        return self.query("SELECT * FROM basic_blocks WHERE procedure_id = ? ORDER BY block_index", (procedure_id,))
+
+    def successors(self, procedure_id):
+        return self.query("SELECT * FROM block_successors WHERE procedure_id = ? ORDER BY block_index, successor_index", (procedure_id,))
+
+    def callees(self, procedure_id):
+        return self.query("SELECT * FROM call_references WHERE procedure_id = ? ORDER BY from_address", (procedure_id,))
+
+    def callers(self, address):
+        return self.query("SELECT * FROM call_references WHERE to_address = ? ORDER BY from_address", (stored_address(address),))
+
+    def instructions(self, procedure_id):
+        return self.query("SELECT * FROM instructions WHERE procedure_id = ? ORDER BY address", (procedure_id,))
+
+    def strings(self, start=None, end=None):
+        return self.query("SELECT * FROM strings WHERE address BETWEEN ? AND ? ORDER BY address", _address_range(start, end))
+
+    def comments_at(self, address):
+        return self.query("SELECT * FROM comments WHERE address = ?", (stored_address(address),))
+
+    def tags_at(self, address):
+        return [row["name"] for row in self.query("SELECT name FROM tags WHERE address = ?", (stored_address(address),))]
+
+    def addresses_tagged(self, name):
+        return [row["address"] for row in self.query("SELECT DISTINCT address FROM tags WHERE name = ? ORDER BY address", (name,))]
+
+    def pseudocode(self, procedure_id):
+        row = self.database.execute("SELECT code FROM pseudocode WHERE procedure_id = ?", (procedure_id,)).fetchone()
+        return row[0] if row else None
+
+
+def _address_range(start, end):
+    """Stored bounds of [start, end[ for BETWEEN, whose upper bound is included"""
+    start = 0 if start is None else start
+    last = (1 << 64) - 1 if end is None else end - 1
+    if last < start:
+        # Empty: no stored address is both >= 0 and <= -1
+        return (0, -1)
+    return (stored_address(start), stored_address(last))
@@ -0,0 +1,190 @@
+#
+#  hopper_strings.py
+#  IDA Objc
+#
+#  Bulk extraction of the strings of the Mach-O string sections, one read per section
+#
+
+import bisect
+import struct
+import threading
+
+# Sections holding NUL terminated strings
+CSTRING_SECTIONS = ("__cstring", "__objc_methname", "__objc_classname", "__objc_methtype")
+# Sections holding NUL terminated UTF-16 strings
+USTRING_SECTIONS = ("__ustring",)
+# Sections holding CFString literal records, pointing at a string of one of the above
+CFSTRING_SECTIONS = ("__cfstring",)
+STRING_SECTIONS = CSTRING_SECTIONS + USTRING_SECTIONS + CFSTRING_SECTIONS
+
+# CFString record: isa, flags, characters pointer, length
+_CFSTRING_RECORD_64 = struct.Struct("<QQQQ")
+_CFSTRING_RECORD_32 = struct.Struct("<IIII")
+# Set in the flags of the records whose characters are UTF-16
+_CFSTRING_UNICODE_FLAG = 0x10
+# Chained fixups keep the target vmaddr, or its offset from the image base, in the low bits of a pointer
+_CHAINED_POINTER_TARGET_MASK = (1 << 36) - 1
+
+
+def split_cstrings(start, data):
+    """Yield (address, string) for each NUL terminated string of data, read at start"""
+    offset = 0
+    while offset < len(data):
+        terminator = data.find(b"\0", offset)
+        if terminator == -1:
+            terminator = len(data)
+        if terminator > offset:
+            yield start + offset, data[offset:terminator].decode("utf-8", errors="replace")
+        offset = terminator + 1
+
+
+def split_ustrings(start, data):
+    """Yield (address, string) for each NUL terminated UTF-16 little endian string of data, read at start"""
+    offset = 0
+    while offset + 1 < len(data):
+        terminator = data.find(b"\0\0", offset)
+        # The terminator is a whole character
+        while terminator != -1 and (terminator - offset) % 2:
+            terminator = data.find(b"\0\0", terminator + 1)
+        if terminator == -1:
+            terminator = len(data) - (len(data) - offset) % 2
+        if terminator > offset:
+            yield start + offset, data[offset:terminator].decode("utf-16-le", errors="replace")
+        offset = terminator + 2
+
+
+class StringTable(object):
+    """Every string of the string sections of a document, extracted at once. strings is the sorted list of
+    (address, section name, string). The string of a CFString is listed at the address of its record
+    """
+
+    def __init__(self, document):
+        self.executable_path = document.getExecutableFilePath()
+        # (internal segment, start, end) of the sections read, to tell which modifications matter
+        self.section_ranges = []
+
+        strings = []
+        characters = {}
+        cfstring_sections = []
+        image_base = None
+        for segment in document.getSegmentsList():
+            if image_base is None or segment.getStartingAddress() < image_base:
+                image_base = segment.getStartingAddress()
+            for section_index in range(segment.getSectionCount()):
+                section = segment.getSection(section_index)
+                if section is None or section.getName() not in STRING_SECTIONS:
+                    continue
+                name = section.getName()
+                start = section.getStartingAddress()
+                self.section_ranges.append((segment.__internal_segment_addr__, start, start + section.getLength()))
+                data = segment.readBytes(start, section.getLength())
+                if not data:
+                    continue
+
+                if name in CFSTRING_SECTIONS:
+                    # Resolved once the strings they point at are known
+                    cfstring_sections.append((name, start, data))
+                    continue
+                split = split_ustrings if name in USTRING_SECTIONS else split_cstrings
+                for address, string in split(start, data):
+                    strings.append((address, name, string))
+                    characters[address] = string
+
+        record = _CFSTRING_RECORD_64 if document.is64Bits() else _CFSTRING_RECORD_32
+        for name, start, data in cfstring_sections:
+            for offset in range(0, len(data) - record.size + 1, record.size):
+                _, flags, pointer, length = record.unpack_from(data, offset)
+                if pointer == 0:
+                    continue
+                string = self._cfstring_characters(document, characters, image_base or 0, pointer, length, flags & _CFSTRING_UNICODE_FLAG)
+                if string is not None:
+                    strings.append((start + offset, name, string))
+
+        strings.sort(key=lambda entry: entry[0])
+        self.strings = strings
+        self._addresses = [entry[0] for entry in strings]
+
+    @staticmethod
+    def _cfstring_characters(document, characters, image_base, pointer, length, unicode):
+        candidates = (pointer, pointer & _CHAINED_POINTER_TARGET_MASK, image_base + (pointer & 0xFFFFFFFF))
+        for address in candidates:
+            string = characters.get(address)
+            if string is not None:
+                return string
+
+        # The characters are outside of the string sections
+        size = length * 2 if unicode else length
+        for address in candidates:
+            data = document.readBytes(address, size) if size > 0 else False
+            if data:
+                return data.decode("utf-16-le" if unicode else "utf-8", errors="replace")
+        return None
+
+    def in_sections(self, section_names=None):
+        """(address, section name, string) of the strings of some sections, all of them if section_names is None"""
+        if section_names is None:
+            return iter(self.strings)
+        section_names = set(section_names)
+        return (entry for entry in self.strings if entry[1] in section_names)
+
+    def at(self, address):
+        """(address, section name, string) of the string at an address, or None"""
+        index = bisect.bisect_left(self._addresses, address)
+        if index < len(self._addresses) and self._addresses[index] == address:
+            return self.strings[index]
+        return None
+
+    def overlaps(self, segment_internal, start, end):
+        for section_segment, section_start, section_end in self.section_ranges:
+            if section_segment == segment_internal and start < section_end and section_start < end:
+                return True
+        return False
+
+
+class StringTableCache(object):
+    """The StringTable of each document, built on first use. Once installed, writes made through hopper_api
+    to a string section drop the table of its document
+    """
+
+    def __init__(self):
+        self._tables = {}
+        self._lock = threading.Lock()
+        self._change_bytes = None
+
+    def install(self, segment_class):
+        """Listen to the modifications made through hopper_api. segment_class is hopper_api.Segment"""
+        self._change_bytes = segment_class.CHANGE_BYTES
+        segment_class.addModificationObserver(self.on_modification)
+
+    def uninstall(self, segment_class):
+        segment_class.removeModificationObserver(self.on_modification)
+
+    def table(self, document):
+        key = document.__internal_document_addr__
+        with self._lock:
+            table = self._tables.get(key)
+            # Hopper may reuse the internal address of a closed document
+            if table is not None and table.executable_path == document.getExecutableFilePath():
+                return table
+
+        table = StringTable(document)
+        with self._lock:
+            self._tables[key] = table
+        return table
+
+    def invalidate(self, document=None):
+        """Drop the table of a document, or of every document"""
+        with self._lock:
+            if document is None:
+                self._tables = {}
+            else:
+                self._tables.pop(document.__internal_document_addr__, None)
+
+    def on_modification(self, segment_internal, addr, length, kind):
+        """hopper_api modification observer. Only the bytes matter, the strings are read regardless of their types"""
+        if kind != self._change_bytes:
+            return
+        with self._lock:
+            for key, table in list(self._tables.items()):
+                if table.overlaps(segment_internal, addr, addr + max(length, 1)):
+                    del self._tables[key]
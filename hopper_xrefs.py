@@ -0,0 +1,268 @@
+#
+#  hopper_xrefs.py
+#  IDA Objc
+#
+#  Document-wide cross-reference index in sorted arrays, answering range and batch queries without bridge calls
+#
+
+import bisect
+import threading
+from array import array
+
+# Query directions: the references to an address, or from it
+TO = "to"
+FROM = "from"
+
+# Mach-O section types (flags & 0xFF) of the zero filled sections, which have no bytes to make references
+ZEROFILL_SECTION_TYPES = (0x1, 0xC, 0x12)
+ZEROFILL_SECTION_NAMES = ("__bss", "__common", ".bss", ".tbss")
+# Segment types of the bytes starting an object, which may make references
+DEFINED_TYPE_NAMES = ("TYPE_INT8", "TYPE_INT16", "TYPE_INT32", "TYPE_INT64", "TYPE_ASCII", "TYPE_UNICODE", "TYPE_ALIGN", "TYPE_CODE", "TYPE_PROCEDURE", "TYPE_STRUCTURE")
+
+
+class XrefIndex(object):
+    """Every cross reference of a document, gathered once by walking the objects of each segment with
+    Segment.getReferencesFromAddress().
+
+    The references are kept twice, as parallel sorted arrays: forward_sources/forward_targets ordered by
+    (source, target), and reverse_targets/reverse_sources ordered by (target, source). Queries on an address
+    or a range of addresses are then bisections. Once installed, references added or removed through hopper_api
+    are applied to the arrays directly, and the ranges whose bytes or types change are gathered again on the next query.
+
+    The walk skips the zero filled sections, and jumps over each run of undefined bytes at once.
+    """
+
+    def __init__(self, document):
+        self.executable_path = document.getExecutableFilePath()
+        self._lock = threading.RLock()
+        self._segments = {segment.__internal_segment_addr__: segment for segment in document.getSegmentsList()}
+        self._zerofill_ranges = {internal: self._zerofill(segment) for internal, segment in self._segments.items()}
+        # (internal segment, start, end) of the modifications made since the last refresh
+        self._modified_ranges = []
+        self._change_bytes = None
+        self._change_type = None
+
+        references = []
+        for segment in self._segments.values():
+            start = segment.getStartingAddress()
+            references.extend(self._gather(segment, start, start + segment.getLength()))
+        self._load(references)
+
+    @staticmethod
+    def _zerofill(segment):
+        """Sorted (start, end) of the zero filled sections of a segment"""
+        ranges = []
+        for section_index in range(segment.getSectionCount()):
+            section = segment.getSection(section_index)
+            if section is None:
+                continue
+            name = section.getName() or ""
+            section_type = (section.getFlags() or 0) & 0xFF
+            # Only Mach-O sections, named __*, have their type in their flags
+            if name in ZEROFILL_SECTION_NAMES or (name.startswith("__") and section_type in ZEROFILL_SECTION_TYPES):
+                section_start = section.getStartingAddress()
+                ranges.append((section_start, section_start + section.getLength()))
+        ranges.sort()
+        return ranges
+
+    @staticmethod
+    def _next_defined(segment, address, end):
+        """First address after address, and before end, starting an object. end if there is none"""
+        next_address = end
+        for type_name in DEFINED_TYPE_NAMES:
+            found = segment.getNextAddressWithType(address, getattr(segment, type_name))
+            if found is not None and found != segment.BAD_ADDRESS and address < found < next_address:
+                next_address = found
+        return next_address
+
+    def _gather(self, segment, start, end):
+        """(source, target) of the references made by the objects starting in [start, end["""
+        references = []
+        undefined_types = (segment.TYPE_UNDEFINED, segment.TYPE_OUTSIDE)
+        zerofill_ranges = self._zerofill_ranges.get(segment.__internal_segment_addr__, ())
+        address = start
+        while address < end:
+            zerofill_end = next((range_end for range_start, range_end in zerofill_ranges if range_start <= address < range_end), None)
+            if zerofill_end is not None:
+                address = zerofill_end
+                continue
+            length = segment.getObjectLength(address)
+            # Undefined bytes are objects of one byte: look for the end of their run instead of walking it
+            if (length is None or length <= 1) and segment.getTypeAtAddress(address) in undefined_types:
+                address = self._next_defined(segment, address, end)
+                continue
+            for target in segment.getReferencesFromAddress(address) or ():
+                references.append((address, target))
+            address += max(length or 1, 1)
+        return references
+
+    def _load(self, references):
+        references = sorted(set(references))
+        self.forward_sources = array("Q", (source for source, _ in references))
+        self.forward_targets = array("Q", (target for _, target in references))
+        references.sort(key=lambda reference: (reference[1], reference[0]))
+        self.reverse_targets = array("Q", (target for _, target in references))
+        self.reverse_sources = array("Q", (source for source, _ in references))
+
+    def __len__(self):
+        return len(self.forward_sources)
+
+    def install(self, segment_class):
+        """Follow the references and modifications made through hopper_api. segment_class is hopper_api.Segment"""
+        self._change_bytes = segment_class.CHANGE_BYTES
+        self._change_type = segment_class.CHANGE_TYPE
+        segment_class.addReferenceObserver(self.on_reference)
+        segment_class.addModificationObserver(self.on_modification)
+
+    def uninstall(self, segment_class):
+        segment_class.removeReferenceObserver(self.on_reference)
+        segment_class.removeModificationObserver(self.on_modification)
+
+    def on_reference(self, segment_internal, addr, referenced, added):
+        """hopper_api reference observer"""
+        if segment_internal not in self._segments:
+            return
+        with self._lock:
+            if added:
+                self._insert(addr, referenced)
+            else:
+                self._delete(addr, referenced)
+
+    def on_modification(self, segment_internal, addr, length, kind):
+        """hopper_api modification observer. Rewriting or retyping bytes changes the references they make"""
+        if segment_internal not in self._segments or kind not in (self._change_bytes, self._change_type):
+            return
+        with self._lock:
+            self._modified_ranges.append((segment_internal, addr, addr + max(length, 1)))
+
+    @staticmethod
+    def _slot(keys, values, key, value):
+        """Index of (key, value) in the parallel arrays sorted by (key, value), and whether it is there"""
+        low = bisect.bisect_left(keys, key)
+        high = bisect.bisect_right(keys, key, low)
+        slot = bisect.bisect_left(values, value, low, high)
+        return slot, slot < high and values[slot] == value
+
+    def _insert(self, source, target):
+        slot, found = self._slot(self.forward_sources, self.forward_targets, source, target)
+        if found:
+            return
+        self.forward_sources.insert(slot, source)
+        self.forward_targets.insert(slot, target)
+        slot, _ = self._slot(self.reverse_targets, self.reverse_sources, target, source)
+        self.reverse_targets.insert(slot, target)
+        self.reverse_sources.insert(slot, source)
+
+    def _delete(self, source, target):
+        slot, found = self._slot(self.forward_sources, self.forward_targets, source, target)
+        if not found:
+            return
+        del self.forward_sources[slot]
+        del self.forward_targets[slot]
+        slot, found = self._slot(self.reverse_targets, self.reverse_sources, target, source)
+        if found:
+            del self.reverse_targets[slot]
+            del self.reverse_sources[slot]
+
+    def refresh(self):
+        """Gather the references of the modified ranges again. Returns the number of ranges gathered"""
+        with self._lock:
+            modified_ranges, self._modified_ranges = self._modified_ranges, []
+            for segment_internal, start, end in modified_ranges:
+                segment = self._segments[segment_internal]
+                # Walk from the start of the object overlapping the range, so that the walk stays aligned on objects
+                object_start = segment.getInstructionStart(start)
+                if object_start is not None and object_start != segment.BAD_ADDRESS and object_start <= start:
+                    start = object_start
+                for source, target in self._range(self.forward_sources, self.forward_targets, start, end):
+                    self._delete(source, target)
+                for source, target in self._gather(segment, start, end):
+                    self._insert(source, target)
+            return len(modified_ranges)
+
+    @staticmethod
+    def _range(keys, values, start, end):
+        low = bisect.bisect_left(keys, start)
+        high = bisect.bisect_left(keys, end, low)
+        return list(zip(keys[low:high], values[low:high]))
+
+    def references_from(self, address):
+        """Sorted addresses referenced by address"""
+        return [target for _, target in self.references_from_range(address, address + 1)]
+
+    def references_to(self, address):
+        """Sorted addresses referencing address"""
+        return [source for _, source in self.references_to_range(address, address + 1)]
+
+    def references_from_range(self, start, end):
+        """(source, target) of the references made from [start, end[, sorted by source"""
+        self.refresh()
+        with self._lock:
+            return self._range(self.forward_sources, self.forward_targets, start, end)
+
+    def references_to_range(self, start, end):
+        """(target, source) of the references into [start, end[, sorted by target"""
+        self.refresh()
+        with self._lock:
+            return self._range(self.reverse_targets, self.reverse_sources, start, end)
+
+    def references_from_many(self, addresses):
+        """Dict of address -> sorted addresses it references, for each of addresses"""
+        self.refresh()
+        with self._lock:
+            return {address: [target for _, target in self._range(self.forward_sources, self.forward_targets, address, address + 1)] for address in addresses}
+
+    def references_to_many(self, addresses):
+        """Dict of address -> sorted addresses referencing it, for each of addresses"""
+        self.refresh()
+        with self._lock:
+            return {address: [source for _, source in self._range(self.reverse_targets, self.reverse_sources, address, address + 1)] for address in addresses}
+
+
+class XrefIndexCache(object):
+    """The XrefIndex of each document, built on first use and kept up to date from then on"""
+
+    def __init__(self):
+        self._indexes = {}
+        self._lock = threading.Lock()
+        self._segment_class = None
+
+    def install(self, segment_class):
+        """segment_class is hopper_api.Segment, which the indexes follow the references and modifications of"""
+        self._segment_class = segment_class
+
+    def uninstall(self, segment_class):
+        self.invalidate()
+        self._segment_class = None
+
+    def index(self, document):
+        key = document.__internal_document_addr__
+        with self._lock:
+            index = self._indexes.get(key)
+            # Hopper may reuse the internal address of a closed document
+            if index is not None and index.executable_path == document.getExecutableFilePath():
+                return index
+
+        # Built outside of the lock: walking a whole document takes a while
+        index = XrefIndex(document)
+        if self._segment_class:
+            index.install(self._segment_class)
+        with self._lock:
+            previous = self._indexes.get(key)
+            self._indexes[key] = index
+        if previous is not None and self._segment_class:
+            previous.uninstall(self._segment_class)
+        return index
+
+    def invalidate(self, document=None):
+        """Drop the index of a document, or of every document. Needed after the background analysis added references"""
+        with self._lock:
+            if document is None:
+                dropped = list(self._indexes.values())
+                self._indexes = {}
+            else:
+                dropped = [self._indexes.pop(document.__internal_document_addr__, None)]
+        if self._segment_class:
+            for index in dropped:
+                if index is not None:
+                    index.uninstall(self._segment_class)
@@ -1,4 +1,4 @@
-import json
+import functools
 import logging
 import subprocess
 import time
@@ -7,6 +7,7 @@ from pathlib import Path
 
 import requests
 
+from hopper_client import HopperClient, HopperClientError
 from hopper_proxy import TerminateHopper
 
 logger = logging.getLogger("hopper_launch")
@@ -22,18 +23,26 @@ TerminateHopper.kill_hopper()
 hopper_launcher_path = "/Applications/Hopper Disassembler v4.app/Contents/MacOS/hopper"
 hopper_path = "/Applications/Hopper Disassembler v4.app/Contents/MacOS/Hopper Disassembler v4"
 
+# Seconds each /events long poll waits for the documents to change
+EVENTS_WAIT = 20
+# Polling delays, doubling from the initial one, while the server is unreachable or has no /events
+BACKOFF_INITIAL_DELAY = 0.25
+BACKOFF_MAX_DELAY = 5
+
+
+@functools.lru_cache(maxsize=None)
+def hopper_client(port):
+    """A pooled client for the server on this port"""
+    return HopperClient(port=port)
+
 
 def server_list_documents(port):
-    endpoint = f"http://localhost:{port}/documents"
-    response = requests.get(endpoint)
-    return response.json().get("data")
+    return hopper_client(port).documents()
 
 
 def server_get_doc_filepath(port, document_name):
-    endpoint = f"http://localhost:{port}/filepath"
     try:
-        response = requests.post(endpoint, data=json.dumps({"document_name": document_name}))
-        return response.json().get("data")
+        return hopper_client(port).filepath(document_name)
     except Exception as e:
         print(e)
     return None
@@ -104,51 +113,89 @@ def open_binary_in_hopper(binary: Path, arch_flag):
     _launch_binary_workaround_hopper_bug(binary, hopper_args)
 
 
-def wait_for_document(port, document_name):
-    """Wait for a specific Document to become available"""
+def wait_for_documents(port, predicate, timeout=None):
+    """Wait until predicate(documents) returns something other than None, and return it. documents is the list of
+    {"document", "path", "analyzing"} of the open documents. The server's /events long poll wakes the wait up
+    as soon as the documents change. A server that is not up yet, or that has no /events, is polled with
+    exponential backoff instead. Raises TimeoutError after timeout seconds
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    delay = BACKOFF_INITIAL_DELAY
+    after = None
     while True:
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            raise TimeoutError("timed out waiting for the Hopper documents")
+
         try:
-            documents = server_list_documents(port)
-            if document_name in documents:
-                break
+            wait = EVENTS_WAIT if remaining is None else min(EVENTS_WAIT, remaining)
+            state = hopper_client(port).events(after=after, timeout=wait)
+            result = predicate(state["documents"])
+            if result is not None:
+                return result
+            after = state["sequence"]
+            delay = BACKOFF_INITIAL_DELAY
+            continue
         except requests.exceptions.ConnectionError:
             pass
+        except HopperClientError:
+            # A server without /events, or with every /events slot taken
+            try:
+                result = predicate(server_poll_documents(port))
+                if result is not None:
+                    return result
+            except requests.exceptions.ConnectionError:
+                pass
+
+        time.sleep(delay if remaining is None else min(delay, remaining))
+        delay = min(delay * 2, BACKOFF_MAX_DELAY)
+
+
+def server_poll_documents(port):
+    """The documents, as the /events documents, read with one request per document"""
+    documents = []
+    for document_name in server_list_documents(port):
+        documents.append({"document": document_name, "path": server_get_doc_filepath(port, document_name), "analyzing": None})
+    return documents
+
+
+def wait_for_document(port, document_name, timeout=None):
+    """Wait for a specific Document to become available"""
 
+    def is_open(documents):
+        return True if any(document["document"] == document_name for document in documents) else None
 
-def wait_for_new_document(port, previous_docs):
+    wait_for_documents(port, is_open, timeout)
+
+
+def wait_for_new_document(port, previous_docs, timeout=None):
     """Wait for a previously-unknown Document to become available.
     previous_docs: Document names that are already known
     """
-    while True:
-        try:
-            new_documents = server_list_documents(port)
-            if len(new_documents) > len(previous_docs):
-                # Find the new item
-                new_document = [new_doc for new_doc in new_documents if new_doc not in previous_docs][0]
-                return new_document
-        except requests.exceptions.ConnectionError:
-            pass
 
+    def new_document(documents):
+        new_documents = [document["document"] for document in documents if document["document"] not in previous_docs]
+        return new_documents[0] if new_documents else None
 
-def wait_for_named_document_with_path(port, document_file_path):
+    return wait_for_documents(port, new_document, timeout)
+
+
+def wait_for_named_document_with_path(port, document_file_path, timeout=None):
     """Wait for a Document to become available that:
     1. Has a real name, which indicates it is not still processing
     2. Has a executablePath that matches the provided document_file_path
     """
-    while True:
-        try:
-            new_documents = server_list_documents(port)
-            for document in new_documents:
-                # Skip un-named (still analyzing) docs
-                if "Untitle" in document:
-                    continue
-                if document_file_path == server_get_doc_filepath(port, document):
-                    return document
 
-            time.sleep(1)
+    def named_document(documents):
+        for document in documents:
+            # Skip un-named (still analyzing) docs
+            if "Untitle" in document["document"]:
+                continue
+            if document_file_path == document["path"]:
+                return document["document"]
+        return None
 
-        except requests.exceptions.ConnectionError:
-            pass
+    return wait_for_documents(port, named_document, timeout)
 
 
 testbin_path = Path("/Users/ethanarbuckle/Desktop/decrypt")#Path("/Users/ethanarbuckle/Downloads/app_downloads/Payload 65/app-decrypt-com.cvs.cvspharmacyr1buo3ck.app/CVSOnlineiPhone")
@@ -0,0 +1,155 @@
+import sqlite3
+
+import pytest
+
+import hopper_cache
+from hopper_cache import DecompilationCache
+
+
+class FakeInstruction(object):
+    def __init__(self, architecture):
+        self.architecture = architecture
+
+    def getArchitecture(self):
+        return self.architecture
+
+
+class FakeBlock(object):
+    def __init__(self, end):
+        self.end = end
+
+    def getEndingAddress(self):
+        return self.end
+
+
+class FakeSegment(object):
+    def __init__(self, document):
+        self.document = document
+        self.__internal_segment_addr__ = id(document)
+
+    def getStartingAddress(self):
+        return 0x1000
+
+    def getProcedureCount(self):
+        return len(self.document.procedures)
+
+    def getNamedAddresses(self):
+        return sorted(self.document.labels)
+
+    def getLabelsList(self):
+        return [self.document.labels[address] for address in sorted(self.document.labels)]
+
+    def getInstructionAtAddress(self, address):
+        return FakeInstruction(self.document.architecture)
+
+
+class FakeProcedure(object):
+    def __init__(self, document, entry_point):
+        self.document = document
+        self.entry_point = entry_point
+
+    def getEntryPoint(self):
+        return self.entry_point
+
+    def getSegment(self):
+        return self.document.segment
+
+    def getBasicBlockCount(self):
+        return 1
+
+    def getBasicBlock(self, index):
+        return FakeBlock(self.entry_point + 0x10)
+
+    def decompile(self):
+        self.document.decompiled += 1
+        return f"{self.document.labels[self.entry_point]}() {{}}"
+
+
+class FakeDocument(object):
+    def __init__(self, path, architecture, internal):
+        self.path = path
+        self.architecture = architecture
+        self.__internal_document_addr__ = internal
+        self.labels = {0x1000: "main", 0x1100: "helper"}
+        self.procedures = [0x1000, 0x1100]
+        self.decompiled = 0
+        self.segment = FakeSegment(self)
+
+    def getExecutableFilePath(self):
+        return self.path
+
+    def backgroundProcessActive(self):
+        return False
+
+    def getEntryPoint(self):
+        return 0x1000
+
+    def getSegmentAtAddress(self, address):
+        return self.segment
+
+    def getSegmentsList(self):
+        return [self.segment]
+
+    def procedure(self, entry_point):
+        return FakeProcedure(self, entry_point)
+
+
+@pytest.fixture
+def executable(tmp_path):
+    path = tmp_path / "fat"
+    path.write_bytes(b"\xca\xfe\xba\xbe" + bytes(64))
+    return str(path)
+
+
+@pytest.fixture(autouse=True)
+def no_stamp_interval(monkeypatch):
+    monkeypatch.setattr(hopper_cache, "ANALYSIS_STAMP_INTERVAL", 0)
+
+
+def test_fat_slices_are_cached_apart(executable):
+    cache = DecompilationCache()
+    x86_64 = FakeDocument(executable, 2, 1)
+    aarch64 = FakeDocument(executable, 5, 2)
+    aarch64.labels[0x1000] = "_start"
+
+    assert cache.decompile(x86_64, x86_64.procedure(0x1000)) == "main() {}"
+    assert cache.decompile(aarch64, aarch64.procedure(0x1000)) == "_start() {}"
+    assert cache.executable_key(x86_64) != cache.executable_key(aarch64)
+
+
+def test_renames_outside_hopper_api_invalidate_the_disk_tier(executable, tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    document = FakeDocument(executable, 5, 1)
+    cache = DecompilationCache(path)
+    assert cache.decompile(document, document.procedure(0x1000)) == "main() {}"
+    cache.close()
+
+    # Same analysis in a new session: served from disk
+    cache = DecompilationCache(path)
+    assert cache.decompile(document, document.procedure(0x1000)) == "main() {}"
+    assert cache.disk_hits == 1 and document.decompiled == 1
+
+    # Renamed in the UI
+    document.labels[0x1000] = "entry"
+    assert cache.decompile(document, document.procedure(0x1000)) == "entry() {}"
+    cache.close()
+
+    cache = DecompilationCache(path)
+    assert cache.decompile(document, document.procedure(0x1000)) == "entry() {}"
+    assert document.decompiled == 2
+
+
+def test_failed_writes_are_not_notified(executable, tmp_path):
+    cache = DecompilationCache(str(tmp_path / "cache.sqlite"))
+    document = FakeDocument(executable, 5, 1)
+    cache.executable_key(document)
+    notified = []
+    cache.add_listener(lambda *arguments: notified.append(arguments))
+    cache._database.execute("CREATE TRIGGER full BEFORE INSERT ON pseudocode BEGIN SELECT RAISE(ABORT, 'disk full'); END")
+
+    assert cache.decompile(document, document.procedure(0x1000)) == "main() {}"
+    assert notified == []
+    with pytest.raises(sqlite3.Error):
+        cache.put(cache.executable_key(document), 0x1100, 0x1110, "helper() {}")
+    assert notified == []
+    assert cache.stats()["memory_entries"] == 0
@@ -0,0 +1,156 @@
+import pytest
+
+from hopper_callgraph import CALLEES, CALLERS, CallGraph
+
+CALL = 1
+JUMP = 2
+
+
+class FakeReference(object):
+    def __init__(self, from_address, to_address, call_type=CALL):
+        self._from = from_address
+        self._to = to_address
+        self._type = call_type
+
+    def fromAddress(self):
+        return self._from
+
+    def toAddress(self):
+        return self._to
+
+    def type(self):
+        return self._type
+
+
+class FakeProcedure(object):
+    def __init__(self, entry_point, end, callees):
+        self.entry_point = entry_point
+        self.end = end
+        self.callees = callees
+
+    def getEntryPoint(self):
+        return self.entry_point
+
+    def getAllCallees(self):
+        return [FakeReference(*callee) for callee in self.callees]
+
+
+class FakeSegment(object):
+    def __init__(self, procedures):
+        self.procedures = procedures
+
+    def getProcedureCount(self):
+        return len(self.procedures)
+
+    def getProcedureAtIndex(self, index):
+        return self.procedures[index]
+
+
+class FakeDocument(object):
+    """Procedures of 0x10 bytes at the given entry points, calling (call site, called address[, call type])"""
+
+    def __init__(self, calls):
+        self.segment = FakeSegment([FakeProcedure(entry_point, entry_point + 0x10, callees) for entry_point, callees in calls.items()])
+
+    def getSegmentsList(self):
+        return [self.segment]
+
+    def getProcedureAtAddress(self, address):
+        for procedure in self.segment.procedures:
+            if procedure.entry_point <= address < procedure.end:
+                return procedure
+        return None
+
+
+@pytest.fixture
+def document():
+    # main -> parse -> helper, main -> run -> helper, run -> run, a <-> b, run -> imported stub 0x9000
+    return FakeDocument(
+        {
+            0x100: [(0x104, 0x200), (0x108, 0x300)],
+            0x200: [(0x204, 0x400)],
+            0x300: [(0x304, 0x400), (0x308, 0x300), (0x30C, 0x9000, JUMP)],
+            0x400: [],
+            0x500: [(0x504, 0x600)],
+            0x600: [(0x604, 0x500)],
+        }
+    )
+
+
+def test_nodes_and_edges(document):
+    graph = CallGraph(document)
+    assert list(graph.addresses) == [0x100, 0x200, 0x300, 0x400, 0x500, 0x600, 0x9000]
+    assert graph.edge_count() == 8
+    assert graph.is_procedure(0x100)
+    assert not graph.is_procedure(0x9000)
+
+
+def test_callees_and_callers(document):
+    graph = CallGraph(document)
+    assert graph.callees(0x300) == [(0x304, 0x400, CALL), (0x308, 0x300, CALL), (0x30C, 0x9000, JUMP)]
+    assert sorted(graph.callers(0x400)) == [(0x204, 0x200, CALL), (0x304, 0x300, CALL)]
+    with pytest.raises(KeyError):
+        graph.callees(0x700)
+
+
+def test_calls_into_a_procedure_body_resolve_to_its_entry_point():
+    graph = CallGraph(FakeDocument({0x100: [(0x104, 0x208)], 0x200: []}))
+    assert graph.callees(0x100) == [(0x104, 0x200, CALL)]
+
+
+def test_traversals(document):
+    graph = CallGraph(document)
+    assert list(graph.bfs(0x100)) == [(0x100, 0), (0x200, 1), (0x300, 1), (0x400, 2), (0x9000, 2)]
+    assert list(graph.bfs(0x100, max_depth=1)) == [(0x100, 0), (0x200, 1), (0x300, 1)]
+    assert list(graph.dfs(0x100)) == [0x100, 0x200, 0x400, 0x300, 0x9000]
+    assert graph.reachable(0x400, CALLERS) == {0x100, 0x200, 0x300, 0x400}
+    assert graph.reachable(0x300, call_types={CALL}) == {0x300, 0x400}
+    assert graph.is_reachable(0x100, 0x400)
+    assert not graph.is_reachable(0x400, 0x100)
+
+
+def test_shortest_caller_chain(document):
+    graph = CallGraph(document)
+    assert graph.shortest_caller_chain(0x400) == [0x100, 0x200, 0x400]
+    assert graph.shortest_caller_chain(0x400, sources=[0x300]) == [0x300, 0x400]
+    assert graph.shortest_caller_chain(0x100, sources=[0x500]) is None
+
+
+def test_strongly_connected_components(document):
+    graph = CallGraph(document)
+    assert sorted(graph.strongly_connected_components()) == [[0x300], [0x500, 0x600]]
+    assert len(graph.strongly_connected_components(min_size=1)) == 6
+
+
+def test_refresh_only_gathers_modified_procedures(document):
+    graph = CallGraph(document)
+    document.segment.procedures[3].callees = [(0x404, 0x100)]
+    # Not modified through hopper_api: the graph does not know
+    assert graph.callees(0x400) == []
+
+    assert graph.refresh(addresses=[0x40C]) == 1
+    assert graph.callees(0x400) == [(0x404, 0x100, CALL)]
+    assert graph.is_reachable(0x400, 0x300)
+
+
+def test_modification_observer(document):
+    graph = CallGraph(document)
+
+    class FakeSegmentClass(object):
+        CHANGE_BYTES = 1
+        CHANGE_TYPE = 2
+        CHANGE_NAME = 3
+        CHANGE_LOCAL_NAME = 4
+        CHANGE_COMMENT = 5
+
+        @staticmethod
+        def addModificationObserver(callback):
+            pass
+
+    graph.install(FakeSegmentClass)
+    document.segment.procedures[3].callees = [(0x404, 0x100)]
+    graph.on_modification(0, 0x404, 1, FakeSegmentClass.CHANGE_COMMENT)
+    assert graph.refresh() == 0
+    graph.on_modification(0, 0x404, 4, FakeSegmentClass.CHANGE_BYTES)
+    assert graph.refresh() == 1
+    assert graph.callees(0x400) == [(0x404, 0x100, CALL)]
@@ -0,0 +1,125 @@
+from array import array
+
+from hopper_cfg import ControlFlowGraph
+
+
+def graph(successors, entry_point=0x100, size=0x10):
+    """ControlFlowGraph of blocks of size bytes from entry_point on, block i jumping to successors[i]"""
+    starts = array("Q", (entry_point + size * index for index in range(len(successors))))
+    ends = array("Q", (start + size for start in starts))
+    offsets = array("l", [0])
+    flat = array("l")
+    for block_successors in successors:
+        flat.extend(block_successors)
+        offsets.append(len(flat))
+    return ControlFlowGraph(entry_point, starts, ends, offsets, flat)
+
+
+class FakeBlock(object):
+    def __init__(self, start, end, successors):
+        self.start = start
+        self.end = end
+        self.successors = successors
+
+    def getStartingAddress(self):
+        return self.start
+
+    def getEndingAddress(self):
+        return self.end
+
+    def getSuccessorCount(self):
+        return len(self.successors)
+
+    def getSuccessorIndexAtIndex(self, index):
+        return self.successors[index]
+
+
+class FakeProcedure(object):
+    def __init__(self, entry_point, blocks):
+        self.entry_point = entry_point
+        self.blocks = blocks
+
+    def getEntryPoint(self):
+        return self.entry_point
+
+    def basicBlockIterator(self):
+        return iter(self.blocks)
+
+
+class FakeSnapshot(object):
+    def __init__(self, blocks, edges):
+        self.blocks = blocks
+        self.edges = edges
+
+    def basic_blocks(self, procedure_id):
+        return self.blocks
+
+    def successors(self, procedure_id):
+        return self.edges
+
+
+def test_from_procedure_and_snapshot_agree():
+    procedure = FakeProcedure(0x110, [FakeBlock(0x100, 0x110, [2]), FakeBlock(0x110, 0x120, [0, 2]), FakeBlock(0x120, 0x130, [])])
+    live = ControlFlowGraph.from_procedure(procedure)
+    assert live.entry == 1
+    assert live.block_count() == 3
+    assert list(live.block_successors(1)) == [0, 2]
+
+    snapshot = FakeSnapshot(
+        [{"block_index": 0, "start": 0x100, "end": 0x110}, {"block_index": 1, "start": 0x110, "end": 0x120}, {"block_index": 2, "start": 0x120, "end": 0x130}],
+        [
+            {"block_index": 0, "successor_index": 2},
+            {"block_index": 1, "successor_index": 0},
+            {"block_index": 1, "successor_index": 2},
+        ],
+    )
+    stored = ControlFlowGraph.from_snapshot(snapshot, {"id": 0, "entry_point": 0x110})
+    assert stored.to_json(True, True) == live.to_json(True, True)
+
+
+def test_to_json():
+    cfg = graph([[1, 2], [3], [3], []]).to_json()
+    assert cfg == {
+        "address": 0x100,
+        "entry": 0,
+        "starts": [0x100, 0x110, 0x120, 0x130],
+        "ends": [0x110, 0x120, 0x130, 0x140],
+        "edge_sources": [0, 0, 1, 2],
+        "edge_targets": [1, 2, 3, 3],
+    }
+
+
+def test_dominators_of_a_diamond():
+    cfg = graph([[1, 2], [3], [3], []])
+    assert cfg.reverse_postorder()[0] == 0
+    assert cfg.immediate_dominators() == [-1, 0, 0, 0]
+    assert cfg.dominates(0, 3)
+    assert not cfg.dominates(1, 3)
+    assert cfg.loops() == []
+
+
+def test_unreachable_blocks_have_no_dominator():
+    cfg = graph([[1], [], [1]])
+    assert cfg.immediate_dominators() == [-1, 0, -1]
+    assert cfg.reverse_postorder() == [0, 1]
+
+
+def test_nested_loops():
+    # 0 -> 1 (outer header) -> 2 (inner header) -> 3 -> 2, 3 -> 4 -> 1, 4 -> 5
+    cfg = graph([[1], [2], [3], [2, 4], [1, 5], []])
+    assert cfg.immediate_dominators() == [-1, 0, 1, 2, 3, 4]
+
+    outer, inner = cfg.loops()
+    assert outer == {"header": 1, "blocks": [1, 2, 3, 4], "back_edges": [4], "parent": None, "depth": 1}
+    assert inner == {"header": 2, "blocks": [2, 3], "back_edges": [3], "parent": 0, "depth": 2}
+
+
+def test_self_loop():
+    cfg = graph([[1], [1, 2], []])
+    assert cfg.loops() == [{"header": 1, "blocks": [1], "back_edges": [1], "parent": None, "depth": 1}]
+
+
+def test_irreducible_cycle_is_not_a_loop():
+    # 1 and 2 form a cycle entered from 0 through both of them
+    cfg = graph([[1, 2], [2], [1]])
+    assert cfg.loops() == []
@@ -0,0 +1,65 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from hopper_client import HopperClient, HopperClientError
+
+
+class Handler(BaseHTTPRequestHandler):
+    """/documents answers like the servers, /fail with an error, and every other route like GCDWebServer for an
+    unknown route: a 501 status without a body
+    """
+
+    def do_GET(self):
+        self.do_POST()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path == "/documents":
+            self.reply(200, {"data": ["binary.hop"]})
+        elif self.path == "/fail":
+            self.reply(500, {"data": None, "error": "failed to find specified document"})
+        else:
+            self.send_response(501)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+    def reply(self, status, body):
+        body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *arguments):
+        pass
+
+
+@pytest.fixture
+def client():
+    server = HTTPServer(("localhost", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    with HopperClient(port=server.server_address[1], retries=0) as client:
+        yield client
+    server.shutdown()
+    server.server_close()
+
+
+def test_data(client):
+    assert client.documents() == ["binary.hop"]
+
+
+def test_error(client):
+    with pytest.raises(HopperClientError, match="failed to find specified document"):
+        client.post("/fail")
+
+
+def test_unknown_route_without_body(client):
+    with pytest.raises(HopperClientError, match="HTTP 501"):
+        client.events(after=0, timeout=1)
+    with pytest.raises(HopperClientError, match="HTTP 501"):
+        list(client.stream("/procedures", document_name="binary.hop"))
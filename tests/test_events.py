@@ -0,0 +1,112 @@
+import logging
+import threading
+import time
+
+import pytest
+
+import hopper_events
+from hopper_events import ANALYSIS_FINISHED, DOCUMENT_CLOSED, DOCUMENT_OPENED, DOCUMENT_RENAMED, DocumentEvents
+
+
+class FakeDocuments(object):
+    """Open documents: internal address -> [name, path, analyzing], and the analysis ends they wait on"""
+
+    def __init__(self):
+        self.documents = {}
+        self.analysis_ends = {}
+        self.failure = None
+
+    def document_class(self):
+        documents = self
+
+        class FakeDocument(object):
+            def __init__(self, internal):
+                self.__internal_document_addr__ = internal
+
+            @staticmethod
+            def getAllDocuments():
+                if documents.failure:
+                    raise Exception(documents.failure)
+                return [FakeDocument(internal) for internal in list(documents.documents)]
+
+            def getDocumentName(self):
+                return documents.documents[self.__internal_document_addr__][0]
+
+            def getExecutableFilePath(self):
+                return documents.documents[self.__internal_document_addr__][1]
+
+            def backgroundProcessActive(self):
+                return documents.documents[self.__internal_document_addr__][2]
+
+            def waitForBackgroundProcessToEnd(self):
+                documents.analysis_ends.setdefault(self.__internal_document_addr__, threading.Event()).wait()
+
+        return FakeDocument
+
+    def end_analysis(self, internal):
+        self.documents[internal][2] = False
+        self.analysis_ends.setdefault(internal, threading.Event()).set()
+
+
+@pytest.fixture
+def documents():
+    documents = FakeDocuments()
+    documents.documents[1] = ["existing.hop", "/bin/existing", False]
+    return documents
+
+
+@pytest.fixture
+def events(documents, monkeypatch):
+    monkeypatch.setattr(hopper_events, "WATCH_INTERVAL", 0.02)
+    events = DocumentEvents()
+    events.start(documents.document_class())
+    yield events
+    for internal in list(documents.documents):
+        documents.end_analysis(internal)
+    events.stop()
+
+
+def test_documents_open_at_start_are_not_events(events):
+    assert events.state() == (0, [{"document": "existing.hop", "path": "/bin/existing", "analyzing": False}])
+    assert events.wait(0, timeout=0.05) == []
+
+
+def test_lifecycle(events, documents):
+    documents.documents[2] = ["Untitled", "/bin/new", True]
+    opened = events.wait(0, timeout=2)
+    assert opened == [{"type": DOCUMENT_OPENED, "document": "Untitled", "path": "/bin/new", "analyzing": True, "sequence": 1}]
+
+    # The analysis waiter wakes the watcher up: no need to wait for a poll
+    documents.documents[2][0] = "new.hop"
+    documents.end_analysis(2)
+    finished = events.wait(1, timeout=2)
+    assert [(event["type"], event["sequence"]) for event in finished] == [(DOCUMENT_RENAMED, 2), (ANALYSIS_FINISHED, 3)]
+    assert finished[0]["previous_name"] == "Untitled"
+
+    del documents.documents[1]
+    closed = events.wait(3, timeout=2)
+    assert closed == [{"type": DOCUMENT_CLOSED, "document": "existing.hop", "path": "/bin/existing", "sequence": 4}]
+    assert events.state()[0] == 4
+
+
+def test_wait_filters_types(events, documents):
+    documents.documents[2] = ["Untitled", "/bin/new", True]
+    assert events.wait(0, timeout=2, event_types={DOCUMENT_OPENED})
+    documents.end_analysis(2)
+    finished = events.wait(0, timeout=2, event_types={ANALYSIS_FINISHED})
+    assert [event["type"] for event in finished] == [ANALYSIS_FINISHED]
+
+
+def test_wait_times_out(events):
+    started = time.monotonic()
+    assert events.wait(0, timeout=0.1) == []
+    assert time.monotonic() - started >= 0.1
+
+
+def test_repeated_failures_are_logged_once(events, documents, caplog):
+    with caplog.at_level(logging.WARNING, logger="hopper_events"):
+        documents.failure = "document closed while read"
+        time.sleep(0.2)
+        documents.failure = None
+        time.sleep(0.1)
+    assert [record.getMessage() for record in caplog.records] == ["failed to look at the documents: document closed while read"]
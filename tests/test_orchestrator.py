@@ -0,0 +1,143 @@
+import json
+import random
+import socket
+
+import pytest
+
+from hopper_orchestrator import DONE, FAILED, PENDING, RUNNING, JobQueue, Orchestrator, StubBackend, StubSpawner, latency_summary
+
+
+def free_base_port(count):
+    """First of count consecutive free ports"""
+    for base_port in range(53100, 60000, count):
+        sockets = []
+        try:
+            for port in range(base_port, base_port + count):
+                candidate = socket.socket()
+                sockets.append(candidate)
+                candidate.bind(("localhost", port))
+            return base_port
+        except OSError:
+            continue
+        finally:
+            for candidate in sockets:
+                candidate.close()
+    raise RuntimeError("no free ports")
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = JobQueue(str(tmp_path / "queue.db"), max_attempts=2)
+    yield queue
+    queue.close()
+
+
+def test_claim_in_order(queue):
+    first = queue.enqueue("/bin/a", "--aarch64", "/out/a")
+    second = queue.enqueue("/bin/b", "--aarch64", "/out/b")
+
+    job = queue.claim(0)
+    assert job["id"] == first
+    assert job["attempts"] == 1
+    assert queue.claim(1)["id"] == second
+    assert queue.claim(2) is None
+    assert queue.counts() == {PENDING: 0, RUNNING: 2, DONE: 0, FAILED: 0}
+
+
+def test_fail_retries_until_max_attempts(queue):
+    job_id = queue.enqueue("/bin/a", "--aarch64", "/out/a")
+
+    queue.claim(0)
+    assert queue.fail(job_id, "crashed") == PENDING
+    job = queue.claim(0)
+    assert job["attempts"] == 2
+    assert queue.fail(job_id, "crashed again") == FAILED
+    assert queue.claim(0) is None
+    assert queue.counts()[FAILED] == 1
+
+
+def test_requeue_running(queue):
+    queue.enqueue("/bin/a", "--aarch64", "/out/a")
+    queue.enqueue("/bin/b", "--aarch64", "/out/b")
+    queue.claim(0)
+    queue.claim(1)
+
+    assert queue.requeue_running() == 2
+    assert queue.counts() == {PENDING: 2, RUNNING: 0, DONE: 0, FAILED: 0}
+
+
+def test_report(queue):
+    for index in range(3):
+        queue.enqueue(f"/bin/{index}", "--aarch64", f"/out/{index}")
+    for seconds in (1.0, 3.0):
+        job = queue.claim(0)
+        queue.complete(job["id"], {"open": 0.5, "analysis": seconds})
+    job = queue.claim(0)
+    queue.fail(job["id"], "crashed")
+    job = queue.claim(0)
+    queue.fail(job["id"], "crashed")
+
+    report = queue.report()
+    assert report["done"] == 2
+    assert report["failed"] == 1
+    assert report["phases"]["analysis"]["count"] == 2
+    assert report["phases"]["analysis"]["mean"] == 2.0
+    assert report["phases"]["analysis"]["max"] == 3.0
+    assert "export" not in report["phases"]
+
+
+def test_latency_summary():
+    summary = latency_summary([4, 1, 3, 2])
+    assert summary == {"count": 4, "mean": 2.5, "p50": 3, "p95": 4, "max": 4}
+
+
+def test_stub_events_sequence():
+    backend = StubBackend(free_base_port(1), analysis_time=0.05)
+    try:
+        state = backend.events()
+        assert state == {"sequence": 0, "events": [], "documents": []}
+
+        backend.open("/bin/a")
+        state = backend.events(after=0, timeout=1)
+        assert [event["type"] for event in state["events"]] == ["opened"]
+        assert state["sequence"] == 1
+        assert state["documents"] == [{"document": "Untitled 1", "path": "/bin/a", "analyzing": True}]
+
+        # Waits for the end of the analysis
+        state = backend.events(after=state["sequence"], timeout=5)
+        assert [event["type"] for event in state["events"]] == ["renamed", "analysis_finished"]
+        assert state["sequence"] == 3
+        assert state["documents"] == [{"document": "a.hop", "path": "/bin/a", "analyzing": False}]
+
+        # Nothing happens: the wait times out on the same sequence
+        assert backend.events(after=3, timeout=0.05)["events"] == []
+        assert backend.events(after=3, timeout=0.05)["sequence"] == 3
+
+        backend.handle("/close", {"document_name": "a.hop"})
+        state = backend.events(after=3, timeout=1)
+        assert [event["type"] for event in state["events"]] == ["closed"]
+        assert state["documents"] == []
+    finally:
+        backend.stop()
+
+
+def test_orchestrator_retries_crashed_instances(tmp_path):
+    random.seed(1)
+    queue = JobQueue(str(tmp_path / "queue.db"), max_attempts=10)
+    for index in range(12):
+        binary = tmp_path / f"binary{index}"
+        binary.write_bytes(b"\0")
+        queue.enqueue(binary, "--aarch64", tmp_path / "out" / f"binary{index}.snapshot")
+
+    instance_count = 3
+    orchestrator = Orchestrator(queue, StubSpawner(analysis_time=0.01, crash_rate=0.3), instance_count, free_base_port(instance_count), analysis_timeout=30)
+    report = orchestrator.run(until_empty=True)
+
+    assert queue.counts() == {PENDING: 0, RUNNING: 0, DONE: 12, FAILED: 0}
+    assert report["done"] == 12
+    for index in range(12):
+        assert json.loads((tmp_path / "out" / f"binary{index}.snapshot").read_text())["document"] == f"binary{index}.hop"
+    # Some attempts crashed, and were retried
+    attempts = [row[0] for row in queue._database.execute("SELECT attempts FROM jobs")]
+    assert max(attempts) > 1
+    queue.close()
@@ -0,0 +1,214 @@
+import json
+import threading
+
+import pytest
+
+from hopper_pipeline import CANCELLED, FAILED, FINISHED, DecompilationPipeline, read_results
+
+
+class FakeBlock(object):
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+    def getStartingAddress(self):
+        return self.start
+
+    def getEndingAddress(self):
+        return self.end
+
+
+class FakeProcedure(object):
+    def __init__(self, document, entry_point, size):
+        self.document = document
+        self.entry_point = entry_point
+        self.size = size
+
+    def getEntryPoint(self):
+        return self.entry_point
+
+    def basicBlockIterator(self):
+        return iter([FakeBlock(self.entry_point, self.entry_point + self.size)])
+
+    def decompile(self):
+        return self.document.decompile(self)
+
+
+class FakeSegment(object):
+    def __init__(self, procedures):
+        self.procedures = procedures
+
+    def getProcedureCount(self):
+        return len(self.procedures)
+
+    def getProcedureAtIndex(self, index):
+        return self.procedures[index]
+
+
+class FakeDocument(object):
+    """Procedures at 0x1000, 0x1100, ... of growing sizes. The ones in failing raise, the ones in empty decompile to None"""
+
+    def __init__(self, count, failing=(), empty=()):
+        self.segment = FakeSegment([FakeProcedure(self, 0x1000 + 0x100 * index, 4 * (index + 1)) for index in range(count)])
+        self.failing = set(failing)
+        self.empty = set(empty)
+        self.decompiled = []
+        self.stop_requests = 0
+        self._lock = threading.Lock()
+
+    def getDocumentName(self):
+        return "binary.hop"
+
+    def getExecutableFilePath(self):
+        return "/bin/binary"
+
+    def getSegmentsList(self):
+        return [self.segment]
+
+    def requestBackgroundProcessStop(self):
+        self.stop_requests += 1
+
+    def decompile(self, procedure):
+        with self._lock:
+            self.decompiled.append(procedure.entry_point)
+        if procedure.entry_point in self.failing:
+            raise Exception("decompiler crashed")
+        if procedure.entry_point in self.empty:
+            return None
+        return f"void sub_{procedure.entry_point:x}() {{}}"
+
+
+def test_run_writes_every_procedure(tmp_path):
+    output_path = str(tmp_path / "pseudocode.ndjson")
+    document = FakeDocument(10)
+    pipeline = DecompilationPipeline(document, output_path, worker_count=3)
+    assert pipeline.run() == FINISHED
+
+    header, results = read_results(output_path)
+    assert header == {"document": "binary.hop", "executable_path": "/bin/binary"}
+    assert results == {0x1000 + 0x100 * index: f"void sub_{0x1000 + 0x100 * index:x}() {{}}" for index in range(10)}
+    status = pipeline.status()
+    assert (status["total"], status["done"], status["failed"], status["remaining"]) == (10, 10, 0, 0)
+
+
+def test_procedures_are_scheduled_largest_first(tmp_path):
+    document = FakeDocument(5)
+    DecompilationPipeline(document, str(tmp_path / "out.ndjson"), worker_count=1).run()
+    assert document.decompiled == [0x1400, 0x1300, 0x1200, 0x1100, 0x1000]
+
+
+def test_failures_are_reported_and_retried(tmp_path):
+    output_path = str(tmp_path / "out.ndjson")
+    document = FakeDocument(4, failing=[0x1100], empty=[0x1200])
+    pipeline = DecompilationPipeline(document, output_path, worker_count=2)
+    assert pipeline.run() == FINISHED
+
+    status = pipeline.status()
+    assert status["done"] == 2
+    assert status["failed"] == 2
+    assert sorted(status["failures"], key=lambda failure: failure["address"]) == [
+        {"address": 0x1100, "error": "decompiler crashed"},
+        {"address": 0x1200, "error": "no pseudocode was produced"},
+    ]
+
+    # The next run only tries the failed procedures again
+    document.failing = set()
+    document.empty = set()
+    document.decompiled = []
+    pipeline = DecompilationPipeline(document, output_path, worker_count=2)
+    assert pipeline.run() == FINISHED
+    assert sorted(document.decompiled) == [0x1100, 0x1200]
+    assert pipeline.status()["skipped"] == 2
+    assert len(read_results(output_path)[1]) == 4
+
+
+def test_resume_after_a_crash(tmp_path):
+    output_path = tmp_path / "out.ndjson"
+    output_path.write_text(
+        json.dumps({"document": "binary.hop", "executable_path": "/bin/binary"})
+        + "\n"
+        + json.dumps({"address": 0x1000, "pseudocode": "done before"})
+        + "\n"
+        + '{"address": 4352, "pseudo'
+    )
+    # The line cut short is not a result
+    assert read_results(str(output_path))[1] == {0x1000: "done before"}
+
+    document = FakeDocument(3)
+    pipeline = DecompilationPipeline(document, str(output_path))
+    assert pipeline.run() == FINISHED
+    assert sorted(document.decompiled) == [0x1100, 0x1200]
+
+    header, results = read_results(str(output_path))
+    assert header["executable_path"] == "/bin/binary"
+    assert results[0x1000] == "done before"
+    assert sorted(results) == [0x1000, 0x1100, 0x1200]
+
+
+def test_resume_refuses_the_output_of_another_executable(tmp_path):
+    output_path = tmp_path / "out.ndjson"
+    output_path.write_text(json.dumps({"document": "other.hop", "executable_path": "/bin/other"}) + "\n")
+    pipeline = DecompilationPipeline(FakeDocument(1), str(output_path))
+    assert pipeline.run() == FAILED
+    assert "/bin/other" in pipeline.status()["error"]
+
+
+def test_cancel(tmp_path):
+    output_path = str(tmp_path / "out.ndjson")
+    document = FakeDocument(20)
+
+    def progress(pipeline):
+        if pipeline.done == 5:
+            pipeline.cancel()
+
+    pipeline = DecompilationPipeline(document, output_path, worker_count=1, progress=progress)
+    assert pipeline.run() == CANCELLED
+    assert pipeline.status()["done"] == 5
+    assert pipeline.status()["remaining"] == 15
+    assert document.stop_requests == 1
+    assert len(read_results(output_path)[1]) == 5
+
+
+def test_cancel_before_start_does_not_touch_the_document(tmp_path):
+    document = FakeDocument(3)
+    pipeline = DecompilationPipeline(document, str(tmp_path / "out.ndjson"))
+    pipeline.cancel()
+    assert pipeline.run() == CANCELLED
+    assert document.decompiled == []
+    assert not (tmp_path / "out.ndjson").exists()
+
+
+def test_workers_hold_the_lock(tmp_path):
+    held = threading.local()
+    entered = []
+
+    class Lock(object):
+        def __enter__(self):
+            held.value = True
+            entered.append(1)
+
+        def __exit__(self, *exc_info):
+            held.value = False
+
+    document = FakeDocument(4)
+    decompile = document.decompile
+
+    def locked_decompile(procedure):
+        assert getattr(held, "value", False)
+        return decompile(procedure)
+
+    document.decompile = locked_decompile
+    pipeline = DecompilationPipeline(document, str(tmp_path / "out.ndjson"), worker_count=2, lock=Lock)
+    assert pipeline.run() == FINISHED
+    assert pipeline.status()["done"] == 4
+    # Once to list the procedures, then once per procedure
+    assert len(entered) == 5
+
+
+@pytest.mark.parametrize("worker_count", [1, 4])
+def test_start_and_join(tmp_path, worker_count):
+    pipeline = DecompilationPipeline(FakeDocument(8), str(tmp_path / "out.ndjson"), worker_count=worker_count)
+    pipeline.start()
+    pipeline.join(10)
+    assert pipeline.state == FINISHED
+    assert pipeline.status()["procedures_per_second"] is not None
@@ -0,0 +1,86 @@
+import pytest
+
+import hopper_proxy
+from hopper_proxy import BatchRequest, DecompileProcedure, HopperHandler
+
+
+class FakeDocument(object):
+    names = ["binary.hop", "library.hop"]
+
+    def __init__(self, index):
+        self.index = index
+
+    @staticmethod
+    def getAllDocuments():
+        return [FakeDocument(index) for index in range(len(FakeDocument.names))]
+
+    @staticmethod
+    def getDocumentsGeneration():
+        # Like Hopper's, unchanged by the renames Hopper makes on its own
+        return len(FakeDocument.names)
+
+    def getDocumentName(self):
+        return FakeDocument.names[self.index]
+
+    def getExecutableFilePath(self):
+        return "/bin/" + self.getDocumentName()
+
+    def getProcedureAtAddress(self, address):
+        return address if address == 0x100003F20 else None
+
+
+@pytest.fixture(autouse=True)
+def documents(monkeypatch):
+    monkeypatch.setattr(hopper_proxy, "Document", FakeDocument, raising=False)
+    monkeypatch.setattr(FakeDocument, "names", list(FakeDocument.names))
+    HopperHandler.invalidate_document_cache()
+    yield
+    HopperHandler.invalidate_document_cache()
+
+
+@pytest.mark.parametrize("concurrent", [False, True])
+def test_batch_with_handlers_without_document_name(concurrent):
+    results = BatchRequest.run(
+        [
+            {"path": "/documents"},
+            {"path": "/filepath"},
+            {"path": "/filepath", "args": {"document_name": "library.hop"}},
+        ],
+        document_name="binary.hop",
+        concurrent=concurrent,
+    )
+    assert results == [
+        {"data": ["binary.hop", "library.hop"]},
+        {"data": "/bin/binary.hop"},
+        {"data": "/bin/library.hop"},
+    ]
+
+
+def test_decompile_parses_the_address(monkeypatch):
+    class FakeCache(object):
+        @staticmethod
+        def decompile(document, procedure):
+            return f"{procedure:#x}"
+
+    monkeypatch.setattr(hopper_proxy, "decompilation_cache", FakeCache)
+    assert DecompileProcedure.run("binary.hop", "0x100003f20") == "0x100003f20"
+
+
+def test_document_locks_do_not_outlive_their_requests():
+    with pytest.raises(Exception, match="failed to find specified document"):
+        BatchRequest.dispatch(hopper_proxy.DocumentFilePath, {"document_name": "missing.hop"})
+    BatchRequest.dispatch(hopper_proxy.DocumentFilePath, {"document_name": "binary.hop"})
+    assert hopper_proxy._document_locks == {}
+
+    with hopper_proxy.document_lock("binary.hop", write=False):
+        with hopper_proxy.document_lock("binary.hop", write=False):
+            assert hopper_proxy._document_locks["binary.hop"][1] == 2
+    assert hopper_proxy._document_locks == {}
+
+
+def test_renamed_documents_are_not_found_by_their_previous_name():
+    assert HopperHandler.get_document_named("binary.hop").index == 0
+    FakeDocument.names[0] = "binary"
+    with pytest.raises(Exception, match="failed to find specified document"):
+        HopperHandler.get_document_named("binary.hop")
+    assert HopperHandler.get_document_named("binary").index == 0
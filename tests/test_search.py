@@ -0,0 +1,158 @@
+import re
+
+import pytest
+
+from hopper_search import (
+    KIND_COMMENT,
+    KIND_LABEL,
+    KIND_PSEUDOCODE,
+    KIND_STRING,
+    SearchIndex,
+    SearchIndexCache,
+    matching_line,
+    required_literals,
+    trigrams,
+)
+
+
+@pytest.mark.parametrize(
+    "pattern, literals",
+    [
+        ("objc_msgSend", ["objc_msgSend"]),
+        ("foo.*bar", ["foo", "bar"]),
+        ("^hello$", ["hello"]),
+        (r"ab\.cd", ["ab.cd"]),
+        ("x[abc]yz", ["x", "yz"]),
+        ("(abc)+de?f", ["abc", "d", "f"]),
+        ("(?:xyz){0,3}w", ["w"]),
+        ("abc{2}", ["ab", "c"]),
+        ("a|bcd", []),
+    ],
+)
+def test_required_literals(pattern, literals):
+    assert required_literals(pattern) == literals
+    assert required_literals(pattern, re.IGNORECASE) == literals
+
+
+def test_required_literals_are_in_every_match():
+    pattern = "(init|alloc)WithFrame:.*(frame)+"
+    for text in ("initWithFrame: (CGRect)frame", "allocWithFrame:frameframe"):
+        assert re.search(pattern, text)
+        for literal in required_literals(pattern):
+            assert literal in text
+
+
+def test_trigrams():
+    assert trigrams("AbcD") == {"abc", "bcd"}
+    assert trigrams("ab") == set()
+
+
+def test_matching_line():
+    text = "int f() {\n    return g();\n}"
+    assert matching_line(text, text.index("g()")) == "    return g();"
+    assert matching_line(text, 0) == "int f() {"
+    assert matching_line(text, len(text) - 1) == "}"
+
+
+@pytest.fixture
+def index():
+    index = SearchIndex()
+    index.add(KIND_STRING, 0x1000, "Hello, World")
+    index.add(KIND_STRING, 0x1010, "hello again")
+    index.add(KIND_LABEL, 0x2000, "-[AppDelegate applicationDidFinishLaunching:]")
+    index.add(KIND_COMMENT, 0x2004, "checks the license")
+    index.add(KIND_PSEUDOCODE, 0x2000, "void f() {\n    check_license();\n    return;\n}", 0x2040)
+    return index
+
+
+def test_substring_search(index):
+    assert [result["address"] for result in index.search("hello")] == [0x1000, 0x1010]
+    assert [result["address"] for result in index.search("Hello", case_sensitive=True)] == [0x1000]
+    assert index.search("license", kinds=[KIND_COMMENT]) == [{"kind": KIND_COMMENT, "address": 0x2004, "text": "checks the license"}]
+    assert len(index.search("hello", limit=1)) == 1
+    assert index.search("missing") == []
+
+
+def test_pseudocode_results_are_the_matching_line(index):
+    assert index.search("check_license") == [{"kind": KIND_PSEUDOCODE, "address": 0x2000, "text": "    check_license();"}]
+
+
+def test_regex_search(index):
+    assert [result["kind"] for result in index.search(r"application\w+Launching", regex=True)] == [KIND_LABEL]
+    assert [result["address"] for result in index.search("^hel+o", regex=True)] == [0x1000, 0x1010]
+    # Too short to filter on trigrams: every text is compared
+    assert [result["address"] for result in index.search("w.r", regex=True)] == [0x1000]
+
+
+def test_replace_and_remove(index):
+    index.add(KIND_STRING, 0x1000, "Goodbye")
+    assert [result["address"] for result in index.search("hello")] == [0x1010]
+    index.add(KIND_STRING, 0x1010, "")
+    assert index.search("hello") == []
+    assert len(index) == 4
+
+
+def test_remove_pseudocode(index):
+    index.remove_pseudocode(0x2030, 0x2038)
+    assert index.search("check_license") == []
+    assert len(index.search("license")) == 1
+
+
+class FakeBlock(object):
+    def getInstructionList(self):
+        return [(0x2000, None), (0x2004, None)]
+
+
+class FakeProcedure(object):
+    def basicBlockIterator(self):
+        return iter([FakeBlock()])
+
+
+class FakeSegment(object):
+    __internal_segment_addr__ = 1
+    comments = {0x2004: "checks the license"}
+
+    def getNamedAddresses(self):
+        return [0x2000]
+
+    def getLabelsList(self):
+        return ["check"]
+
+    def getProcedureCount(self):
+        return 1
+
+    def getProcedureAtIndex(self, index):
+        return FakeProcedure()
+
+    def getCommentAtAddress(self, address):
+        return self.comments.get(address)
+
+    def getInlineCommentAtAddress(self, address):
+        return None
+
+
+class FakeDocument(object):
+    __internal_document_addr__ = 1
+
+    def getExecutableFilePath(self):
+        return "/bin/binary"
+
+    def getSegmentsList(self):
+        return [FakeSegment()]
+
+
+class FakeStringTable(object):
+    strings = []
+
+
+def test_comments_at_unnamed_addresses_need_scan_comments():
+    cache = SearchIndexCache()
+    document = FakeDocument()
+    index = cache.index(document, FakeStringTable())
+    assert index.search("license") == []
+
+    scanned = cache.index(document, FakeStringTable(), scan_comments=True)
+    assert scanned is not index
+    assert scanned.search("license") == [{"kind": KIND_COMMENT, "address": 0x2004, "text": "checks the license"}]
+    # A scanned index also serves the searches without scan_comments
+    assert cache.index(document, scanned.string_table) is scanned
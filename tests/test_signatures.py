@@ -0,0 +1,105 @@
+import pytest
+
+from hopper_signatures import Signature, SignatureScanner
+
+
+def test_from_string():
+    signature = Signature.from_string("48 8B ?? 05 4? ?F")
+    assert signature.values == bytes([0x48, 0x8B, 0x00, 0x05, 0x40, 0x0F])
+    assert signature.mask == bytes([0xFF, 0xFF, 0x00, 0xFF, 0xF0, 0x0F])
+    assert signature.to_string() == "48 8B ?? 05 4? ?F"
+    assert Signature.from_string("488B??05").to_string() == "48 8B ?? 05"
+
+
+@pytest.mark.parametrize("text", ["", "??", "4", "GG", "48 8B 0"])
+def test_invalid_strings(text):
+    with pytest.raises(ValueError):
+        Signature.from_string(text)
+
+
+def test_parse():
+    assert Signature.parse({"bytes": "c3"}).to_string() == "C3"
+    assert Signature.parse({"bytes": "48ff", "mask": "ff0f"}).to_string() == "48 ?F"
+    signature = Signature.from_string("90")
+    assert Signature.parse(signature) is signature
+    with pytest.raises(ValueError):
+        Signature.parse(42)
+
+
+def test_scan_bytes_reports_overlapping_and_shared_matches():
+    scanner = SignatureScanner({"nops": "90 90", "nop_ret": "90 C3", "any_ret": "?? C3"})
+    data = bytes([0x90, 0x90, 0x90, 0xC3, 0x00])
+    assert sorted(scanner.scan_bytes(data, 0x1000)) == [
+        ("any_ret", 0x1002),
+        ("nop_ret", 0x1002),
+        ("nops", 0x1000),
+        ("nops", 0x1001),
+    ]
+
+
+def test_scan_bytes_stops_at_end():
+    scanner = SignatureScanner(["AA BB"])
+    assert scanner.scan_bytes(bytes([0xAA, 0xBB, 0xAA, 0xBB]), 0, end=2) == [(0, 0)]
+
+
+def test_nibble_wildcards():
+    scanner = SignatureScanner(["E? 00"])
+    assert scanner.scan_bytes(bytes([0xE8, 0x00, 0xD8, 0x00, 0xEF, 0x00])) == [(0, 0), (0, 4)]
+
+
+def test_scan_range_finds_matches_across_chunks():
+    data = bytearray(100)
+    for offset in (0, 7, 14, 30, 62, 97):
+        data[offset:offset + 3] = b"\xde\xad\xbe"
+    reads = []
+
+    def reader(address, length):
+        reads.append((address, length))
+        return bytes(data[address - 0x4000:address - 0x4000 + length])
+
+    scanner = SignatureScanner(["DE AD BE"])
+    matches = scanner.scan_range(reader, 0x4000, 0x4000 + len(data), chunk_size=8)
+    assert [address - 0x4000 for _, address in matches] == [0, 7, 14, 30, 62, 97]
+    # Each chunk reads the signature length minus one byte past its end
+    assert reads[0] == (0x4000, 10)
+
+
+class FakeSegment(object):
+    def __init__(self, name, start, data):
+        self.name = name
+        self.start = start
+        self.data = data
+
+    def getName(self):
+        return self.name
+
+    def getStartingAddress(self):
+        return self.start
+
+    def getLength(self):
+        return len(self.data)
+
+    def readBytes(self, address, length):
+        return self.data[address - self.start:address - self.start + length]
+
+
+class FakeDocument(object):
+    def __init__(self, segments):
+        self.segments = segments
+
+    def getSegmentsList(self):
+        return self.segments
+
+
+@pytest.mark.parametrize("worker_count", [1, 4])
+def test_scan_document(worker_count):
+    document = FakeDocument([FakeSegment("__DATA", 0x8000, b"\x00\xc3\xc3"), FakeSegment("__TEXT", 0x1000, b"\xc3\x90\xc3")])
+    scanner = SignatureScanner({"ret": "C3"})
+    assert scanner.scan(document, worker_count=worker_count) == [("ret", 0x1000), ("ret", 0x1002), ("ret", 0x8001), ("ret", 0x8002)]
+    assert scanner.scan(document, segment_names=["__TEXT"], worker_count=worker_count) == [("ret", 0x1000), ("ret", 0x1002)]
+    assert scanner.scan(document, start=0x1001, end=0x8002, worker_count=worker_count) == [("ret", 0x1002), ("ret", 0x8001)]
+
+
+def test_no_signatures():
+    with pytest.raises(ValueError):
+        SignatureScanner([])
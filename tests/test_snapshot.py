@@ -0,0 +1,15 @@
+from hopper_snapshot import BAD_ADDRESS, loaded_address, stored_address
+
+
+def test_addresses_keep_their_order():
+    addresses = [0, 0x1000, 0x7FFFFFFFFFFFFFFF, 0x8000000000000000, 0xFFFFFFFFFFFFFFFF]
+    stored = [stored_address(address) for address in addresses]
+    assert stored == sorted(stored)
+    assert all(-(1 << 63) <= value < (1 << 63) for value in stored)
+    assert [loaded_address(value) for value in stored] == addresses
+
+
+def test_missing_addresses_are_null():
+    assert stored_address(None) is None
+    assert stored_address(BAD_ADDRESS) is None
+    assert loaded_address(None) is None